@@ -15,7 +15,9 @@ import logging
 import sys
 import os
 import base64
+import io
 import time
+import numpy as np
 import pandas as pd
 
 from configparser import ConfigParser
@@ -68,6 +70,50 @@ def web_service_get(url):
     return None
     
 
+###################################################################
+#
+# web_service_post
+#
+# Posts data, retrying up to twice when the connection fails or the
+# service answers 429 or 5xx, since the post may never have arrived
+# or its response may have been lost. Any other status, such as 400
+# for an invalid template, is returned at once. Retrying is only
+# safe because the data carries an idempotency key: a repeated post
+# returns the job of the first one instead of creating another.
+#
+def web_service_post(url, data):
+  try:
+    retries = 0
+    
+    while True:
+      try:
+        response = requests.post(url, json=data)
+
+        if response.status_code != 429 and response.status_code < 500:
+          break
+        print("post failed with status", response.status_code)
+      except requests.exceptions.ConnectionError as e:
+        if retries >= 2:
+          raise
+        print("post failed, retrying:", e)
+
+      retries = retries + 1
+      if retries < 3:
+        time.sleep(retries)
+        continue
+
+      break
+
+    return response
+
+  except Exception as e:
+    print("**ERROR**")
+    logging.error("web_service_post() failed:")
+    logging.error("url: " + url)
+    logging.error(e)
+    return None
+
+
 ############################################################
 #
 # prompt
@@ -163,6 +209,19 @@ def template(baseurl):
 
     if res.status_code == 200: #success
       raw_content = res.text  
+
+      print("Pre-fill THRESHOLDS with suggested values?")
+      print("Press ENTER to keep defaults, or")
+      print("enter method (otsu or mixture)>")
+      method = input()
+
+      if method != "":
+        thresholds = suggest(baseurl, method)
+        if thresholds is not None:
+          template_json = json.loads(raw_content)
+          template_json["THRESHOLDS"] = thresholds
+          raw_content = json.dumps(template_json, indent=2)
+
       filename = "template.json"
       with open(filename, "w", encoding="utf-8") as f:
         f.write(raw_content)
@@ -185,6 +244,48 @@ def template(baseurl):
     return
   
 
+############################################################
+#
+# suggest
+#
+def suggest(baseurl, method):
+  """
+  Asks the web service for thresholds suggested from the stored
+  marker intensity histograms of every sample.
+
+  Parameters - baseurl: baseurl for web service,
+               method: otsu or mixture
+  Returns - THRESHOLDS dictionary, or None on failure
+  """
+
+  try:
+    api = '/suggest?method=' + method
+    url = baseurl + api
+
+    res = web_service_get(url)
+
+    if res.status_code == 200: #success
+      pass
+    else:
+      # failed:
+      print("Failed with status code:", res.status_code)
+      print("url: " + url)
+      if res.status_code == 500:
+        body = res.json()
+        print("Error message:", body)
+      return None
+
+    body = res.json()
+
+    print("Thresholds suggested using", body["METHOD"])
+    return body["THRESHOLDS"]
+
+  except Exception as e:
+    logging.error("**ERROR: suggest() failed:")
+    logging.error("url: " + url)
+    logging.error(e)
+    return None
+
 ############################################################
 #
 # jobs
@@ -239,16 +340,138 @@ def jobs(baseurl):
     logging.error(e)
     return
 
+############################################################
+#
+# sweep_dataframe
+#
+def sweep_dataframe(body):
+  """
+  Converts the result of a threshold sweep into a DataFrame with
+  one row per (marker, threshold) and one column per sample
+
+  Parameters - body: sweep result returned by the web service
+  Returns - DataFrame of positive cell counts
+  """
+
+  index = []
+  for marker, thresholds in body["thresholds"].items():
+    for threshold in thresholds:
+      index.append((marker, threshold))
+
+  columns = {}
+  for sample, counts in body["counts"].items():
+    column = []
+    for marker in body["thresholds"]:
+      column.extend(counts[marker])
+    columns[sample] = column
+
+  index = pd.MultiIndex.from_tuples(index, names=["Marker", "Threshold"])
+  return pd.DataFrame(columns, index=index)
+
+############################################################
+#
+# timing_report
+#
+def timing_report(baseurl, jobid):
+  """
+  Prints where a completed job spent its time, one row per stage
+  sorted by total seconds, and its memory report if it was profiled
+
+  Parameters - baseurl: baseurl for web service, jobid: job id
+  Returns - nothing
+  """
+
+  url = baseurl + '/results/' + str(jobid) + '?timing=true'
+  res = web_service_get(url)
+  if res is None or res.status_code != 200:
+    print("No timing summary for this job")
+    return
+
+  body = res.json()
+  df = pd.DataFrame.from_dict(body["stages"], orient='index')
+  df = df.sort_values("seconds", ascending=False)
+  df.index.name = "stage"
+
+  print()
+  print("Job time:", round(body["total_seconds"], 2), "seconds")
+  print(df.to_string())
+  print()
+
+  # only jobs run with memory profiling have a memory report
+  res = web_service_get(baseurl + '/results/' + str(jobid) + '?memory=true')
+  if res is None or res.status_code != 200:
+    return
+
+  body = res.json()
+  print("Peak memory:", body["peak_rss_mb"], "MB RSS,", body["peak_traced_mb"], "MB traced")
+  if "fit" in body:
+    print("Memory per million cells:", body["fit"]["mb_per_million_cells"], "MB")
+  for samples, mb in body["recommended_mb"].items():
+    print("Recommended Lambda memory for", samples, "samples:", mb, "MB")
+  print()
+
+############################################################
+#
+# result_dataframe
+#
+def result_dataframe(body):
+  """
+  Returns the matrix of a compute id 1-3 result, sent either as
+  JSON or as a base64 encoded .npz (see result_format)
+
+  Parameters - body: parsed response body
+  Returns - DataFrame with one row per phenotype (or "Cells") and
+            one column per sample
+  """
+
+  if body.get("format") != "npz":
+    return pd.DataFrame.from_dict(body, orient='index')
+
+  data = base64.b64decode(body["data"])
+  with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+    return pd.DataFrame(npz['values'], index=list(npz['rows']), columns=list(npz['columns']))
+
+############################################################
+#
+# show_partial
+#
+def show_partial(body, shown, output_file):
+  """
+  Prints the columns of the samples completed since the last poll
+  and writes the partial matrix to the result CSV
+
+  Parameters - body: parsed 481 response body with partial results,
+               shown: list of samples already printed, extended in
+               place, output_file: CSV the results are written to
+  Returns - nothing
+  """
+
+  df = pd.DataFrame.from_dict(body["results"], orient='index')
+  new = [sample for sample in body["completed"] if sample not in shown]
+  if len(new) == 0:
+    return
+
+  print("Partial results,", len(body["completed"]), "of", body["total"], "samples completed:")
+  print(df[new])
+  shown.extend(new)
+
+  # in the order the samples completed; the completed results are
+  # written over it in template order
+  df.to_csv(output_file)
+  print("Partial results written to", output_file)
+
 ############################################################
 #
 # upload and compute
 #
-def upload_and_compute(baseurl):
+def upload_and_compute(baseurl, result_format):
   """
   Prompts the user for template file and compute id then prints result
   and downloads as a CSV or JPG depending on compute function
 
-  Parameters - baseurl: baseurl for web service
+  Parameters - baseurl: baseurl for web service, result_format: json
+               or npz, the encoding asked for the results of compute
+               ids 1-3
   Returns - nothing
   """
   
@@ -265,18 +488,37 @@ def upload_and_compute(baseurl):
     print("2: Compute phenotypes as a proportion of total cell count per sample")
     print("3: Compute cell counts per sample")
     print("4: Compute co-occurence matrices separated by LTS vs STS samples")
+    print("5: Compute positive cell counts across a sweep of thresholds per sample")
+    print("6: Compare phenotype proportions between LTS and STS samples")
+    print("7: Compute neighborhood enrichment of phenotype pairs in LTS vs STS samples")
 
     computeid = int(input())
 
-    if computeid > 4 or computeid < 1:
+    if computeid > 7 or computeid < 1:
       return
 
+    matrix_files = {1: 'LTSvsSTS-Phenotype-Counts.csv',
+                    2: 'LTSvsSTS-Phenotype-Proportions.csv',
+                    3: 'LTSvsSTS-Cell-Counts.csv'}
+
     # Open JSON file and load contents
     with open(local_filename, "r") as infile:
       json_data = json.load(infile)
 
+    # ask for binary results when the job produces a matrix; the
+    # CSVs written below are the same either way. Matrix jobs also
+    # return the samples completed so far while they are processing
+    results_query = ''
+    if computeid in matrix_files:
+      results_query = '?partial=true'
+      if result_format == "npz":
+        json_data["RESULT_FORMAT"] = "npz"
+        results_query += '&format=npz'
+
+    # one key per submission, sent again with every retry of it
     data = {"filename": local_filename,
-            "data": json_data}
+            "data": json_data,
+            "idempotencykey": str(uuid.uuid4())}
     
     # Call the web service:
     res = None
@@ -284,13 +526,20 @@ def upload_and_compute(baseurl):
     api = '/upload/' + str(computeid)
     url = baseurl + api
 
-    res = requests.post(url, json=data)
+    res = web_service_post(url, data)
 
-    if res.status_code == 200: #success
+    if res is None:
+      return
+    elif res.status_code == 200: #success
       pass
-    elif res.status_code == 400: # no such user
+    elif res.status_code == 400: # no such user, or an invalid template
       body = res.json()
-      print(body)
+      if isinstance(body, dict) and "errors" in body:
+        print("Template rejected:")
+        for error in body["errors"]:
+          print(" ", error)
+      else:
+        print(body)
       return
     else:
       # failed:
@@ -309,10 +558,11 @@ def upload_and_compute(baseurl):
 
     print("Computation job ID:", jobid)
 
+    shown = []
     while True:
-      if computeid not in [1, 2, 3, 4]:
+      if computeid not in [1, 2, 3, 4, 5, 6, 7]:
         break
-      api = '/results/' + str(jobid)
+      api = '/results/' + str(jobid) + results_query
       url = baseurl + api
       res = web_service_get(url)
       body = res.json()
@@ -323,24 +573,45 @@ def upload_and_compute(baseurl):
 
       print("Status code:", res.status_code)
       if res.status_code == 200:
-        if computeid==1:
-          df = pd.DataFrame.from_dict(body, orient='index')
-          df.to_csv('LTSvsSTS-Phenotype-Counts.csv')
-        elif computeid==2:
-          df = pd.DataFrame.from_dict(body, orient='index')
-          df.to_csv('LTSvsSTS-Phenotype-Proportions.csv')
-        elif computeid==3:
-          df = pd.DataFrame.from_dict(body, orient='index')
-          df.to_csv('LTSvsSTS-Cell-Counts.csv')
+        if computeid in matrix_files:
+          df = result_dataframe(body)
+          df.to_csv(matrix_files[computeid])
         elif computeid==4:
           base64_string = body['heatmap_image']
           image_bytes = base64.b64decode(base64_string)
           output_file = "LTSvsSTS-Co-Occurence-Matrices.jpg"
           with open(output_file, "wb") as f:
               f.write(image_bytes)
+          if 'pvalues' in body:
+            df = pd.DataFrame(body['pvalues'], index=body['markers'], columns=body['markers'])
+            df.to_csv('LTSvsSTS-Co-Occurence-PValues.csv')
+            df = pd.DataFrame(body['difference'], index=body['markers'], columns=body['markers'])
+            df.to_csv('LTSvsSTS-Co-Occurence-Differences.csv')
+        elif computeid==5:
+          df = sweep_dataframe(body)
+          df.to_csv('LTSvsSTS-Threshold-Sweep.csv')
+        elif computeid==6:
+          df = pd.DataFrame.from_dict(body['STATISTICS'], orient='index')
+          df.to_csv('LTSvsSTS-Cohort-Statistics.csv')
+          df = pd.DataFrame.from_dict(body['PROPORTIONS'], orient='index')
+          df.loc['Cohort'] = pd.Series(body['COHORTS'])
+          df.to_csv('LTSvsSTS-Cohort-Proportions.csv')
+        elif computeid==7:
+          df = pd.DataFrame.from_dict(body['STATISTICS'], orient='index')
+          df.to_csv('LTSvsSTS-Neighborhood-Statistics.csv')
+          df = pd.DataFrame.from_dict(body['ZSCORES'], orient='index')
+          df.loc['Cohort'] = pd.Series(body['COHORTS'])
+          df.to_csv('LTSvsSTS-Neighborhood-ZScores.csv')
+          df = pd.DataFrame.from_dict(body['COUNTS'], orient='index')
+          df.to_csv('LTSvsSTS-Neighborhood-Counts.csv')
           
         print("Job Complete")
+        timing_report(baseurl, jobid)
         break
+
+      if res.status_code == 481 and isinstance(body, dict):
+        status = body["status"]
+        show_partial(body, shown, matrix_files[computeid])
       print("Job status:", status)
 
       if "error" in status:
@@ -401,6 +672,12 @@ try:
   if lastchar == "/":
     baseurl = baseurl[:-1]
 
+  # json (the default) or npz, see upload_and_compute
+  result_format = configur.get('client', 'result_format', fallback='json').strip().lower()
+  if result_format not in ["json", "npz"]:
+    print("**ERROR: result_format in the config file must be json or npz")
+    sys.exit(0)
+
   # main processing loop:
   cmd = prompt()
 
@@ -409,7 +686,7 @@ try:
     if cmd == 1:
       template(baseurl)
     elif cmd == 2:
-      upload_and_compute(baseurl)
+      upload_and_compute(baseurl, result_format)
     elif cmd == 3:
       reset(baseurl)
     elif cmd == 4:
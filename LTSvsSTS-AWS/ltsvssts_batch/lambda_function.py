@@ -0,0 +1,202 @@
+#
+# Shared-scan worker for compute ids 1, 2 and 4. The S3 put events
+# of their templates are queued in SQS, and the queue's trigger
+# invokes this function with every job submitted within its batching
+# window. Each sample the jobs read is loaded once and evaluated for
+# all of them (see ltsvssts/sharedscan.py). Compute id 1 and 2 jobs
+# are completed here; compute id 4 jobs are handed to
+# ltsvssts_compute4 once their samples' co-occurrence matrices are
+# cached, so it reads no CSVs.
+#
+
+import json
+import boto3
+import os
+import uuid
+import pathlib
+from ltsvssts import datatier
+from ltsvssts import analysis
+from ltsvssts import jobqueue
+from ltsvssts import loader
+from ltsvssts import prefetch
+from ltsvssts import results
+from ltsvssts import samplecache
+from ltsvssts import sharedscan
+from ltsvssts import timing
+import urllib.parse
+
+from configparser import ConfigParser
+
+def fail_job(s3_client, bucket, dbConn, bucketkey, msg):
+    """
+    Marks a job failed with msg as its results file, which the
+    download function returns to the client
+    """
+    print("**ERROR**", bucketkey + ":", msg)
+    bucketkey_results_file = results.results_key(bucketkey, results.DEFAULT_FORMAT)
+    try:
+        s3_client.put_object(Bucket=bucket, Key=bucketkey_results_file, Body=msg)
+    except Exception as err:
+        print("**could not upload error message:", str(err))
+        bucketkey_results_file = ""
+
+    sql = "update jobs set status = %s, resultsfilekey = %s where datafilekey = %s"
+    datatier.perform_action(dbConn, sql, ['error', bucketkey_results_file, bucketkey])
+
+    # best effort, as in the compute functions' error path
+    try:
+        s3_client.delete_object(Bucket=bucket, Key=results.partial_key(bucketkey))
+    except Exception as err:
+        print("**could not delete partial results:", str(err))
+
+def finish_matrix_job(s3_client, bucket, dbConn, job):
+    """
+    Stores a compute id 1 or 2 job's results as its compute function
+    would and marks it completed
+    """
+    bucketkey_results_file = results.results_key(job.bucketkey, job.result_format)
+    print("bucketkey results file:", bucketkey_results_file)
+
+    with timing.stage("result_encode"):
+        result_body = results.encode_matrix(job.dataframe(), job.result_format)
+    with timing.stage("result_upload"):
+        s3_client.put_object(Bucket=bucket, Key=bucketkey_results_file, Body=result_body)
+
+    # the batch's timing summary, shared by its jobs
+    s3_client.put_object(Bucket=bucket, Key=timing.timing_key(bucketkey_results_file),
+                         Body=json.dumps(timing.summary()))
+
+    sql = "update jobs set status = %s, resultsfilekey = %s where datafilekey = %s"
+    datatier.perform_action(dbConn, sql, ['completed', bucketkey_results_file, job.bucketkey])
+    s3_client.delete_object(Bucket=bucket, Key=results.partial_key(job.bucketkey))
+
+def hand_off(lambda_client, function, bucket, bucketkey):
+    """
+    Invokes a compute function asynchronously with the S3 put event
+    of the job's template, as if S3 had triggered it
+    """
+    s3_event = {"Records": [{"s3": {"bucket": {"name": bucket},
+                                    "object": {"key": urllib.parse.quote_plus(bucketkey, safe="/")}}}]}
+    lambda_client.invoke(FunctionName=function, InvocationType='Event', Payload=json.dumps(s3_event))
+    print("handed", bucketkey, "to", function)
+
+
+def lambda_handler(event, context):
+  dbConn = None
+  jobs = []
+  # jobs completed, handed to compute4 or failed on their own
+  finished = set()
+  try:
+    print("**STARTING**")
+    print("**lambda: ltsvssts_batch**")
+
+    # setup AWS based on config file:
+    config_file = 'ltsvsstsapp-config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+
+    configur = ConfigParser()
+    configur.read(config_file)
+
+    # configure for S3 access:
+    s3_profile = 's3readwrite'
+    boto3.setup_default_session(profile_name=s3_profile)
+
+    bucketname = configur.get('s3', 'bucket_name')
+    s3_client = boto3.client('s3')
+    lambda_client = boto3.client('lambda')
+    compute4_function = configur.get('batch', 'compute4_function', fallback='ltsvssts_compute4')
+
+    # configure for RDS access
+    rds_endpoint = configur.get('rds', 'endpoint')
+    rds_portnum = int(configur.get('rds', 'port_number'))
+    rds_username = configur.get('rds', 'user_name')
+    rds_pwd = configur.get('rds', 'user_pwd')
+    rds_dbname = configur.get('rds', 'db_name')
+
+    # every message is the S3 put event of one job's template
+    bucketkeys = jobqueue.template_keys(event)
+    print("templates in batch:", len(bucketkeys))
+    if len(bucketkeys) == 0:
+      return {
+        'statusCode': 200,
+        'body': json.dumps("no jobs")
+      }
+
+    timing.start_job("batch-" + str(uuid.uuid4()))
+
+    print("**Opening DB connection**")
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    sql = "update jobs set status = %s where datafilekey = %s"
+
+    # a template that cannot be run fails its job only
+    for bucketkey in bucketkeys:
+      try:
+        print("bucketkey:", bucketkey)
+        with timing.stage("template_download"):
+          data = json.loads(s3_client.get_object(Bucket=bucketname, Key=bucketkey)['Body'].read())
+
+        backend = analysis.job_backend(configur, data)
+        job = sharedscan.make_job(s3_client, bucketname, dbConn, bucketkey, data, backend)
+        if job.computeid in (1, 2):
+          job.result_format = results.result_format(data)
+          job.partial = results.PartialResults(s3_client, bucketname, bucketkey, job.row_names, len(job.filelist))
+
+        status = 'processing - starting'
+        datatier.perform_action(dbConn, sql, [status, bucketkey])
+        jobs.append(job)
+      except Exception as err:
+        fail_job(s3_client, bucketname, dbConn, bucketkey, str(err))
+
+    def on_sample(job, file_key, value):
+      sample = loader.sample_name(file_key)
+      if job.computeid in (1, 2):
+        with timing.stage("partial_upload", sample):
+          job.partial.add(sample, value)
+
+      processed = len(job.filelist) - len(job.pending)
+      status = 'processing - ' + pathlib.Path(file_key).name + ' ' + str(processed) + '/' + str(len(job.filelist)) + ' processed'
+      with timing.stage("db_update", sample):
+        datatier.perform_action(dbConn, sql, [status, job.bucketkey])
+
+    cache = samplecache.get_cache(configur)
+    loaded = sharedscan.scan(s3_client, bucketname, jobs, cache, on_sample, prefetch.get_depth(configur))
+    print(cache.report())
+    print("samples loaded:", loaded, "for", len(jobs), "jobs")
+
+    failed = len(bucketkeys) - len(jobs)
+    for job in jobs:
+      try:
+        if job.error is not None:
+          raise Exception(job.error)
+        if job.computeid == 4:
+          hand_off(lambda_client, compute4_function, bucketname, job.bucketkey)
+        else:
+          finish_matrix_job(s3_client, bucketname, dbConn, job)
+      except Exception as err:
+        failed += 1
+        fail_job(s3_client, bucketname, dbConn, job.bucketkey, str(err))
+      finished.add(job.bucketkey)
+
+    print("**DONE**")
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({"jobs": len(bucketkeys), "failed": failed, "samples_loaded": loaded})
+    }
+
+  # an error outside of a job fails every job of the batch that
+  # has not finished yet
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    if dbConn is not None:
+      for job in jobs:
+        if job.bucketkey in finished:
+          continue
+        fail_job(s3_client, bucketname, dbConn, job.bucketkey, str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
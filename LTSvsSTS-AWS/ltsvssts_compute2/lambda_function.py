@@ -10,58 +10,66 @@ import os
 import uuid
 import base64
 import pathlib
-import datatier
+from ltsvssts import datatier
+from ltsvssts import analysis
+from ltsvssts import loader
+from ltsvssts import phenotypes
+from ltsvssts import prefetch
+from ltsvssts import samplecache
+from ltsvssts import registry
+from ltsvssts import results
+from ltsvssts import timing
+from ltsvssts import memprofile
 import urllib.parse
 import string
 import pandas as pd
 import numpy as np
-from io import StringIO
 
 from configparser import ConfigParser
 
-def threshold_data(df, thresholds):
-    thr_series = pd.Series(thresholds)
-    mask = df[thr_series.index] >= thr_series
-    df[thr_series.index] = mask.astype(int)
-
-def quantify_phenotypes(df, phenotypedict):
-    file_counts = []
-    phenotype_sums = {phenotype: df[cols].sum(axis=1) for phenotype, cols in phenotypedict.items()}
-    for phenotype, sum_column in phenotype_sums.items():
-        mask = (sum_column == len(phenotypedict[phenotype]))
-        file_counts.append(mask.sum())
-
-    return file_counts
-
-def phenotype_matrix(s3_client, bucket, filelist, thresholddict, phenotypedict, bucketkey, dbConn):
-    count_matrix = {}
+def phenotype_matrix(s3_client, bucket, filelist, thresholddict, phenotypedict, bucketkey, dbConn, cache, backend,
+                     prefetch_depth):
     row_names = list(phenotypedict.keys())
+    column_names = [loader.sample_name(file_key) for file_key in filelist]
+    count_matrix = np.zeros((len(row_names), len(filelist)), dtype=np.float64)
+
+    # compile once per job, shared subexpressions are then
+    # evaluated once per sample
+    program = phenotypes.compile_phenotypes(phenotypedict)
+    columns = loader.job_columns(thresholddict, program.columns())
 
     total = len(filelist)
+    partial = results.PartialResults(s3_client, bucket, bucketkey, row_names, total)
     filenum = 1
-    for file_key in filelist:
-        print(f"Processing file: {file_key}")
+    # the next samples load while this one is counted
+    def load(file_key):
+        return cache.load(s3_client, bucket, file_key, columns)
 
-        obj = s3_client.get_object(Bucket=bucket, Key=file_key)
-        csv_body = obj['Body'].read().decode('utf-8')
-        df = pd.read_csv(StringIO(csv_body))
+    for j, (file_key, df) in enumerate(prefetch.prefetched(load, filelist, prefetch_depth)):
+        print(f"Processing file: {file_key}")
+        sample = loader.sample_name(file_key)
 
         thresholds = thresholddict[file_key]
 
-        threshold_data(df, thresholds)
-        
-        file_counts = quantify_phenotypes(df, phenotypedict)
+        with timing.stage("threshold", sample):
+            positive = backend.threshold(df, thresholds)
+
+        with timing.stage("phenotypes", sample):
+            file_counts = backend.count_phenotypes(positive, program)
 
-        column_name = pathlib.Path(file_key).stem
         row_count = len(df.index)
-        count_matrix[column_name] = np.array(file_counts)/ row_count * 100
+        count_matrix[:, j] = np.array(file_counts) / row_count * 100
 
-        status = 'processing - ' + str(file_key[14:]) + ' ' + str(filenum) + '/20 processed'
+        with timing.stage("partial_upload", sample):
+            partial.add(sample, count_matrix[:, j])
+
+        status = 'processing - ' + pathlib.Path(file_key).name + ' ' + str(filenum) + '/' + str(total) + ' processed'
         filenum += 1
-        sql = "update jobs set status = %s where datafilekey = %s"
-        modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
+        with timing.stage("db_update", sample):
+            sql = "update jobs set status = %s where datafilekey = %s"
+            modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
 
-    return pd.DataFrame(count_matrix, index=row_names)
+    return pd.DataFrame(count_matrix, index=row_names, columns=column_names)
 
   
 def lambda_handler(event, context):
@@ -111,16 +119,19 @@ def lambda_handler(event, context):
     if extension != ".json" : 
       raise Exception("expecting S3 document to have .json extension")
     
-    bucketkey_results_file = "LTSvsSTS-Result/" + bucketkey[19:-5] + ".json"
+    bucketkey_results_file = "LTSvsSTS-Result/" + pathlib.Path(bucketkey).stem + ".json"
     
     print("bucketkey results file:", bucketkey_results_file)
+
+    timing.start_job(pathlib.Path(bucketkey).stem)
       
     # download JSON from S3 to LOCAL file system:
     print("**DOWNLOADING '", bucketkey, "'**")
 
     local_json = "/tmp/data.json"
     
-    bucket.download_file(bucketkey, local_json)
+    with timing.stage("template_download"):
+      bucket.download_file(bucketkey, local_json)
 
 
     # open LOCAL pdf file:
@@ -128,10 +139,15 @@ def lambda_handler(event, context):
     with open(local_json, 'r') as f:
             data = json.load(f)
 
+    result_format = results.result_format(data)
+    bucketkey_results_file = results.results_key(bucketkey, result_format)
+
+    if memprofile.enabled(configur, data):
+      memprofile.start(configur, pathlib.Path(bucketkey).stem)
+
     thresholddict = data['THRESHOLDS']
     phenotypedict = data['PHENOTYPES']
-    filelist = list(thresholddict.keys()) 
-    
+
     # update status column in DB for this job,
     print("**Opening DB connection**")
     dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
@@ -139,15 +155,36 @@ def lambda_handler(event, context):
     sql = "update jobs set status = %s where datafilekey = %s"
     modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
 
-    df = phenotype_matrix(s3_client, bucketname, filelist, thresholddict, phenotypedict, bucketkey, dbConn)
+    filelist = registry.job_files(dbConn, list(thresholddict.keys()))
+
+    cache = samplecache.get_cache(configur)
+    backend = analysis.job_backend(configur, data)
 
-    result_json = df.to_json(orient='index')
-    s3_client.put_object(Bucket=bucketname, Key=bucketkey_results_file, Body=result_json)
+    df = phenotype_matrix(s3_client, bucketname, filelist, thresholddict, phenotypedict, bucketkey, dbConn, cache, backend,
+                          prefetch.get_depth(configur))
+    print(cache.report())
+
+    with timing.stage("result_encode"):
+      result_body = results.encode_matrix(df, result_format)
+    with timing.stage("result_upload"):
+      s3_client.put_object(Bucket=bucketname, Key=bucketkey_results_file, Body=result_body)
+
+    if memprofile.active():
+      report = memprofile.report(registry.ready_samples(dbConn))
+      print("recommended memory (MB):", report["recommended_mb"])
+      s3_client.put_object(Bucket=bucketname, Key=memprofile.memory_key(bucketkey_results_file),
+                           Body=json.dumps(report))
+
+    # stored before the job completes, so it is there once the
+    # client sees the results
+    s3_client.put_object(Bucket=bucketname, Key=timing.timing_key(bucketkey_results_file),
+                         Body=json.dumps(timing.summary()))
 
     status = 'completed'
     datatier.perform_action(dbConn, sql, [status, bucketkey])
     sql = "update jobs set resultsfilekey = %s where datafilekey = %s"
     datatier.perform_action(dbConn, sql, [bucketkey_results_file, bucketkey])
+    s3_client.delete_object(Bucket=bucketname, Key=results.partial_key(bucketkey))
     print("**DONE**")
     
     return {
@@ -159,12 +196,20 @@ def lambda_handler(event, context):
   except Exception as err:
     print("**ERROR**")
     print(str(err))
+    memprofile.stop()
     
     # update the database if connection is established
     if dbConn is not None:
         status = 'error'
         sql = "update jobs set status = %s, resultsfilekey = %s where datafilekey = %s"
         datatier.perform_action(dbConn, sql, [status, bucketkey_results_file, bucketkey])
+
+        # best effort: the partial results of a failed job are never
+        # completed (deleting a missing key is not an error)
+        try:
+            s3_client.delete_object(Bucket=bucketname, Key=results.partial_key(bucketkey))
+        except Exception as partial_err:
+            print("**could not delete partial results:", str(partial_err))
     
     return {
       'statusCode': 500,
@@ -1,6 +1,8 @@
 #
-# Python program to open and process 20 large CSV file, extracting
-# all numeric values from the document for counting number of cells
+# Python program counting the number of cells in 20 large CSV files.
+# Counts come from the per-sample manifests written at ingest when
+# they match the current CSV, otherwise from a streaming newline
+# count over the S3 body, with the samples fetched concurrently.
 #
 
 import json
@@ -9,38 +11,121 @@ import os
 import uuid
 import base64
 import pathlib
-import datatier
+from ltsvssts import datatier
+from ltsvssts import compression
+from ltsvssts import loader
+from ltsvssts import registry
+from ltsvssts import results
+from ltsvssts import timing
+from ltsvssts import memprofile
 import urllib.parse
 import string
 import pandas as pd
 import numpy as np
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from configparser import ConfigParser
 
-def count_matrix(s3_client, bucket, filelist, bucketkey, dbConn):
-    count_matrix = {}
+CHUNK_SIZE = 8 * 1024 * 1024
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+
+def manifest_cells(s3_client, bucket, file_key):
+    """
+    Returns the cell count recorded in the sample's manifest, or None
+    if there is no ready manifest for the CSV's current ETag
+    """
+    key = "LTSvsSTS-Manifest/" + loader.sample_name(file_key) + ".json"
+    try:
+        manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+    if manifest.get("status") != "ready":
+        return None
+
+    etag = s3_client.head_object(Bucket=bucket, Key=file_key)['ETag'].strip('"')
+    if manifest.get("etag") != etag:
+        print(f"manifest for {file_key} is stale")
+        return None
+
+    return manifest["cells"]
+
+def count_lines(s3_client, bucket, file_key):
+    """
+    Counts data rows by scanning the S3 body for newlines without
+    tokenizing; the sample CSVs are numeric, so no quoted newlines.
+    Blank lines are not counted, as pd.read_csv skips them. A
+    compressed body is decompressed as it streams in
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=file_key)
+    encoding = compression.sample_encoding(file_key, response.get('ContentEncoding'))
+    body = compression.open_stream(response['Body'], encoding)
+
+    lines = 0
+    # the last two bytes before the chunk, as if the body followed
+    # a blank line
+    previous = b'\n\n'
+    for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+        data = np.frombuffer(previous + chunk, dtype=np.uint8)
+        ends = np.flatnonzero(data[2:] == NEWLINE) + 2
+
+        # a line is blank if the byte before its newline, or before
+        # its \r\n, is another newline
+        before = data[ends - 1]
+        before = np.where(before == CARRIAGE_RETURN, data[ends - 2], before)
+        lines += int(np.count_nonzero(before != NEWLINE))
+        previous = bytes(data[-2:])
+
+    # a last row without a trailing newline still counts
+    if previous[-1:] != b'\n':
+        lines += 1
+
+    # minus the header row
+    return max(lines - 1, 0)
+
+def count_cells(s3_client, bucket, file_key):
+    sample = loader.sample_name(file_key)
+    with timing.stage("manifest_read", sample):
+        cells = manifest_cells(s3_client, bucket, file_key)
+    if cells is not None:
+        return cells, "manifest"
+    with timing.stage("newline_scan", sample):
+        return count_lines(s3_client, bucket, file_key), "newline scan"
+
+def count_matrix(s3_client, bucket, filelist, bucketkey, dbConn, max_workers):
     row_names = ["Cells"]
+    column_names = [loader.sample_name(file_key) for file_key in filelist]
+    count_matrix = np.zeros((len(row_names), len(filelist)), dtype=np.int64)
 
     total = len(filelist)
+    partial = results.PartialResults(s3_client, bucket, bucketkey, row_names, total)
     filenum = 1
-    for file_key in filelist:
-        print(f"Processing file: {file_key}")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(count_cells, s3_client, bucket, file_key): j
+                   for j, file_key in enumerate(filelist)}
 
-        obj = s3_client.get_object(Bucket=bucket, Key=file_key)
-        csv_body = obj['Body'].read().decode('utf-8')
-        df = pd.read_csv(StringIO(csv_body))
+        # the DB connection is only used from this thread
+        for future in as_completed(futures):
+            j = futures[future]
+            file_key = filelist[j]
+            sample = loader.sample_name(file_key)
+            row_count, source = future.result()
+            print(f"Processed file: {file_key} ({row_count} cells from {source})")
 
-        column_name = pathlib.Path(file_key).stem
-        row_count = len(df.index)
-        count_matrix[column_name] = row_count
+            count_matrix[0, j] = row_count
 
-        status = 'processing - ' + str(file_key[14:]) + ' ' + str(filenum) + '/20 processed'
-        filenum += 1
-        sql = "update jobs set status = %s where datafilekey = %s"
-        modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
+            with timing.stage("partial_upload", sample):
+                partial.add(sample, count_matrix[:, j])
 
-    return pd.DataFrame(count_matrix, index=row_names)
+            status = 'processing - ' + pathlib.Path(file_key).name + ' ' + str(filenum) + '/' + str(total) + ' processed'
+            filenum += 1
+            with timing.stage("db_update", sample):
+                sql = "update jobs set status = %s where datafilekey = %s"
+                modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
+
+    # columns are in the order of the template
+    return pd.DataFrame(count_matrix, index=row_names, columns=column_names)
 
   
 def lambda_handler(event, context):
@@ -89,16 +174,19 @@ def lambda_handler(event, context):
     if extension != ".json" : 
       raise Exception("expecting S3 document to have .json extension")
     
-    bucketkey_results_file = "LTSvsSTS-Result/" + bucketkey[19:-5] + ".json"
+    bucketkey_results_file = "LTSvsSTS-Result/" + pathlib.Path(bucketkey).stem + ".json"
     
     print("bucketkey results file:", bucketkey_results_file)
+
+    timing.start_job(pathlib.Path(bucketkey).stem)
       
     # download JSON from S3 to LOCAL file system:
     print("**DOWNLOADING '", bucketkey, "'**")
 
     local_json = "/tmp/data.json"
     
-    bucket.download_file(bucketkey, local_json)
+    with timing.stage("template_download"):
+      bucket.download_file(bucketkey, local_json)
 
 
     # open LOCAL json file:
@@ -106,10 +194,15 @@ def lambda_handler(event, context):
     with open(local_json, 'r') as f:
             data = json.load(f)
 
+    result_format = results.result_format(data)
+    bucketkey_results_file = results.results_key(bucketkey, result_format)
+
+    if memprofile.enabled(configur, data):
+      memprofile.start(configur, pathlib.Path(bucketkey).stem)
+
     thresholddict = data['THRESHOLDS']
     phenotypedict = data['PHENOTYPES']
-    filelist = list(thresholddict.keys()) 
-    
+
     # update status column in DB for this job,
     print("**Opening DB connection**")
     dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
@@ -117,15 +210,33 @@ def lambda_handler(event, context):
     sql = "update jobs set status = %s where datafilekey = %s"
     modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
 
-    df = count_matrix(s3_client, bucketname, filelist, bucketkey, dbConn)
+    filelist = registry.job_files(dbConn, list(thresholddict.keys()))
 
-    result_json = df.to_json(orient='index')
-    s3_client.put_object(Bucket=bucketname, Key=bucketkey_results_file, Body=result_json)
+    max_workers = configur.getint('compute', 'max_workers', fallback=8)
+
+    df = count_matrix(s3_client, bucketname, filelist, bucketkey, dbConn, max_workers)
+
+    with timing.stage("result_encode"):
+      result_body = results.encode_matrix(df, result_format)
+    with timing.stage("result_upload"):
+      s3_client.put_object(Bucket=bucketname, Key=bucketkey_results_file, Body=result_body)
+
+    if memprofile.active():
+      report = memprofile.report(registry.ready_samples(dbConn))
+      print("recommended memory (MB):", report["recommended_mb"])
+      s3_client.put_object(Bucket=bucketname, Key=memprofile.memory_key(bucketkey_results_file),
+                           Body=json.dumps(report))
+
+    # stored before the job completes, so it is there once the
+    # client sees the results
+    s3_client.put_object(Bucket=bucketname, Key=timing.timing_key(bucketkey_results_file),
+                         Body=json.dumps(timing.summary()))
 
     status = 'completed'
     datatier.perform_action(dbConn, sql, [status, bucketkey])
     sql = "update jobs set resultsfilekey = %s where datafilekey = %s"
     datatier.perform_action(dbConn, sql, [bucketkey_results_file, bucketkey])
+    s3_client.delete_object(Bucket=bucketname, Key=results.partial_key(bucketkey))
     print("**DONE**")
     
     return {
@@ -137,12 +248,20 @@ def lambda_handler(event, context):
   except Exception as err:
     print("**ERROR**")
     print(str(err))
+    memprofile.stop()
     
     # update the database if connection is established
     if dbConn is not None:
         status = 'error'
         sql = "update jobs set status = %s, resultsfilekey = %s where datafilekey = %s"
         datatier.perform_action(dbConn, sql, [status, bucketkey_results_file, bucketkey])
+
+        # best effort: the partial results of a failed job are never
+        # completed (deleting a missing key is not an error)
+        try:
+            s3_client.delete_object(Bucket=bucketname, Key=results.partial_key(bucketkey))
+        except Exception as partial_err:
+            print("**could not delete partial results:", str(partial_err))
     
     return {
       'statusCode': 500,
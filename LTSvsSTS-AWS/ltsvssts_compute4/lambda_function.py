@@ -1,17 +1,28 @@
 #
-# Python program to open and process 20 large CSV file, extracting
+# Python program to open and process large sample CSV files, extracting
 # all numeric values from the document for creating co-occurence matrices
 # showing proportional co-expression. Differentiates between LTS vs STS
-# samples
+# samples using the cohort recorded for each sample in the registry
 #
 
 import json
+import math
 import boto3
 import os
 import uuid
 import base64
 import pathlib
-import datatier
+from ltsvssts import datatier
+from ltsvssts import analysis
+from ltsvssts import samplecache
+from ltsvssts import loader
+from ltsvssts import prefetch
+from ltsvssts import registry
+from ltsvssts import results
+from ltsvssts import stats
+from ltsvssts import workers
+from ltsvssts import timing
+from ltsvssts import memprofile
 import urllib.parse
 import string
 import pandas as pd
@@ -19,52 +30,98 @@ import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from io import StringIO
 from io import BytesIO
 
 from configparser import ConfigParser
 
-def threshold_data(df, thresholds):
-    thr_series = pd.Series(thresholds)
-    mask = df[thr_series.index] >= thr_series
-    df[thr_series.index] = mask.astype(int)
+def sample_input(s3_client, bucket, file_key, thresholds, markers, cache):
+    """
+    Returns the S3 key of the sample's matrix of co-positive cell
+    counts for every marker pair, and either that matrix and the
+    sample's cell count, from S3 if a job (or the batch worker)
+    already computed them with the same thresholds, or the sample's
+    markers to compute them from
+    """
+    etag = s3_client.head_object(Bucket=bucket, Key=file_key)['ETag']
+    key = results.gram_key(file_key, etag, markers, thresholds)
 
-def aggregate_co_occurrence(s3_client, bucket, filelist, thresholddict, markers, dbConn, bucketkey):
+    cached = results.load_gram(s3_client, bucket, key)
+    if cached is not None:
+        return key, cached, None
 
-    total_cells = 0
-    co_occ_mat = np.zeros((len(markers), len(markers)), dtype=float)
-    
-    file_list_name = list(filelist.keys())[0]
-    filelist = filelist[file_list_name]
-    filenum = 1
-    for file_key in filelist:
-        print(f"Processing file: {file_key}")
+    return key, None, cache.load(s3_client, bucket, file_key, markers)
 
-        obj = s3_client.get_object(Bucket=bucket, Key=file_key)
-        df = pd.read_csv(obj['Body'])
+def sample_grams(s3_client, bucket, filelist, thresholddict, markers, dbConn, bucketkey, cache, backend,
+                 prefetch_depth):
+    grams = np.zeros((len(filelist), len(markers), len(markers)), dtype=np.int64)
+    cells = np.zeros(len(filelist), dtype=np.int64)
 
-        thresholds = thresholddict[file_key]
-        threshold_data(df, thresholds)
+    # the next samples load while this one's matrix is computed
+    def load(file_key):
+        return sample_input(s3_client, bucket, file_key, thresholddict[file_key], markers, cache)
 
-        df = df[markers]
+    total = len(filelist)
+    filenum = 1
+    for j, (file_key, (key, cached, df)) in enumerate(prefetch.prefetched(load, filelist, prefetch_depth)):
+        print(f"Processing file: {file_key}")
+        sample = loader.sample_name(file_key)
 
-        n_cells = df.shape[0]
-        total_cells += n_cells
-        
-        co_occ_mat_file = (df.T @ df).values
-        co_occ_mat += co_occ_mat_file
+        with timing.stage("co_occurrence", sample):
+            if cached is not None:
+                grams[j], cells[j] = cached
+            else:
+                cells[j] = len(df.index)
+                grams[j] = backend.co_occurrence(backend.threshold(df, thresholddict[file_key]), markers)
+                results.store_gram(s3_client, bucket, key, grams[j], cells[j], markers)
+        del df
 
-        status = 'processing - ' + str(file_key[14:]) + ' ' + str(filenum) + '/10 processed for ' + file_list_name
+        status = 'processing - ' + pathlib.Path(file_key).name + ' ' + str(filenum) + '/' + str(total) + ' processed'
         filenum += 1
-        sql = "update jobs set status = %s where datafilekey = %s"
-        modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
-    
-    diag = np.diag(co_occ_mat)
+        with timing.stage("db_update", sample):
+            sql = "update jobs set status = %s where datafilekey = %s"
+            modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
+
+    return grams, cells
+
+def normalize_co_occurrence(co_occ_mat):
+    """
+    Divides each row of one or a stack of co-occurrence matrices by
+    its diagonal entry; rows of markers with no positive cells are 0
+    """
+    diag = np.diagonal(co_occ_mat, axis1=-2, axis2=-1)
     with np.errstate(divide='ignore', invalid='ignore'):
-        normalized_mat = np.divide(co_occ_mat, diag[:, None])
+        normalized_mat = np.divide(co_occ_mat, diag[..., :, None])
         normalized_mat[~np.isfinite(normalized_mat)] = 0
-    
-    return normalized_mat, total_cells
+
+    return normalized_mat
+
+def aggregate_co_occurrence(grams, cells, in_cohort):
+    co_occ_mat = grams[in_cohort].sum(axis=0).astype(float)
+    return normalize_co_occurrence(co_occ_mat), int(cells[in_cohort].sum())
+
+def normalized_difference(lts, sts, n_lts, n_sts):
+    """
+    LTS minus STS normalized co-occurrence from the (marker pairs x
+    labelings) cohort sums of the per-sample matrices
+    """
+    k = math.isqrt(lts.shape[0])
+    batch = lts.shape[1]
+    difference = (normalize_co_occurrence(lts.T.reshape(batch, k, k)) -
+                  normalize_co_occurrence(sts.T.reshape(batch, k, k)))
+    return difference.reshape(batch, k * k).T
+
+def permutation_test(grams, in_lts, permutations, num_workers, seed=None):
+    """
+    Two-sided permutation test of LTS minus STS normalized
+    co-occurrence for every marker pair (stats.permutation_test over
+    the flattened matrices). Returns the observed differences and the
+    p-values, as (markers x markers) matrices.
+    """
+    n, k, _ = grams.shape
+    values = grams.reshape(n, k * k).T
+    observed, pvalues = stats.permutation_test(values, in_lts, permutations, num_workers, seed,
+                                               normalized_difference)
+    return observed.reshape(k, k), pvalues.reshape(k, k)
 
 def generate_heatmap(lts_mat, sts_mat, markers, lts_cells, sts_cells):
     fig, axes = plt.subplots(ncols=2, figsize=(20,10))
@@ -152,16 +209,19 @@ def lambda_handler(event, context):
     if extension != ".json" : 
       raise Exception("expecting S3 document to have .json extension")
     
-    bucketkey_results_file = "LTSvsSTS-Result/" + bucketkey[19:-5] + ".json"
+    bucketkey_results_file = "LTSvsSTS-Result/" + pathlib.Path(bucketkey).stem + ".json"
     
     print("bucketkey results file:", bucketkey_results_file)
+
+    timing.start_job(pathlib.Path(bucketkey).stem)
       
     # download JSON from S3 to LOCAL file system:
     print("**DOWNLOADING '", bucketkey, "'**")
 
     local_json = "/tmp/data.json"
     
-    bucket.download_file(bucketkey, local_json)
+    with timing.stage("template_download"):
+      bucket.download_file(bucketkey, local_json)
 
 
     # open LOCAL json file:
@@ -169,9 +229,16 @@ def lambda_handler(event, context):
     with open(local_json, 'r') as f:
             data = json.load(f)
 
+    if memprofile.enabled(configur, data):
+      memprofile.start(configur, pathlib.Path(bucketkey).stem)
+
     thresholddict = data['THRESHOLDS']
     phenotypedict = data['PHENOTYPES']
-    
+    # the test only runs when the template asks for it, so templates
+    # from before it keep their run time
+    permutations = int(data.get('PERMUTATIONS', 0))
+    seed = data.get('SEED', None)
+
     # update status column in DB for this job
 
     print("**Opening DB connection**")
@@ -183,34 +250,66 @@ def lambda_handler(event, context):
     any_file = list(thresholddict.keys())[0]
     markers = list(thresholddict[any_file].keys())
 
-    # define LTS and STS files
-    LTS_files = {"LTS files":[
-      "LTSvsSTS-Data/NU01713.csv", "LTSvsSTS-Data/NU02064.csv", "LTSvsSTS-Data/NU00866.csv", 
-      "LTSvsSTS-Data/NU01482.csv", "LTSvsSTS-Data/NU01405.csv", "LTSvsSTS-Data/NU00908.csv", 
-      "LTSvsSTS-Data/NU00295.csv", "LTSvsSTS-Data/NU01115.csv", "LTSvsSTS-Data/NU01094.csv", 
-      "LTSvsSTS-Data/NU01798.csv"]}
-        
-    STS_files = {"STS files": ["LTSvsSTS-Data/NU00429.csv", "LTSvsSTS-Data/NU00468.csv", "LTSvsSTS-Data/NU02738.csv", 
-      "LTSvsSTS-Data/NU02514.csv", "LTSvsSTS-Data/NU00431.csv", "LTSvsSTS-Data/NU00759.csv", 
-      "LTSvsSTS-Data/NU01420.csv", "LTSvsSTS-Data/NU02359.csv", "LTSvsSTS-Data/NU00826.csv", 
-      "LTSvsSTS-Data/NU01929.csv"]}
+    # LTS and STS files come from the cohort of each sample in the registry
+    registry.job_files(dbConn, list(thresholddict.keys()))
+    cohorts = registry.cohort_files(dbConn, thresholddict)
+    for cohort in ["LTS", "STS"]:
+      if cohort not in cohorts:
+        raise Exception("no " + cohort + " samples in the job (check the cohort column of the samples table)")
 
-    print("**Aggregating LTS co-occurrence**")
-    lts_mat, lts_cells = aggregate_co_occurrence(s3_client, bucketname, LTS_files, thresholddict, markers, dbConn, bucketkey)
-        
-    print("**Aggregating STS co-occurrence**")
-    sts_mat, sts_cells = aggregate_co_occurrence(s3_client, bucketname, STS_files, thresholddict, markers, dbConn, bucketkey)
+    cache = samplecache.get_cache(configur)
+
+    filelist = cohorts["LTS"] + cohorts["STS"]
+    in_lts = np.array([file_key in cohorts["LTS"] for file_key in filelist])
+
+    print("**Computing per-sample co-occurrence**")
+    backend = analysis.job_backend(configur, data)
+    grams, cells = sample_grams(s3_client, bucketname, filelist, thresholddict, markers, dbConn, bucketkey, cache,
+                                backend, prefetch.get_depth(configur))
+    print(cache.report())
+
+    # any cohort split is now a sum of per-sample matrices
+    print("**Aggregating LTS and STS co-occurrence**")
+    lts_mat, lts_cells = aggregate_co_occurrence(grams, cells, in_lts)
+    sts_mat, sts_cells = aggregate_co_occurrence(grams, cells, ~in_lts)
     
     print("**Generating heatmap image**")
-    heatmap_base64 = generate_heatmap(lts_mat, sts_mat, markers, lts_cells, sts_cells)
+    with timing.stage("heatmap"):
+      heatmap_base64 = generate_heatmap(lts_mat, sts_mat, markers, lts_cells, sts_cells)
         
     result = {
             "heatmap_image": heatmap_base64
         }
-    result_json = json.dumps(result)
+
+    if permutations > 0:
+      num_workers = workers.worker_count(configur)
+      print("**Permuting LTS/STS labels:", permutations, "permutations,", num_workers, "workers**")
+      status = 'processing - permuting cohort labels'
+      sql = "update jobs set status = %s where datafilekey = %s"
+      datatier.perform_action(dbConn, sql, [status, bucketkey])
+
+      with timing.stage("permutations"):
+        difference, pvalues = permutation_test(grams, in_lts, permutations, num_workers, seed)
+      result["markers"] = markers
+      result["difference"] = difference.tolist()
+      result["pvalues"] = pvalues.tolist()
+    with timing.stage("result_encode"):
+      result_json = json.dumps(result)
         
     # upload result JSON to S3
-    s3_client.put_object(Bucket=bucketname, Key=bucketkey_results_file, Body=result_json)
+    with timing.stage("result_upload"):
+      s3_client.put_object(Bucket=bucketname, Key=bucketkey_results_file, Body=result_json)
+
+    if memprofile.active():
+      report = memprofile.report(registry.ready_samples(dbConn))
+      print("recommended memory (MB):", report["recommended_mb"])
+      s3_client.put_object(Bucket=bucketname, Key=memprofile.memory_key(bucketkey_results_file),
+                           Body=json.dumps(report))
+
+    # stored before the job completes, so it is there once the
+    # client sees the results
+    s3_client.put_object(Bucket=bucketname, Key=timing.timing_key(bucketkey_results_file),
+                         Body=json.dumps(timing.summary()))
 
     status = 'completed'
     sql = "update jobs set status = %s where datafilekey = %s"
@@ -229,6 +328,7 @@ def lambda_handler(event, context):
   except Exception as err:
     print("**ERROR**")
     print(str(err))
+    memprofile.stop()
     
     # update the database if connection is established
     if dbConn is not None:
@@ -0,0 +1,224 @@
+#
+# Python program to open and process 20 large CSV file, sorting
+# each marker column once per sample and returning the number of
+# positive cells at every threshold in a sweep, so thresholds can
+# be explored without re-running a full job per attempt.
+#
+
+import json
+import boto3
+import os
+import uuid
+import base64
+import pathlib
+from ltsvssts import datatier
+from ltsvssts import samplecache
+from ltsvssts import loader
+from ltsvssts import prefetch
+from ltsvssts import registry
+from ltsvssts import timing
+import urllib.parse
+import string
+import pandas as pd
+import numpy as np
+
+from configparser import ConfigParser
+
+# thresholds used for every marker when the template has no SWEEP
+DEFAULT_SWEEP = {"START": 1.0, "STOP": 10.0, "STEP": 0.05}
+
+def sweep_thresholds(sweep, markers):
+    """
+    Expands the SWEEP entry of the template into a sorted list of
+    thresholds per marker. SWEEP may be a list (used for every
+    marker), a dict of marker -> list, or a START/STOP/STEP range.
+    """
+    if isinstance(sweep, dict) and "STEP" in sweep:
+        values = np.arange(sweep["START"], sweep["STOP"] + sweep["STEP"] / 2, sweep["STEP"])
+        sweep = np.round(values, 6).tolist()
+
+    if isinstance(sweep, list):
+        return {marker: sorted(sweep) for marker in markers}
+
+    missing = [marker for marker in markers if marker not in sweep]
+    if len(missing) > 0:
+        raise Exception("SWEEP has no thresholds for markers: " + ", ".join(missing))
+
+    return {marker: sorted(sweep[marker]) for marker in markers}
+
+def sort_markers(df, markers):
+    sorted_cols = {}
+    for marker in markers:
+        # kept at the column's precision, as analysis.py thresholds it
+        values = df[marker].to_numpy()
+        if not np.issubdtype(values.dtype, np.floating):
+            values = values.astype(np.float64)
+        sorted_cols[marker] = np.sort(values[~np.isnan(values)])
+
+    return sorted_cols
+
+def sweep_counts(sorted_cols, sweepdict):
+    counts = {}
+    for marker, values in sorted_cols.items():
+        # a cell is positive when intensity >= threshold, compared at
+        # the column's precision like compute1/2, so the positive count
+        # is everything at or after the insertion point
+        thresholds = np.asarray(sweepdict[marker], dtype=np.float64).astype(values.dtype)
+        positions = np.searchsorted(values, thresholds, side='left')
+        counts[marker] = (len(values) - positions).tolist()
+
+    return counts
+
+def sweep_matrix(s3_client, bucket, filelist, sweepdict, bucketkey, dbConn, cache, prefetch_depth):
+    counts = {}
+    cells = {}
+    markers = list(sweepdict.keys())
+
+    # the next samples load while this one is swept
+    def load(file_key):
+        return cache.load(s3_client, bucket, file_key, markers)
+
+    total = len(filelist)
+    filenum = 1
+    for file_key, df in prefetch.prefetched(load, filelist, prefetch_depth):
+        print(f"Processing file: {file_key}")
+        column_name = loader.sample_name(file_key)
+
+        with timing.stage("sort", column_name):
+            sorted_cols = sort_markers(df, markers)
+
+        with timing.stage("sweep", column_name):
+            counts[column_name] = sweep_counts(sorted_cols, sweepdict)
+        cells[column_name] = len(df.index)
+
+        status = 'processing - ' + pathlib.Path(file_key).name + ' ' + str(filenum) + '/' + str(total) + ' processed'
+        filenum += 1
+        with timing.stage("db_update", column_name):
+            sql = "update jobs set status = %s where datafilekey = %s"
+            modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
+
+    return {"thresholds": sweepdict, "cells": cells, "counts": counts}
+
+
+def lambda_handler(event, context):
+  dbConn = None
+  try:
+    print("**STARTING**")
+    print("**lambda: ltsvssts_compute5**")
+
+    bucketkey_results_file = ""
+
+    # setup AWS based on config file:
+    config_file = 'ltsvsstsapp-config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+
+    configur = ConfigParser()
+    configur.read(config_file)
+
+    # configure for S3 access:
+    s3_profile = 's3readwrite'
+    boto3.setup_default_session(profile_name=s3_profile)
+
+    bucketname = configur.get('s3', 'bucket_name')
+    s3 = boto3.resource('s3')
+    s3_client = boto3.client('s3')
+    bucket = s3.Bucket(bucketname)
+
+    # configure for RDS access
+    rds_endpoint = configur.get('rds', 'endpoint')
+    rds_portnum = int(configur.get('rds', 'port_number'))
+    rds_username = configur.get('rds', 'user_name')
+    rds_pwd = configur.get('rds', 'user_pwd')
+    rds_dbname = configur.get('rds', 'db_name')
+
+    # this function is event-driven by a json being
+    # dropped into S3. The bucket key is sent to
+    # us and obtain as follows:
+    bucketkey = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+
+    print("bucketkey:", bucketkey)
+
+    if not bucketkey.startswith("LTSvsSTS5-Template/"):
+            raise Exception("File is not in 'LTSvsSTS5-Template/' folder. Ignoring event.")
+
+    extension = pathlib.Path(bucketkey).suffix
+
+    if extension != ".json" :
+      raise Exception("expecting S3 document to have .json extension")
+
+    bucketkey_results_file = "LTSvsSTS-Result/" + pathlib.Path(bucketkey).stem + ".json"
+
+    print("bucketkey results file:", bucketkey_results_file)
+
+    timing.start_job(pathlib.Path(bucketkey).stem)
+
+    # download JSON from S3 to LOCAL file system:
+    print("**DOWNLOADING '", bucketkey, "'**")
+
+    local_json = "/tmp/data.json"
+
+    with timing.stage("template_download"):
+      bucket.download_file(bucketkey, local_json)
+
+    # open LOCAL json file:
+    print("**PROCESSING local JSON**")
+    with open(local_json, 'r') as f:
+            data = json.load(f)
+
+    thresholddict = data['THRESHOLDS']
+
+    any_file = list(thresholddict.keys())[0]
+    markers = list(thresholddict[any_file].keys())
+    sweepdict = sweep_thresholds(data.get('SWEEP', DEFAULT_SWEEP), markers)
+
+    # update status column in DB for this job,
+    print("**Opening DB connection**")
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    status = 'processing - starting'
+    sql = "update jobs set status = %s where datafilekey = %s"
+    modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
+
+    filelist = registry.job_files(dbConn, list(thresholddict.keys()))
+
+    cache = samplecache.get_cache(configur)
+
+    result = sweep_matrix(s3_client, bucketname, filelist, sweepdict, bucketkey, dbConn, cache,
+                          prefetch.get_depth(configur))
+    print(cache.report())
+
+    with timing.stage("result_encode"):
+      result_json = json.dumps(result)
+    with timing.stage("result_upload"):
+      s3_client.put_object(Bucket=bucketname, Key=bucketkey_results_file, Body=result_json)
+
+    # stored before the job completes, so it is there once the
+    # client sees the results
+    s3_client.put_object(Bucket=bucketname, Key=timing.timing_key(bucketkey_results_file),
+                         Body=json.dumps(timing.summary()))
+
+    status = 'completed'
+    datatier.perform_action(dbConn, sql, [status, bucketkey])
+    sql = "update jobs set resultsfilekey = %s where datafilekey = %s"
+    datatier.perform_action(dbConn, sql, [bucketkey_results_file, bucketkey])
+    print("**DONE**")
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps("success")
+    }
+
+  # on an error, try to upload error message to S3:
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    # update the database if connection is established
+    if dbConn is not None:
+        status = 'error'
+        sql = "update jobs set status = %s, resultsfilekey = %s where datafilekey = %s"
+        datatier.perform_action(dbConn, sql, [status, bucketkey_results_file, bucketkey])
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
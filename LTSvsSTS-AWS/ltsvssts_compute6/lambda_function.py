@@ -0,0 +1,308 @@
+#
+# Python program comparing LTS and STS samples on every phenotype:
+# computes the proportion of cells positive for each phenotype per
+# sample, optionally within distance bins of the sample's distance
+# columns or of nearest-phenotype distances computed from the cell
+# centroids (see spatial.py), then runs a rank-sum and
+# a permutation test between the cohorts for every row, with
+# Benjamini-Hochberg correction across all rows.
+#
+
+import json
+import boto3
+import os
+import uuid
+import base64
+import pathlib
+from ltsvssts import datatier
+from ltsvssts import analysis
+from ltsvssts import loader
+from ltsvssts import phenotypes
+from ltsvssts import prefetch
+from ltsvssts import samplecache
+from ltsvssts import registry
+import spatial
+from ltsvssts import stats
+from ltsvssts import workers
+from ltsvssts import timing
+import urllib.parse
+import string
+import pandas as pd
+import numpy as np
+
+from configparser import ConfigParser
+
+def row_names(phenotypedict, distancedict):
+    names = list(phenotypedict.keys())
+    for metric, distances in distancedict.items():
+        for phenotype in phenotypedict:
+            for distance in distances:
+                names.append(phenotype + " " + metric + " " + distance)
+    return names
+
+def quantify_proportions(positive, metrics, distancedict):
+    """
+    Returns the percentage of cells positive for every phenotype,
+    followed for every distance metric by the percentage of cells
+    in each distance bin that are positive for every phenotype.
+    metrics maps each metric of distancedict to its per-cell values.
+    """
+    positive = positive.astype(np.float32)
+    proportions = [positive.sum(axis=1) / positive.shape[1] * 100]
+
+    for metric, distances in distancedict.items():
+        values = metrics[metric]
+        bins = np.stack([(values >= bounds[0]) & (values < bounds[1])
+                         for bounds in distances.values()]).astype(np.float32)
+
+        # phenotypes x bins counts in one product; an empty bin has
+        # no positive cells and gets 0
+        counts = positive @ bins.T
+        cells = bins.sum(axis=1)
+        percent = np.divide(counts, cells, out=np.zeros_like(counts), where=cells > 0) * 100
+        proportions.append(percent.ravel())
+
+    return np.concatenate(proportions)
+
+def proportion_matrix(s3_client, bucket, filelist, thresholddict, phenotypedict, distancedict,
+                      nearestdict, centroids, num_workers, bucketkey, dbConn, cache, backend, prefetch_depth):
+    names = row_names(phenotypedict, distancedict)
+    column_names = [loader.sample_name(file_key) for file_key in filelist]
+    matrix = np.zeros((len(names), len(filelist)), dtype=np.float64)
+
+    program = phenotypes.compile_phenotypes(phenotypedict)
+    phenotype_names = list(program.outputs.keys())
+
+    # NEAREST columns are computed, not read from the sample
+    read_metrics = [metric for metric in distancedict if metric not in nearestdict]
+    extra = program.columns() + read_metrics
+    if len(nearestdict) > 0:
+        extra += centroids
+    columns = loader.job_columns(thresholddict, extra)
+
+    if len(nearestdict) > 0:
+        print("**Computing nearest-phenotype distances:", len(nearestdict), "columns,", num_workers, "workers**")
+
+    # the next samples load while this one is measured
+    def load(file_key):
+        return cache.load(s3_client, bucket, file_key, columns)
+
+    total = len(filelist)
+    filenum = 1
+    for j, (file_key, df) in enumerate(prefetch.prefetched(load, filelist, prefetch_depth)):
+        print(f"Processing file: {file_key}")
+        sample = loader.sample_name(file_key)
+
+        thresholds = thresholddict[file_key]
+
+        with timing.stage("threshold", sample):
+            thresholded = backend.threshold(df, thresholds)
+
+        with timing.stage("phenotypes", sample):
+            positive = backend.phenotype_masks(thresholded, program)
+        metrics = {metric: df[metric].to_numpy() for metric in read_metrics}
+
+        # NEAREST columns are computed per sample, so only this
+        # sample's masks are held
+        if len(nearestdict) > 0:
+            coords = df[centroids].to_numpy(dtype=np.float64)
+            masks = {name: positive[phenotype_names.index(name)]
+                     for name in spatial.nearest_phenotypes(nearestdict)}
+            with timing.stage("nearest", sample):
+                metrics.update(spatial.nearest_columns(coords, masks, nearestdict, num_workers))
+            del coords, masks
+
+        with timing.stage("proportions", sample):
+            matrix[:, j] = quantify_proportions(positive, metrics, distancedict)
+        del positive, metrics
+
+        status = 'processing - ' + pathlib.Path(file_key).name + ' ' + str(filenum) + '/' + str(total) + ' processed'
+        filenum += 1
+        with timing.stage("db_update", sample):
+            sql = "update jobs set status = %s where datafilekey = %s"
+            modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
+
+    return pd.DataFrame(matrix, index=names, columns=column_names)
+
+def compare_cohorts(proportions, in_lts, permutations, num_workers, seed):
+    """
+    Returns one row of statistics per row of proportions: cohort
+    means, rank-sum U and p-value, permutation p-value, and the
+    Benjamini-Hochberg q-values of both tests
+    """
+    values = proportions.to_numpy()
+
+    u, ranksum_p = stats.rank_sum_test(values, in_lts)
+    difference, permutation_p = stats.permutation_test(values, in_lts, permutations, num_workers, seed)
+
+    return pd.DataFrame({
+      "LTS mean": values[:, in_lts].mean(axis=1),
+      "STS mean": values[:, ~in_lts].mean(axis=1),
+      "Difference": difference,
+      "Rank-sum U": u,
+      "Rank-sum p": ranksum_p,
+      "Rank-sum q": stats.fdr_bh(ranksum_p),
+      "Permutation p": permutation_p,
+      "Permutation q": stats.fdr_bh(permutation_p)
+    }, index=proportions.index)
+
+  
+def lambda_handler(event, context):
+  dbConn = None
+  try:
+    print("**STARTING**")
+    print("**lambda: ltsvssts_compute6**")
+    
+    bucketkey_results_file = ""
+    
+    # setup AWS based on config file:
+    config_file = 'ltsvsstsapp-config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+    
+    configur = ConfigParser()
+    configur.read(config_file)
+    
+    # configure for S3 access:
+    s3_profile = 's3readwrite'
+    boto3.setup_default_session(profile_name=s3_profile)
+    
+    bucketname = configur.get('s3', 'bucket_name')
+    s3 = boto3.resource('s3')
+    s3_client = boto3.client('s3')
+    bucket = s3.Bucket(bucketname)
+    
+
+    # configure for RDS access
+    rds_endpoint = configur.get('rds', 'endpoint')
+    rds_portnum = int(configur.get('rds', 'port_number'))
+    rds_username = configur.get('rds', 'user_name')
+    rds_pwd = configur.get('rds', 'user_pwd')
+    rds_dbname = configur.get('rds', 'db_name')
+    
+    # this function is event-driven by a json being
+    # dropped into S3. The bucket key is sent to 
+    # us and obtain as follows:
+    bucketkey = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+    
+    print("bucketkey:", bucketkey)
+      
+    if not bucketkey.startswith("LTSvsSTS6-Template/"):
+            raise Exception("File is not in 'LTSvsSTS6-Template/' folder. Ignoring event.")
+        
+    extension = pathlib.Path(bucketkey).suffix
+    
+    if extension != ".json" : 
+      raise Exception("expecting S3 document to have .json extension")
+    
+    bucketkey_results_file = "LTSvsSTS-Result/" + pathlib.Path(bucketkey).stem + ".json"
+    
+    print("bucketkey results file:", bucketkey_results_file)
+
+    timing.start_job(pathlib.Path(bucketkey).stem)
+      
+    # download JSON from S3 to LOCAL file system:
+    print("**DOWNLOADING '", bucketkey, "'**")
+
+    local_json = "/tmp/data.json"
+    
+    with timing.stage("template_download"):
+      bucket.download_file(bucketkey, local_json)
+
+
+    # open LOCAL json file:
+    print("**PROCESSING local JSON**")
+    with open(local_json, 'r') as f:
+            data = json.load(f)
+
+    thresholddict = data['THRESHOLDS']
+    phenotypedict = data['PHENOTYPES']
+    distancedict = data.get('DISTANCES', {})
+    nearestdict = data.get('NEAREST', {})
+    centroids = data.get('CENTROIDS', [col.strip() for col in
+                         configur.get('spatial', 'centroid_columns', fallback='X, Y').split(',')])
+    permutations = int(data.get('PERMUTATIONS', configur.getint('compute', 'permutations', fallback=10000)))
+    seed = data.get('SEED', None)
+
+    # update status column in DB for this job,
+    print("**Opening DB connection**")
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    status = 'processing - starting'
+    sql = "update jobs set status = %s where datafilekey = %s"
+    modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
+
+    # only samples with a cohort take part in the comparison
+    registry.job_files(dbConn, list(thresholddict.keys()))
+    cohorts = registry.cohort_files(dbConn, thresholddict)
+    for cohort in ["LTS", "STS"]:
+      if len(cohorts.get(cohort, [])) < 2:
+        raise Exception("need at least 2 " + cohort + " samples in the job (check the cohort column of the samples table)")
+
+    filelist = cohorts["LTS"] + cohorts["STS"]
+    in_lts = np.array([file_key in cohorts["LTS"] for file_key in filelist])
+
+    if len(nearestdict) > 0:
+      spatial.check_nearest(nearestdict, phenotypedict)
+
+    cache = samplecache.get_cache(configur)
+    num_workers = workers.worker_count(configur)
+    backend = analysis.job_backend(configur, data)
+
+    # NEAREST forks worker processes for every sample, which is
+    # unsafe while the prefetch thread is downloading (as compute7)
+    prefetch_depth = prefetch.get_depth(configur)
+    if len(nearestdict) > 0:
+      prefetch_depth = 0
+
+    proportions = proportion_matrix(s3_client, bucketname, filelist, thresholddict, phenotypedict, distancedict,
+                                    nearestdict, centroids, num_workers, bucketkey, dbConn, cache, backend,
+                                    prefetch_depth)
+    print(cache.report())
+
+    print("**Comparing cohorts:", len(proportions.index), "rows,", permutations, "permutations,", num_workers, "workers**")
+    status = 'processing - comparing cohorts'
+    datatier.perform_action(dbConn, sql, [status, bucketkey])
+
+    with timing.stage("statistics"):
+      statistics = compare_cohorts(proportions, in_lts, permutations, num_workers, seed)
+
+    result = {
+      "STATISTICS": json.loads(statistics.to_json(orient='index')),
+      "PROPORTIONS": json.loads(proportions.to_json(orient='index')),
+      "COHORTS": {loader.sample_name(file_key): ("LTS" if lts else "STS") for file_key, lts in zip(filelist, in_lts)}
+    }
+    with timing.stage("result_encode"):
+      result_json = json.dumps(result)
+    with timing.stage("result_upload"):
+      s3_client.put_object(Bucket=bucketname, Key=bucketkey_results_file, Body=result_json)
+
+    # stored before the job completes, so it is there once the
+    # client sees the results
+    s3_client.put_object(Bucket=bucketname, Key=timing.timing_key(bucketkey_results_file),
+                         Body=json.dumps(timing.summary()))
+
+    status = 'completed'
+    datatier.perform_action(dbConn, sql, [status, bucketkey])
+    sql = "update jobs set resultsfilekey = %s where datafilekey = %s"
+    datatier.perform_action(dbConn, sql, [bucketkey_results_file, bucketkey])
+    print("**DONE**")
+    
+    return {
+      'statusCode': 200,
+      'body': json.dumps("success")
+    }
+    
+  # on an error, try to upload error message to S3:
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+    
+    # update the database if connection is established
+    if dbConn is not None:
+        status = 'error'
+        sql = "update jobs set status = %s, resultsfilekey = %s where datafilekey = %s"
+        datatier.perform_action(dbConn, sql, [status, bucketkey_results_file, bucketkey])
+    
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
\ No newline at end of file
@@ -0,0 +1,126 @@
+#
+# spatial.py
+#
+# Nearest-phenotype distances from cell centroids: for every cell of
+# a source phenotype, the distance to the closest other cell of a
+# target phenotype. A KD-tree is built once per sample and target
+# phenotype and all source cells are queried in one call; the target
+# phenotypes of a sample are spread over worker processes, so only
+# one sample's masks are held at a time.
+#
+# The NEAREST entry of a template names each new distance column:
+#
+#   "NEAREST": {"CD8 to GFAP+cCasp3+ Distance": {"FROM": "CD8", "TO": "GFAP cCasp3"}}
+#
+# where FROM and TO are phenotypes of PHENOTYPES. Cells outside the
+# source phenotype get NaN, so they fall in no distance bin.
+#
+
+import numpy as np
+
+from ltsvssts import workers
+
+try:
+  from scipy.spatial import cKDTree
+except ImportError:
+  cKDTree = None
+
+
+def check_nearest(nearestdict, phenotypedict):
+  if cKDTree is None:
+    raise Exception("NEAREST distances need scipy, add a SciPy layer to the function")
+
+  for column, pair in nearestdict.items():
+    for role in ["FROM", "TO"]:
+      if role not in pair:
+        raise Exception("NEAREST column '" + column + "' has no " + role + " phenotype")
+      if pair[role] not in phenotypedict:
+        raise Exception("NEAREST column '" + column + "' uses unknown phenotype '" + pair[role] + "'")
+
+def nearest_phenotypes(nearestdict):
+  """
+  Returns the phenotypes the NEAREST columns need, without duplicates
+  """
+  names = []
+  for pair in nearestdict.values():
+    for name in [pair["FROM"], pair["TO"]]:
+      if name not in names:
+        names.append(name)
+  return names
+
+def nearest_distances(tree, targets, coords, source):
+  """
+  Returns the distance from every source cell to the nearest target
+  cell other than itself, NaN for the other cells. targets are the
+  cell indices the tree was built from.
+  """
+  distances = np.full(len(coords), np.nan, dtype=np.float32)
+  sources = np.flatnonzero(source)
+  if len(sources) == 0 or len(targets) == 0:
+    return distances
+
+  # a source cell that is also a target finds itself first, so ask
+  # for two neighbors and skip the self match
+  k = min(2, len(targets))
+  dist, idx = tree.query(coords[sources], k=k)
+  if k == 1:
+    dist = dist[:, None]
+    idx = idx[:, None]
+
+  nearest = dist[:, 0].copy()
+  self_match = targets[idx[:, 0]] == sources
+  if k == 2:
+    nearest[self_match] = dist[self_match, 1]
+  else:
+    nearest[self_match] = np.nan
+
+  distances[sources] = nearest
+  return distances
+
+
+###################################################################
+#
+# sample_nearest:
+#
+# Computes every NEAREST column of one sample from its (cells x 2)
+# centroids and a dict of phenotype -> boolean mask. Returns a dict
+# of column -> float32 distances.
+#
+def sample_nearest(coords, masks, nearestdict):
+  trees = {}
+  columns = {}
+  for column, pair in nearestdict.items():
+    target = pair["TO"]
+    if target not in trees:
+      targets = np.flatnonzero(masks[target])
+      tree = cKDTree(coords[targets]) if len(targets) > 0 else None
+      trees[target] = (tree, targets)
+
+    tree, targets = trees[target]
+    columns[column] = nearest_distances(tree, targets, coords, masks[pair["FROM"]])
+
+  return columns
+
+def nearest_columns(coords, masks, nearestdict, num_workers):
+  """
+  Runs sample_nearest for one sample with the NEAREST columns
+  grouped by target phenotype (one KD-tree each) and the groups
+  split over num_workers processes; returns the columns in
+  nearestdict order
+  """
+  groups = {}
+  for column, pair in nearestdict.items():
+    groups.setdefault(pair["TO"], {})[column] = pair
+  groups = list(groups.values())
+
+  num_workers = max(1, min(num_workers, len(groups)))
+  tasks = []
+  for i in range(num_workers):
+    chunk = {column: pair for group in groups[i::num_workers] for column, pair in group.items()}
+    task_masks = {name: masks[name] for name in nearest_phenotypes(chunk)}
+    tasks.append((coords, task_masks, chunk))
+
+  columns = {}
+  for result in workers.run_parallel(sample_nearest, tasks):
+    columns.update(result)
+  return {column: columns[column] for column in nearestdict}
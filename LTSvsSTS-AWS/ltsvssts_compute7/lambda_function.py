@@ -0,0 +1,251 @@
+#
+# Python program for neighborhood enrichment: for every sample, counts
+# the pairs of cells within a radius of each other for every pair of
+# phenotypes and scores them against random placement of the
+# phenotypes over the same cells (z-scores). The z-scores of LTS and
+# STS samples are then compared with a rank-sum test per phenotype
+# pair, with Benjamini-Hochberg correction.
+#
+
+import json
+import boto3
+import os
+import uuid
+import base64
+import pathlib
+from ltsvssts import datatier
+from ltsvssts import analysis
+from ltsvssts import loader
+from ltsvssts import phenotypes
+from ltsvssts import samplecache
+from ltsvssts import registry
+import neighborhood
+from ltsvssts import stats
+from ltsvssts import workers
+from ltsvssts import timing
+import urllib.parse
+import string
+import pandas as pd
+import numpy as np
+
+from configparser import ConfigParser
+
+def pair_names(phenotypedict):
+    names = list(phenotypedict.keys())
+    return [names[a] + " | " + names[b] for a in range(len(names)) for b in range(a, len(names))]
+
+def enrichment_matrix(s3_client, bucket, filelist, thresholddict, phenotypedict, centroids, radius,
+                      permutations, num_workers, seed, bucketkey, dbConn, cache, backend):
+    names = pair_names(phenotypedict)
+    column_names = [loader.sample_name(file_key) for file_key in filelist]
+    zscores = np.zeros((len(names), len(filelist)), dtype=np.float64)
+    counts = np.zeros((len(names), len(filelist)), dtype=np.int64)
+    upper = np.triu_indices(len(phenotypedict))
+
+    program = phenotypes.compile_phenotypes(phenotypedict)
+    columns = loader.job_columns(thresholddict, program.columns() + centroids)
+
+    # independent random streams per sample
+    seeds = np.random.SeedSequence(seed).spawn(len(filelist))
+
+    total = len(filelist)
+    filenum = 1
+    for j, file_key in enumerate(filelist):
+        print(f"Processing file: {file_key}")
+        sample = loader.sample_name(file_key)
+
+        df = cache.load(s3_client, bucket, file_key, columns)
+
+        thresholds = thresholddict[file_key]
+
+        with timing.stage("threshold", sample):
+            thresholded = backend.threshold(df, thresholds)
+
+        with timing.stage("phenotypes", sample):
+            positive = backend.phenotype_masks(thresholded, program)
+        coords = df[centroids].to_numpy(dtype=np.float64)
+        del df, thresholded
+
+        with timing.stage("neighbor_graph", sample):
+            edges = neighborhood.neighbor_graph(coords, radius)
+        print(f"{len(coords)} cells, {len(edges)} neighbor pairs within {radius}")
+
+        with timing.stage("enrichment", sample):
+            observed, z = neighborhood.enrichment(positive, edges, permutations, num_workers, seeds[j])
+        counts[:, j] = observed[upper]
+        zscores[:, j] = z[upper]
+
+        status = 'processing - ' + pathlib.Path(file_key).name + ' ' + str(filenum) + '/' + str(total) + ' processed'
+        filenum += 1
+        with timing.stage("db_update", sample):
+            sql = "update jobs set status = %s where datafilekey = %s"
+            modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
+
+    return (pd.DataFrame(zscores, index=names, columns=column_names),
+            pd.DataFrame(counts, index=names, columns=column_names))
+
+def compare_cohorts(zscores, in_lts):
+    """
+    Returns, per phenotype pair, the mean z-score of each cohort and
+    a rank-sum test of LTS against STS z-scores
+    """
+    values = zscores.to_numpy()
+    u, pvalues = stats.rank_sum_test(values, in_lts)
+
+    return pd.DataFrame({
+      "LTS mean z": values[:, in_lts].mean(axis=1),
+      "STS mean z": values[:, ~in_lts].mean(axis=1),
+      "Rank-sum U": u,
+      "Rank-sum p": pvalues,
+      "Rank-sum q": stats.fdr_bh(pvalues)
+    }, index=zscores.index)
+
+  
+def lambda_handler(event, context):
+  dbConn = None
+  try:
+    print("**STARTING**")
+    print("**lambda: ltsvssts_compute7**")
+    
+    bucketkey_results_file = ""
+    
+    # setup AWS based on config file:
+    config_file = 'ltsvsstsapp-config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+    
+    configur = ConfigParser()
+    configur.read(config_file)
+    
+    # configure for S3 access:
+    s3_profile = 's3readwrite'
+    boto3.setup_default_session(profile_name=s3_profile)
+    
+    bucketname = configur.get('s3', 'bucket_name')
+    s3 = boto3.resource('s3')
+    s3_client = boto3.client('s3')
+    bucket = s3.Bucket(bucketname)
+    
+
+    # configure for RDS access
+    rds_endpoint = configur.get('rds', 'endpoint')
+    rds_portnum = int(configur.get('rds', 'port_number'))
+    rds_username = configur.get('rds', 'user_name')
+    rds_pwd = configur.get('rds', 'user_pwd')
+    rds_dbname = configur.get('rds', 'db_name')
+    
+    # this function is event-driven by a json being
+    # dropped into S3. The bucket key is sent to 
+    # us and obtain as follows:
+    bucketkey = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+    
+    print("bucketkey:", bucketkey)
+      
+    if not bucketkey.startswith("LTSvsSTS7-Template/"):
+            raise Exception("File is not in 'LTSvsSTS7-Template/' folder. Ignoring event.")
+        
+    extension = pathlib.Path(bucketkey).suffix
+    
+    if extension != ".json" : 
+      raise Exception("expecting S3 document to have .json extension")
+    
+    bucketkey_results_file = "LTSvsSTS-Result/" + pathlib.Path(bucketkey).stem + ".json"
+    
+    print("bucketkey results file:", bucketkey_results_file)
+
+    timing.start_job(pathlib.Path(bucketkey).stem)
+      
+    # download JSON from S3 to LOCAL file system:
+    print("**DOWNLOADING '", bucketkey, "'**")
+
+    local_json = "/tmp/data.json"
+    
+    with timing.stage("template_download"):
+      bucket.download_file(bucketkey, local_json)
+
+
+    # open LOCAL json file:
+    print("**PROCESSING local JSON**")
+    with open(local_json, 'r') as f:
+            data = json.load(f)
+
+    thresholddict = data['THRESHOLDS']
+    phenotypedict = data['PHENOTYPES']
+    centroids = data.get('CENTROIDS', [col.strip() for col in
+                         configur.get('spatial', 'centroid_columns', fallback='X, Y').split(',')])
+    radius = float(data.get('RADIUS', configur.getfloat('spatial', 'radius', fallback=20.0)))
+    permutations = int(data.get('PERMUTATIONS', configur.getint('compute', 'permutations', fallback=1000)))
+    seed = data.get('SEED', None)
+
+    if permutations < 1:
+      raise Exception("PERMUTATIONS must be at least 1")
+
+    # update status column in DB for this job,
+    print("**Opening DB connection**")
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    status = 'processing - starting'
+    sql = "update jobs set status = %s where datafilekey = %s"
+    modified = datatier.perform_action(dbConn, sql, [status, bucketkey])
+
+    # only samples with a cohort take part in the comparison
+    registry.job_files(dbConn, list(thresholddict.keys()))
+    cohorts = registry.cohort_files(dbConn, thresholddict)
+    for cohort in ["LTS", "STS"]:
+      if len(cohorts.get(cohort, [])) < 2:
+        raise Exception("need at least 2 " + cohort + " samples in the job (check the cohort column of the samples table)")
+
+    filelist = cohorts["LTS"] + cohorts["STS"]
+    in_lts = np.array([file_key in cohorts["LTS"] for file_key in filelist])
+
+    cache = samplecache.get_cache(configur)
+    num_workers = workers.worker_count(configur)
+    backend = analysis.job_backend(configur, data)
+
+    print("**Neighborhood enrichment: radius", radius, ",", permutations, "permutations,", num_workers, "workers**")
+    zscores, counts = enrichment_matrix(s3_client, bucketname, filelist, thresholddict, phenotypedict, centroids, radius,
+                                        permutations, num_workers, seed, bucketkey, dbConn, cache, backend)
+    print(cache.report())
+
+    statistics = compare_cohorts(zscores, in_lts)
+
+    result = {
+      "STATISTICS": json.loads(statistics.to_json(orient='index')),
+      "ZSCORES": json.loads(zscores.to_json(orient='index')),
+      "COUNTS": json.loads(counts.to_json(orient='index')),
+      "COHORTS": {loader.sample_name(file_key): ("LTS" if lts else "STS") for file_key, lts in zip(filelist, in_lts)}
+    }
+    with timing.stage("result_encode"):
+      result_json = json.dumps(result)
+    with timing.stage("result_upload"):
+      s3_client.put_object(Bucket=bucketname, Key=bucketkey_results_file, Body=result_json)
+
+    # stored before the job completes, so it is there once the
+    # client sees the results
+    s3_client.put_object(Bucket=bucketname, Key=timing.timing_key(bucketkey_results_file),
+                         Body=json.dumps(timing.summary()))
+
+    status = 'completed'
+    datatier.perform_action(dbConn, sql, [status, bucketkey])
+    sql = "update jobs set resultsfilekey = %s where datafilekey = %s"
+    datatier.perform_action(dbConn, sql, [bucketkey_results_file, bucketkey])
+    print("**DONE**")
+    
+    return {
+      'statusCode': 200,
+      'body': json.dumps("success")
+    }
+    
+  # on an error, try to upload error message to S3:
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+    
+    # update the database if connection is established
+    if dbConn is not None:
+        status = 'error'
+        sql = "update jobs set status = %s, resultsfilekey = %s where datafilekey = %s"
+        datatier.perform_action(dbConn, sql, [status, bucketkey_results_file, bucketkey])
+    
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
\ No newline at end of file
@@ -0,0 +1,135 @@
+#
+# neighborhood.py
+#
+# Neighborhood enrichment: how often cells of two phenotypes lie
+# within a radius of each other, compared to random placement of the
+# phenotypes over the same cells.
+#
+# The neighbor graph (every pair of cells closer than the radius) is
+# built once per sample with a KD-tree ball query. Cells are then
+# reduced to one integer label per distinct combination of
+# phenotypes, so counting the pairs of every phenotype pair is one
+# bincount over the edges and a small matrix product. With many
+# phenotypes the labels can approach one per cell, so past
+# MAX_LABEL_PAIRS (labels x labels) the pairs are counted per
+# phenotype over a sparse adjacency matrix instead. Each permutation
+# shuffles the labels over the cells and recounts on the same graph;
+# permutations are spread over worker processes.
+#
+
+import numpy as np
+
+from ltsvssts import workers
+
+try:
+  from scipy import sparse
+  from scipy.spatial import cKDTree
+except ImportError:
+  cKDTree = None
+
+# largest (labels x labels) bincount pair_counts builds, 32 MB of
+# int64; past it edge_counts is used
+MAX_LABEL_PAIRS = 1 << 22
+
+
+def neighbor_graph(coords, radius):
+  """
+  Returns the (edges x 2) cell index pairs closer than radius, each
+  pair once
+  """
+  if cKDTree is None:
+    raise Exception("neighborhood enrichment needs scipy, add a SciPy layer to the function")
+
+  tree = cKDTree(coords)
+  return tree.query_pairs(radius, output_type='ndarray')
+
+def cell_labels(positive):
+  """
+  Given (phenotypes x cells) bool masks, returns a label per cell and
+  the (labels x phenotypes) 0/1 pattern of each label
+  """
+  patterns, labels = np.unique(positive.T, axis=0, return_inverse=True)
+  return labels.ravel(), patterns.astype(np.float64)
+
+def pair_counts(labels, edges, patterns):
+  """
+  Returns the (phenotypes x phenotypes) number of neighboring cell
+  pairs (u, v) with u of the row phenotype and v of the column
+  phenotype, counting each edge in both directions
+  """
+  num_labels = len(patterns)
+  flat = labels[edges[:, 0]] * num_labels + labels[edges[:, 1]]
+  counts = np.bincount(flat, minlength=num_labels * num_labels).reshape(num_labels, num_labels)
+  counts = counts + counts.T
+  return patterns.T @ counts @ patterns
+
+def adjacency(edges, num_cells):
+  """
+  Returns the (cells x cells) sparse neighbor matrix, each edge in
+  both directions
+  """
+  rows = np.concatenate([edges[:, 0], edges[:, 1]])
+  cols = np.concatenate([edges[:, 1], edges[:, 0]])
+  ones = np.ones(len(rows), dtype=np.float64)
+  return sparse.csr_matrix((ones, (rows, cols)), shape=(num_cells, num_cells))
+
+def edge_counts(labels, graph, patterns):
+  """
+  pair_counts over the adjacency matrix: cells x phenotypes times
+  the graph, with no (labels x labels) matrix
+  """
+  positive = patterns[labels]
+  return positive.T @ (graph @ positive)
+
+def _null_moments(count, labels, graph, patterns, permutations, seed):
+  """
+  Sums of the pair counts and of their squares over random label
+  permutations
+  """
+  rng = np.random.default_rng(seed)
+  total = np.zeros((patterns.shape[1], patterns.shape[1]))
+  total_sq = np.zeros_like(total)
+
+  for _ in range(permutations):
+    counts = count(rng.permutation(labels), graph, patterns)
+    total += counts
+    total_sq += counts * counts
+
+  return total, total_sq
+
+
+###################################################################
+#
+# enrichment:
+#
+# Returns the observed pair counts of one sample and their z-scores
+# against the label-permutation null, splitting the permutations
+# over num_workers processes. A pair whose count cannot change under
+# permutation gets z = 0.
+#
+def enrichment(positive, edges, permutations, num_workers, seed=None):
+  labels, patterns = cell_labels(positive)
+
+  if len(patterns) ** 2 <= MAX_LABEL_PAIRS:
+    count, graph = pair_counts, edges
+  else:
+    print(f"{len(patterns)} phenotype combinations, counting pairs per phenotype")
+    count, graph = edge_counts, adjacency(edges, len(labels))
+  observed = count(labels, graph, patterns)
+
+  num_workers = max(1, min(num_workers, permutations))
+  shares = [permutations // num_workers + (1 if i < permutations % num_workers else 0)
+            for i in range(num_workers)]
+  if not isinstance(seed, np.random.SeedSequence):
+    seed = np.random.SeedSequence(seed)
+  seeds = seed.spawn(num_workers)
+
+  tasks = [(count, labels, graph, patterns, share, child) for share, child in zip(shares, seeds)]
+  moments = workers.run_parallel(_null_moments, tasks)
+
+  mean = sum(m[0] for m in moments) / permutations
+  variance = np.maximum(sum(m[1] for m in moments) / permutations - mean * mean, 0)
+  std = np.sqrt(variance)
+
+  z = np.divide(observed - mean, std, out=np.zeros_like(mean), where=std > 0)
+  return observed, z
@@ -5,14 +5,18 @@
 # completed, or error. In the case of completed, the 
 # analysis results are returned as a json file or bytestring depending
 # on the type of job. In the case of error, the error message from the 
-# results file is returned.
+# results file is returned. Binary (npz) results are returned base64
+# encoded to clients that ask with ?format=npz, and converted to
+# JSON for the others. While a compute id 1-3 job is processing,
+# ?partial=true returns the columns of the samples completed so far
+# with the status.
 #
 
 import json
 import boto3
 import os
 import base64
-import datatier
+from ltsvssts import datatier
 
 from configparser import ConfigParser
 
@@ -100,7 +104,27 @@ def lambda_handler(event, context):
         'body': json.dumps(status)
       }
 
+    parameters = event.get("queryStringParameters") or {}
+
     if status.startswith("processing"):
+      # the compute functions publish the samples completed so far
+      # next to where the results will be (see results.partial_key)
+      if parameters.get("partial", "false").lower() == "true":
+        datafilekey = row[4]
+        partial_key = "LTSvsSTS-Result/" + os.path.splitext(os.path.basename(datafilekey))[0] + "-partial.json"
+        try:
+          partial = json.loads(bucket.Object(partial_key).get()['Body'].read())
+        except bucket.meta.client.exceptions.NoSuchKey:
+          partial = None
+
+        if partial is not None:
+          print("**Returning partial results,", len(partial["completed"]), "of", partial["total"], "samples**")
+          partial["status"] = status
+          return {
+            'statusCode': 481,
+            'body': json.dumps(partial)
+          }
+
       print("**No results yet, returning...**")
       return {
         'statusCode': 481,
@@ -116,6 +140,7 @@ def lambda_handler(event, context):
         }
       
       print("**Job status 'error', downloading error results from S3**")
+      local_filename = "/tmp/results.txt"
       bucket.download_file(results_file_key, local_filename)
       infile = open(local_filename, "r")
       lines = infile.readlines()
@@ -148,8 +173,45 @@ def lambda_handler(event, context):
       
     # job should be completed
     local_filename = "/tmp/results.json"
-    
+
+    # ?timing=true or ?memory=true return the job's timing summary
+    # or memory report instead, which the compute functions store
+    # next to the results
+    for report in ["timing", "memory"]:
+      if parameters.get(report, "false").lower() != "true":
+        continue
+      report_key = os.path.splitext(results_file_key)[0] + "-" + report + ".json"
+      print("**Downloading", report, "report from S3:", report_key, "**")
+      try:
+        body = bucket.Object(report_key).get()['Body'].read()
+      except bucket.meta.client.exceptions.NoSuchKey:
+        return {
+          'statusCode': 400,
+          'body': json.dumps("no " + report + " report for this job...")
+        }
+      return {
+        'statusCode': 200,
+        'body': body.decode('utf-8')
+      }
+
     print("**Downloading results from S3**")
+
+    if results_file_key.endswith(".npz"):
+      body = bucket.Object(results_file_key).get()['Body'].read()
+      if parameters.get("format", "json").lower() == "npz":
+        return {
+          'statusCode': 200,
+          'body': json.dumps({"format": "npz", "data": base64.b64encode(body).decode('utf-8')})
+        }
+
+      # a client that did not ask for npz gets the JSON it expects;
+      # converting needs the Numpy and Pandas layers
+      print("**Converting npz results to JSON**")
+      from ltsvssts import results
+      return {
+        'statusCode': 200,
+        'body': results.decode_matrix(body).to_json(orient='index')
+      }
     
     bucket.download_file(results_file_key, local_filename)
     
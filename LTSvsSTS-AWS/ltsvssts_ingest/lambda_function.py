@@ -0,0 +1,330 @@
+#
+# Prepares a sample CSV when it lands in LTSvsSTS-Data/: validates
+# its column schema, and writes the derived artifacts every later
+# job starts from:
+#
+#   LTSvsSTS-Manifest/<sample>.json   cell count, columns and
+#                                     per-column intensity stats
+#   LTSvsSTS-Columnar/<sample>.npz    float32 array per numeric
+#                                     column
+#   LTSvsSTS-Histogram/<sample>.npz   marker histograms over each
+#                                     marker's own range
+#
+# and records the sample in the samples table of the database.
+# Invoked without S3 records, the function (re)ingests every
+# sample in the bucket. Invoked with {"recompress": "gzip"} (or
+# "zstd", or "none" to decompress), it instead rewrites every .csv
+# sample in place with that Content-Encoding; the S3 trigger then
+# ingests each rewritten sample.
+#
+
+import json
+import boto3
+import os
+from ltsvssts import datatier
+import urllib.parse
+from ltsvssts import compression
+from ltsvssts import loader
+import pandas as pd
+import numpy as np
+from io import BytesIO
+
+from configparser import ConfigParser
+
+# every histogram has the same number of bins, spread over the
+# marker's min to max in the sample, so they can be stacked
+HIST_BINS = 1600
+
+def sample_name(file_key):
+    return loader.sample_name(file_key)
+
+def histogram_key(file_key):
+    return "LTSvsSTS-Histogram/" + sample_name(file_key) + ".npz"
+
+def columnar_key(file_key):
+    return "LTSvsSTS-Columnar/" + sample_name(file_key) + ".npz"
+
+def manifest_key(file_key):
+    return "LTSvsSTS-Manifest/" + sample_name(file_key) + ".json"
+
+def marker_histograms(df, markers):
+    """
+    Returns the (markers x bins) counts and the (markers x bins + 1)
+    edges of each marker's histogram, its bins covering the marker's
+    intensities from min to max
+    """
+    counts = np.zeros((len(markers), HIST_BINS), dtype=np.uint32)
+    edges = np.zeros((len(markers), HIST_BINS + 1))
+
+    for i, marker in enumerate(markers):
+        values = df[marker].to_numpy(dtype=float)
+        values = values[~np.isnan(values)]
+        low, high = (values.min(), values.max()) if len(values) > 0 else (0.0, 1.0)
+        if high <= low:
+            high = low + 1.0
+        edges[i] = np.linspace(low, high, HIST_BINS + 1)
+        counts[i], _ = np.histogram(values, bins=edges[i])
+
+    return counts, edges
+
+def validate_header(header, required_markers):
+    errors = []
+
+    duplicates = sorted(set(col for col in header if header.count(col) > 1))
+    if len(duplicates) > 0:
+        errors.append("duplicate columns: " + ", ".join(duplicates))
+
+    missing = [marker for marker in required_markers if marker not in header]
+    if len(missing) > 0:
+        errors.append("missing marker columns: " + ", ".join(missing))
+
+    if not any(col.endswith("_R") for col in header):
+        errors.append("no *_R marker columns")
+
+    return errors
+
+def numeric_columns(header, required_markers, centroids):
+    """
+    Returns the columns parsed as numbers, in file order: markers
+    (*_R), distance metrics, centroids and the required markers.
+    Other columns (object or image names, class labels) are listed
+    in the manifest but not parsed, so text in them is harmless
+    """
+    wanted = set(required_markers) | set(centroids)
+    return [col for col in header
+            if col.endswith("_R") or col.endswith(loader.DISTANCE_SUFFIX) or col in wanted]
+
+def column_stats(df):
+    stats = {}
+    for col in df.columns:
+        values = df[col].to_numpy(dtype=float)
+        valid = values[~np.isnan(values)]
+        stats[col] = {
+          "min": float(valid.min()) if len(valid) > 0 else None,
+          "max": float(valid.max()) if len(valid) > 0 else None,
+          "mean": float(valid.mean()) if len(valid) > 0 else None,
+          "std": float(valid.std()) if len(valid) > 0 else None,
+          "nan": int(len(values) - len(valid))
+        }
+    return stats
+
+def put_npz(s3_client, bucket, key, arrays):
+    buffer = BytesIO()
+    np.savez(buffer, **arrays)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+
+def ingest_sample(s3_client, bucket, file_key, required_markers, centroids):
+    """
+    Validates one sample and writes its derived artifacts; returns
+    the manifest, whose status is 'ready' or 'invalid'
+    """
+    print(f"Processing file: {file_key}")
+
+    obj = s3_client.get_object(Bucket=bucket, Key=file_key)
+    etag = obj['ETag'].strip('"')
+    encoding = compression.sample_encoding(file_key, obj.get('ContentEncoding'))
+    csv_body = compression.sample_source(obj['Body'].read(), file_key, encoding)
+
+    manifest = {
+      "datafilekey": file_key,
+      "etag": etag,
+      "encoding": encoding,
+      "status": "invalid",
+      "errors": [],
+      "cells": 0,
+      "columns": [],
+      "markers": [],
+      "distances": []
+    }
+
+    header = loader.sample_columns(csv_body)
+    manifest["columns"] = header
+    manifest["errors"] = validate_header(header, required_markers)
+
+    if len(manifest["errors"]) == 0:
+        try:
+            df = loader.load_sample(csv_body, numeric_columns(header, required_markers, centroids), file_key)
+        except ValueError as err:
+            # a non-numeric value in a column
+            df = None
+            manifest["errors"].append("unparseable values: " + str(err))
+
+    del csv_body
+
+    if len(manifest["errors"]) == 0 and len(df.index) == 0:
+        manifest["errors"].append("sample has no cells")
+
+    if len(manifest["errors"]) > 0:
+        print("**INVALID**", file_key, manifest["errors"])
+        # drop what an earlier, valid version of the sample left, so
+        # /suggest and the compute functions stop using it
+        s3_client.delete_object(Bucket=bucket, Key=histogram_key(file_key))
+        s3_client.delete_object(Bucket=bucket, Key=columnar_key(file_key))
+        s3_client.put_object(Bucket=bucket, Key=manifest_key(file_key), Body=json.dumps(manifest))
+        return manifest
+
+    markers = [col for col in header if col.endswith("_R")]
+    distances = [col for col in header if col.endswith(loader.DISTANCE_SUFFIX)]
+
+    counts, edges = marker_histograms(df, markers)
+    put_npz(s3_client, bucket, histogram_key(file_key), {
+      "counts": counts,
+      "edges": edges,
+      "markers": np.array(markers),
+      "datafilekey": np.array(file_key),
+      "cells": np.array(len(df.index))
+    })
+
+    arrays = {col: df[col].to_numpy() for col in df.columns}
+    arrays["__etag__"] = np.array(etag)
+    put_npz(s3_client, bucket, columnar_key(file_key), arrays)
+
+    manifest.update({
+      "status": "ready",
+      "cells": len(df.index),
+      "markers": markers,
+      "distances": distances,
+      "stats": column_stats(df),
+      "columnarkey": columnar_key(file_key),
+      "histogramkey": histogram_key(file_key)
+    })
+    s3_client.put_object(Bucket=bucket, Key=manifest_key(file_key), Body=json.dumps(manifest))
+
+    return manifest
+
+def record_sample(dbConn, manifest):
+    if manifest["status"] == "ready":
+        status = "ready"
+    else:
+        status = ("invalid: " + "; ".join(manifest["errors"]))[:256]
+
+    sql = """
+      INSERT INTO samples(datafilekey, etag, status, cells, numcolumns, manifestkey)
+                  VALUES(%s, %s, %s, %s, %s, %s)
+      ON DUPLICATE KEY UPDATE etag = VALUES(etag), status = VALUES(status),
+                              cells = VALUES(cells), numcolumns = VALUES(numcolumns),
+                              manifestkey = VALUES(manifestkey);
+    """
+    datatier.perform_action(dbConn, sql, [manifest["datafilekey"], manifest["etag"], status,
+                                          manifest["cells"], len(manifest["columns"]),
+                                          manifest_key(manifest["datafilekey"])])
+
+def recompress_sample(s3_client, bucket, file_key, encoding, level):
+    """
+    Rewrites a sample under the same key with the given
+    Content-Encoding (None stores it uncompressed); returns the
+    object's size before and after
+    """
+    obj = s3_client.get_object(Bucket=bucket, Key=file_key)
+    current = compression.sample_encoding(file_key, obj.get('ContentEncoding'))
+    body = obj['Body'].read()
+    if current == encoding:
+        print(f"{file_key} is already stored as {encoding or 'plain CSV'}")
+        return len(body), len(body)
+
+    data = compression.decompress(body, current)
+    size = len(body)
+    del body
+    if encoding is None:
+        s3_client.put_object(Bucket=bucket, Key=file_key, Body=data, ContentType='text/csv')
+        print(f"{file_key}: {size} -> {len(data)} bytes, decompressed")
+        return size, len(data)
+
+    compressed = compression.compress(data, encoding, level)
+    s3_client.put_object(Bucket=bucket, Key=file_key, Body=compressed, ContentType='text/csv',
+                         ContentEncoding=encoding)
+    print(f"{file_key}: {size} -> {len(compressed)} bytes, {len(data) / max(len(compressed), 1):.1f}x {encoding}")
+    return size, len(compressed)
+
+
+def lambda_handler(event, context):
+  try:
+    print("**STARTING**")
+    print("**lambda: ltsvssts_ingest**")
+
+    # setup AWS based on config file:
+    config_file = 'ltsvsstsapp-config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+
+    configur = ConfigParser()
+    configur.read(config_file)
+
+    # configure for S3 access:
+    s3_profile = 's3readwrite'
+    boto3.setup_default_session(profile_name=s3_profile)
+
+    bucketname = configur.get('s3', 'bucket_name')
+    s3 = boto3.resource('s3')
+    s3_client = boto3.client('s3')
+    bucket = s3.Bucket(bucketname)
+
+    # configure for RDS access
+    rds_endpoint = configur.get('rds', 'endpoint')
+    rds_portnum = int(configur.get('rds', 'port_number'))
+    rds_username = configur.get('rds', 'user_name')
+    rds_pwd = configur.get('rds', 'user_pwd')
+    rds_dbname = configur.get('rds', 'db_name')
+
+    required_markers = [marker.strip() for marker in
+                        configur.get('ingest', 'required_markers', fallback='').split(',')
+                        if marker.strip() != '']
+    centroids = [col.strip() for col in
+                 configur.get('spatial', 'centroid_columns', fallback='X, Y').split(',')]
+
+    if "recompress" in event:
+      encoding = None if str(event["recompress"]).lower() == "none" else str(event["recompress"]).lower()
+      if encoding is not None and encoding not in compression.ENCODINGS:
+        raise Exception("recompress must be one of: none, " + ", ".join(compression.ENCODINGS))
+      level = event.get("level")
+
+      # keys ending in .csv.gz/.csv.zst name their encoding, so only
+      # .csv keys can be rewritten in place
+      filelist = [obj.key for obj in bucket.objects.filter(Prefix="LTSvsSTS-Data/") if obj.key.endswith(".csv")]
+      results = {}
+      for file_key in filelist:
+        before, after = recompress_sample(s3_client, bucketname, file_key, encoding, level)
+        results[file_key] = {"before": before, "after": after}
+
+      print("**DONE**")
+      return {
+        'statusCode': 200,
+        'body': json.dumps(results)
+      }
+
+    # event-driven by a sample CSV being dropped into S3; with no
+    # records every sample in LTSvsSTS-Data/ is (re)processed:
+    if "Records" in event:
+      filelist = [urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+                  for record in event['Records']]
+    else:
+      filelist = [obj.key for obj in bucket.objects.filter(Prefix="LTSvsSTS-Data/")]
+
+    filelist = [key for key in filelist if compression.is_sample_key(key)]
+
+    if len(filelist) == 0:
+      raise Exception("no CSV files in 'LTSvsSTS-Data/' to process")
+
+    print("**Opening DB connection**")
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    results = {}
+    for file_key in filelist:
+      manifest = ingest_sample(s3_client, bucketname, file_key, required_markers, centroids)
+      record_sample(dbConn, manifest)
+      results[file_key] = manifest["status"] if manifest["status"] == "ready" else manifest["errors"]
+
+    print("**DONE**")
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps(results)
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
@@ -6,7 +6,7 @@
 import json
 import boto3
 import os
-import datatier
+from ltsvssts import datatier
 
 from configparser import ConfigParser
 
@@ -0,0 +1,28 @@
+#
+# ltsvssts
+#
+# Code shared by the LTSvsSTS lambda functions and the notebook,
+# deployed as a Lambda layer (zip the ltsvssts_layer folder so the
+# archive holds python/ltsvssts/):
+#
+#   analysis      per-sample kernels behind pandas/numpy/polars backends
+#   compression   gzip/zstd compressed samples, streamed into the parser
+#   datatier      MySQL access through pymysql
+#   download      concurrent ranged GETs into one buffer
+#   jobqueue      SQS job queue events and an in-process stand-in
+#   loader        column-selective CSV parsing
+#   memprofile    opt-in memory profiling of a job
+#   phenotypes    phenotype expression compiler
+#   prefetch      loads the next samples while one is computed
+#   registry      sample registry queries
+#   results       json and npz encodings of result matrices
+#   samplecache   /tmp cache of decoded samples
+#   sampleindex   sample header index and template checks
+#   sharedscan    one scan of the samples for a batch of jobs
+#   stats         rank-sum and permutation tests, FDR
+#   timing        per-stage timing of a job
+#   workers       process pool that works without /dev/shm
+#
+# Modules are imported individually (from ltsvssts import loader),
+# so functions without pymysql can still use the analysis modules.
+#
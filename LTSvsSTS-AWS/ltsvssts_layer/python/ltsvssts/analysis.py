@@ -0,0 +1,288 @@
+#
+# analysis.py
+#
+# The per-sample analysis kernels (thresholding, phenotype counts and
+# masks, marker co-occurrence) behind interchangeable backends:
+#
+#   pandas   the reference: DataFrame operations as in the original
+#            notebook, kept simple rather than fast
+#   numpy    thresholded markers packed into 64-bit bitmasks, so a
+#            phenotype is a few bitwise operations and a popcount
+#            over n/64 words (the default)
+#   polars   polars expressions over Arrow memory, evaluated on
+#            polars' thread pool, if polars is installed
+#
+# Every backend returns the same results, which
+# LTSvsSTS-Benchmarks/conformance.py checks against the reference.
+# A job picks its backend with "BACKEND" in the template, otherwise
+# backend in the [compute] section of the config file is used.
+#
+# A marker is positive when its intensity is at or above the
+# threshold, compared at the column's precision (a float32 column
+# against the float32 threshold). NaN intensities are negative. A
+# phenotype column without a threshold is positive where it is
+# non-zero.
+#
+
+import operator
+import numpy as np
+import pandas as pd
+
+from ltsvssts import phenotypes
+
+try:
+  import polars as pl
+except ImportError:
+  pl = None
+
+DEFAULT_BACKEND = "numpy"
+
+
+class Backend:
+  """
+  threshold() returns the backend's own representation of a
+  thresholded sample, which the other methods take. Results are
+  int64 counts and bool masks with rows in the order of the
+  phenotype dictionary (or markers) they were built from.
+  """
+
+  name = None
+
+  def threshold(self, df, thresholds):
+    raise NotImplementedError
+
+  def phenotype_masks(self, sample, program):
+    """
+    Returns a (phenotypes x cells) bool array
+    """
+    raise NotImplementedError
+
+  def count_phenotypes(self, sample, program):
+    """
+    Returns the number of positive cells of every phenotype
+    """
+    return self.phenotype_masks(sample, program).sum(axis=1, dtype=np.int64)
+
+  def co_occurrence(self, sample, markers):
+    """
+    Returns the (markers x markers) number of cells positive for
+    both markers of every pair
+    """
+    raise NotImplementedError
+
+
+###################################################################
+#
+# pandas: the reference backend
+#
+class _PandasSample:
+
+  def __init__(self, df, positive):
+    self.df = df
+    self.positive = positive
+
+  def column(self, col):
+    if col in self.positive.columns:
+      return self.positive[col]
+    return self.df[col].fillna(1) != 0
+
+
+class PandasBackend(Backend):
+
+  name = "pandas"
+
+  def threshold(self, df, thresholds):
+    positive = pd.DataFrame({col: df[col] >= df[col].dtype.type(thr) for col, thr in thresholds.items()},
+                            index=df.index)
+    return _PandasSample(df, positive)
+
+  def phenotype_masks(self, sample, program):
+    masks = phenotypes.evaluate_phenotypes(program, sample.column, operator.inv, operator.and_, operator.or_)
+    positive = np.zeros((len(program.outputs), len(sample.df.index)), dtype=bool)
+    for i, phenotype in enumerate(program.outputs):
+      positive[i] = masks[phenotype].to_numpy(dtype=bool)
+    return positive
+
+  def co_occurrence(self, sample, markers):
+    frame = pd.DataFrame({marker: sample.column(marker) for marker in markers}, index=sample.df.index)
+    frame = frame.astype(np.int64)
+    return (frame.T @ frame).to_numpy(dtype=np.int64)
+
+
+###################################################################
+#
+# numpy: bitmask backend. Bit i of a column's words is cell i; the
+# padding bits after the last cell are kept 0, so negation is masked
+# with the bits of the sample's cells.
+#
+def _pack(mask, num_words):
+  packed = np.packbits(mask, bitorder='little')
+  words = np.zeros(num_words * 8, dtype=np.uint8)
+  words[:len(packed)] = packed
+  return words.view(np.uint64)
+
+_BYTE_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def _bit_counts(words):
+  """
+  Returns the number of set bits along the last axis of an array of
+  words
+  """
+  if hasattr(np, "bitwise_count"):
+    return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+  # numpy < 2.0: count the bits of every byte
+  return _BYTE_COUNTS[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+class _BitmaskSample:
+
+  def __init__(self, df, cells, positive):
+    self.df = df
+    self.cells = cells
+    self.num_words = (cells + 63) // 64
+    self.positive = positive
+    self.valid = _pack(np.ones(cells, dtype=bool), self.num_words)
+
+  def column(self, col):
+    words = self.positive.get(col)
+    if words is None:
+      values = self.df[col].to_numpy()
+      words = _pack(values != 0, self.num_words)
+    return words
+
+  def negate(self, words):
+    return np.bitwise_and(np.invert(words), self.valid)
+
+
+class NumpyBackend(Backend):
+
+  name = "numpy"
+
+  def threshold(self, df, thresholds):
+    cells = len(df.index)
+    num_words = (cells + 63) // 64
+    positive = {}
+    for col, thr in thresholds.items():
+      values = df[col].to_numpy()
+      positive[col] = _pack(values >= values.dtype.type(thr), num_words)
+    return _BitmaskSample(df, cells, positive)
+
+  def _evaluate(self, sample, program):
+    return phenotypes.evaluate_phenotypes(program, sample.column, sample.negate,
+                                          np.bitwise_and, np.bitwise_or)
+
+  def count_phenotypes(self, sample, program):
+    words = self._evaluate(sample, program)
+    return np.array([_bit_counts(words[phenotype]) for phenotype in program.outputs], dtype=np.int64)
+
+  def phenotype_masks(self, sample, program):
+    words = self._evaluate(sample, program)
+    masks = np.zeros((len(program.outputs), sample.cells), dtype=bool)
+    for i, phenotype in enumerate(program.outputs):
+      masks[i] = np.unpackbits(words[phenotype].view(np.uint8), count=sample.cells,
+                               bitorder='little').view(bool)
+    return masks
+
+  def co_occurrence(self, sample, markers):
+    if len(markers) == 0:
+      return np.zeros((0, 0), dtype=np.int64)
+
+    words = np.stack([sample.column(marker) for marker in markers])
+    gram = np.zeros((len(markers), len(markers)), dtype=np.int64)
+    for i in range(len(markers)):
+      counts = _bit_counts(np.bitwise_and(words[i], words[i:]))
+      gram[i, i:] = counts
+      gram[i:, i] = counts
+    return gram
+
+
+###################################################################
+#
+# polars: expression backend. All phenotypes (or marker pairs) of a
+# sample are one select, which polars evaluates in parallel with
+# common subexpressions computed once.
+#
+class _PolarsSample:
+
+  def __init__(self, frame, thresholded):
+    self.frame = frame
+    self.thresholded = thresholded
+
+  def column(self, col):
+    if col in self.thresholded:
+      return pl.col(col)
+    # NaN becomes null when converting from pandas, and counts as
+    # non-zero like in the other backends
+    return (pl.col(col) != 0).fill_null(True)
+
+
+class PolarsBackend(Backend):
+
+  name = "polars"
+
+  def __init__(self):
+    if pl is None:
+      raise Exception("the polars backend needs polars, add a Polars layer to the function")
+
+  def threshold(self, df, thresholds):
+    frame = pl.from_pandas(df)
+    exprs = [(pl.col(col) >= pl.lit(thr).cast(frame.schema[col])).fill_null(False).alias(col)
+             for col, thr in thresholds.items()]
+    return _PolarsSample(frame.with_columns(exprs), set(thresholds))
+
+  def _exprs(self, sample, program):
+    exprs = phenotypes.evaluate_phenotypes(program, sample.column, operator.inv, operator.and_, operator.or_)
+    return [exprs[phenotype].alias(str(i)) for i, phenotype in enumerate(program.outputs)]
+
+  def count_phenotypes(self, sample, program):
+    if len(program.outputs) == 0:
+      return np.zeros(0, dtype=np.int64)
+    exprs = [expr.sum().cast(pl.Int64) for expr in self._exprs(sample, program)]
+    row = sample.frame.lazy().select(exprs).collect().row(0)
+    return np.array(row, dtype=np.int64)
+
+  def phenotype_masks(self, sample, program):
+    if len(program.outputs) == 0:
+      return np.zeros((0, sample.frame.height), dtype=bool)
+    frame = sample.frame.lazy().select(self._exprs(sample, program)).collect()
+    return frame.to_numpy().T.astype(bool)
+
+  def co_occurrence(self, sample, markers):
+    pairs = [(i, j) for i in range(len(markers)) for j in range(i, len(markers))]
+    gram = np.zeros((len(markers), len(markers)), dtype=np.int64)
+    if len(pairs) == 0:
+      return gram
+
+    columns = [sample.column(marker) for marker in markers]
+    exprs = [(columns[i] & columns[j]).sum().cast(pl.Int64).alias(str(k)) for k, (i, j) in enumerate(pairs)]
+    row = sample.frame.lazy().select(exprs).collect().row(0)
+    for (i, j), count in zip(pairs, row):
+      gram[i, j] = gram[j, i] = count
+    return gram
+
+
+BACKENDS = {
+  "pandas": PandasBackend,
+  "numpy": NumpyBackend,
+  "polars": PolarsBackend
+}
+
+def available_backends():
+  """
+  Names of the backends whose dependencies are installed
+  """
+  return [name for name in BACKENDS if name != "polars" or pl is not None]
+
+def get_backend(name):
+  if name not in BACKENDS:
+    raise Exception("unknown analysis backend '" + str(name) + "', expected one of: " + ", ".join(BACKENDS))
+  return BACKENDS[name]()
+
+def job_backend(configur, data):
+  """
+  Returns the backend a job asked for in its template, or the
+  config file's default
+  """
+  name = data.get("BACKEND", configur.get('compute', 'backend', fallback=DEFAULT_BACKEND))
+  print("analysis backend:", name)
+  return get_backend(name)
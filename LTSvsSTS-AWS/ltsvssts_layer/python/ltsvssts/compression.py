@@ -0,0 +1,110 @@
+#
+# compression.py
+#
+# Compressed sample CSVs. Numeric CSV compresses 4-8x, so a sample
+# can be stored gzip or zstd compressed, either under a key ending
+# in .csv.gz / .csv.zst, or under its .csv key with the object's
+# Content-Encoding set to gzip / zstd (how the ingest function's
+# recompress mode rewrites existing samples, so templates keep
+# working). Only the compressed bytes are downloaded; they are
+# decompressed as a stream while the CSV parser pulls blocks from it,
+# so neither the decompressed text nor a temporary file is ever
+# held in full.
+#
+# zstd needs the zstandard package (a zstandard layer on the
+# function); gzip is in the standard library.
+#
+
+import gzip
+
+from ltsvssts import download
+
+# Content-Encoding -> key suffix after .csv
+ENCODINGS = {
+  "gzip": ".gz",
+  "zstd": ".zst"
+}
+
+SAMPLE_SUFFIXES = (".csv",) + tuple(".csv" + suffix for suffix in ENCODINGS.values())
+
+# bytes read from the compressed stream at a time
+_READ_SIZE = 1024 * 1024
+
+
+def _zstandard():
+  try:
+    import zstandard
+  except ImportError:
+    raise Exception("zstd compressed samples need the zstandard package, add a zstandard layer to the function")
+  return zstandard
+
+def is_sample_key(key):
+  return key.startswith("LTSvsSTS-Data/") and key.endswith(SAMPLE_SUFFIXES)
+
+def sample_encoding(file_key, content_encoding=None):
+  """
+  Returns the encoding of a sample object (gzip, zstd or None) from
+  its key's extension, or else its Content-Encoding
+  """
+  for encoding, suffix in ENCODINGS.items():
+    if file_key.endswith(".csv" + suffix):
+      return encoding
+
+  content_encoding = (content_encoding or "").strip().lower()
+  if content_encoding in ("", "identity"):
+    return None
+  if content_encoding not in ENCODINGS:
+    raise Exception("sample '" + file_key + "' has unsupported Content-Encoding '" + content_encoding + "'")
+  return content_encoding
+
+def open_stream(raw, encoding):
+  """
+  Returns a file object reading the decompressed bytes of the
+  file object raw
+  """
+  if encoding is None:
+    return raw
+  if encoding == "gzip":
+    return gzip.GzipFile(fileobj=raw, mode='rb')
+  if encoding == "zstd":
+    return _zstandard().ZstdDecompressor().stream_reader(raw, read_size=_READ_SIZE, read_across_frames=True)
+  raise Exception("unsupported encoding '" + str(encoding) + "'")
+
+def compress(data, encoding, level=None):
+  if encoding == "gzip":
+    return gzip.compress(data, compresslevel=(6 if level is None else level), mtime=0)
+  if encoding == "zstd":
+    zstandard = _zstandard()
+    return zstandard.ZstdCompressor(level=(3 if level is None else level), threads=-1).compress(data)
+  raise Exception("unsupported encoding '" + str(encoding) + "'")
+
+def decompress(data, encoding):
+  if encoding is None:
+    return data
+  with open_stream(download.BufferReader(data), encoding) as stream:
+    return stream.read()
+
+
+class CompressedSample:
+  """
+  A downloaded compressed sample; the loader opens a new
+  decompressing stream over the buffer for every pass
+  """
+
+  def __init__(self, buffer, encoding):
+    self.buffer = buffer
+    self.encoding = encoding
+
+  def open(self):
+    return open_stream(download.BufferReader(self.buffer), self.encoding)
+
+
+def sample_source(body, file_key, content_encoding=None):
+  """
+  Returns what the loader parses for a downloaded sample: the body
+  itself, or a CompressedSample if the sample is compressed
+  """
+  encoding = sample_encoding(file_key, content_encoding)
+  if encoding is None:
+    return body
+  return CompressedSample(body, encoding)
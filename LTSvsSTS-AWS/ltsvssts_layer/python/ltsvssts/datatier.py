@@ -188,5 +188,57 @@ def perform_action(dbConn, sql, parameters=[]):
     print(str(err))
     raise
 
+  finally:
+    dbCursor.close()
+
+
+###############################################################
+#
+# insert_row:
+#
+# Given a database connection and an SQL insert query,
+# executes the query and returns the id of the row together
+# with the number of rows modified, in one round trip instead
+# of a separate SELECT LAST_INSERT_ID(). With an
+# "ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)" clause the
+# id is that of the existing row when the insert was a
+# duplicate, and the number of rows modified is 0 (the
+# connection does not set CLIENT_FOUND_ROWS). The query can be
+# parameterized using %s, in which case pass the values as a
+# list [value1, value2, ...]
+#
+def insert_row(dbConn, sql, parameters=[]):
+  """
+  Executes an sql INSERT query against the database connection
+  and returns the row's id and the number of rows modified
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL INSERT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized
+
+  Returns
+  _______
+  (id, rows modified): the auto-generated id of the new row and
+  1, or the id of the existing row and 0 for a duplicate
+  """
+
+  dbCursor = dbConn.cursor()
+
+  try:
+    # try to execute, and if successful commit the changes
+    # and return the row id and # of rows modified:
+    dbCursor.execute(sql, parameters)
+    dbConn.commit()
+    return dbCursor.lastrowid, dbCursor.rowcount
+
+  except Exception as err:
+    # failed, rollback any possible changes and log error:
+    dbConn.rollback()
+    print("datatier.insert_row() failed:")
+    print(str(err))
+    raise
+
   finally:
     dbCursor.close()
\ No newline at end of file
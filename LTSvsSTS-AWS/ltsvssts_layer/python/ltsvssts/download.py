@@ -0,0 +1,157 @@
+#
+# download.py
+#
+# Downloads large S3 objects with concurrent byte-range GETs. The
+# object's size is known from its HEAD, so one buffer is allocated
+# up front and every part is written straight into its slice; the
+# parser then reads a memoryview of that buffer through
+# BufferReader instead of a copy in a BytesIO.
+#
+# Each ranged GET is made with IfMatch on the object's ETag, so an
+# object re-uploaded while it is being fetched fails the download
+# instead of mixing parts of two versions. A part whose stream
+# breaks is fetched again, up to the configured number of attempts.
+#
+# Settings are in the [download] section of the config file:
+#
+#   part_size_mb   size of each ranged GET (default 8)
+#   concurrency    GETs in flight at once (default 8)
+#   attempts       tries per part (default 3)
+#
+# Objects no larger than one part are fetched with a single GET.
+#
+
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MB = 1024 * 1024
+
+# bytes copied from the response stream at a time
+_CHUNK_SIZE = 1 * MB
+
+
+class BufferReader(io.RawIOBase):
+  """
+  Read-only, seekable file over a bytes-like object, so pandas and
+  numpy can parse a downloaded buffer without copying all of it
+  """
+
+  def __init__(self, buffer):
+    self.view = memoryview(buffer).cast('B')
+    self.pos = 0
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def readinto(self, b):
+    n = min(len(b), len(self.view) - self.pos)
+    if n <= 0:
+      return 0
+    b[:n] = self.view[self.pos:self.pos + n]
+    self.pos += n
+    return n
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_SET:
+      self.pos = offset
+    elif whence == io.SEEK_CUR:
+      self.pos += offset
+    elif whence == io.SEEK_END:
+      self.pos = len(self.view) + offset
+    else:
+      raise ValueError("invalid whence: " + str(whence))
+    self.pos = max(self.pos, 0)
+    return self.pos
+
+  def tell(self):
+    return self.pos
+
+
+class RangedDownloader:
+
+  def __init__(self, part_size=8 * MB, concurrency=8, attempts=3):
+    if part_size <= 0 or concurrency <= 0 or attempts <= 0:
+      raise Exception("download part size, concurrency and attempts must be positive")
+    self.part_size = part_size
+    self.concurrency = concurrency
+    self.attempts = attempts
+
+  def parts(self, size):
+    """
+    Returns the (first, last) byte of every part of an object, with
+    last inclusive as in an HTTP Range header
+    """
+    return [(first, min(first + self.part_size, size) - 1)
+            for first in range(0, size, self.part_size)]
+
+  def _fetch_part(self, s3_client, bucket, key, etag, view, first, last):
+    expected = last - first + 1
+    for attempt in range(1, self.attempts + 1):
+      try:
+        response = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag,
+                                        Range="bytes=" + str(first) + "-" + str(last))
+        pos = first
+        for chunk in response['Body'].iter_chunks(_CHUNK_SIZE):
+          if pos + len(chunk) > last + 1:
+            raise Exception("more bytes than requested")
+          view[pos:pos + len(chunk)] = chunk
+          pos += len(chunk)
+        if pos - first != expected:
+          raise Exception("got " + str(pos - first) + " of " + str(expected) + " bytes")
+        return
+      except s3_client.exceptions.ClientError as err:
+        if err.response.get('Error', {}).get('Code') in ("PreconditionFailed", "412"):
+          raise Exception("'" + key + "' changed during the download, retry the job")
+        if attempt == self.attempts:
+          raise
+      except Exception as err:
+        if attempt == self.attempts:
+          raise Exception("download of '" + key + "' bytes " + str(first) + "-" + str(last) +
+                          " failed after " + str(attempt) + " attempts: " + str(err))
+      print("download: retrying", key, "bytes", first, "-", last, "attempt", attempt + 1)
+
+  def fetch(self, s3_client, bucket, key, size=None, etag=None):
+    """
+    Returns the object's bytes as a memoryview of a buffer filled by
+    concurrent ranged GETs; size and etag come from a HEAD if not
+    given
+    """
+    if size is None or etag is None:
+      head = s3_client.head_object(Bucket=bucket, Key=key)
+      size = head['ContentLength']
+      etag = head['ETag']
+
+    start = time.perf_counter()
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    parts = self.parts(size)
+
+    if len(parts) <= 1 or self.concurrency == 1:
+      for first, last in parts:
+        self._fetch_part(s3_client, bucket, key, etag, view, first, last)
+    else:
+      with ThreadPoolExecutor(max_workers=min(self.concurrency, len(parts))) as pool:
+        futures = [pool.submit(self._fetch_part, s3_client, bucket, key, etag, view, first, last)
+                   for first, last in parts]
+        for future in futures:
+          future.result()
+
+    seconds = time.perf_counter() - start
+    rate = (size / MB / seconds) if seconds > 0 else 0.0
+    print(f"download: {key} {size / MB:.1f} MB in {len(parts)} parts, "
+          f"{min(self.concurrency, max(len(parts), 1))} concurrent, {seconds:.2f} s, {rate:.1f} MB/s")
+    return view
+
+
+def get_downloader(configur):
+  """
+  Returns a downloader with the settings of the [download] section
+  """
+  part_size = int(configur.getfloat('download', 'part_size_mb', fallback=8) * MB)
+  concurrency = configur.getint('download', 'concurrency', fallback=8)
+  attempts = configur.getint('download', 'attempts', fallback=3)
+  return RangedDownloader(part_size, concurrency, attempts)
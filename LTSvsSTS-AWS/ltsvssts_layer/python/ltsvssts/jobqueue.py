@@ -0,0 +1,118 @@
+#
+# jobqueue.py
+#
+# Queue of submitted compute id 1, 2 and 4 jobs for the shared-scan
+# worker (ltsvssts_batch). In AWS the S3 put events of those
+# templates go to an SQS queue instead of the compute functions, and
+# the queue's Lambda trigger collects messages over its batching
+# window (MaximumBatchingWindowInSeconds) and invokes the worker with
+# up to BatchSize of them at once.
+#
+# LocalQueue is an in-process stand-in with the same batching, for
+# the emulator and local tests: messages sent within the window of
+# the first one are delivered together, as an SQS event.
+#
+
+import json
+import queue
+import re
+import time
+import urllib.parse
+import uuid
+
+# compute ids the batch worker runs with a shared scan
+SHARED_COMPUTE_IDS = (1, 2, 4)
+
+_TEMPLATE_KEY = re.compile(r"^LTSvsSTS(\d+)-Template/.+\.json$")
+
+
+def compute_id(bucketkey):
+  """
+  Returns the compute id of a template key, or None if the key is
+  not a template
+  """
+  match = _TEMPLATE_KEY.match(bucketkey)
+  if match is None:
+    return None
+  return int(match.group(1))
+
+def template_keys(event):
+  """
+  Returns the template keys of an SQS event whose messages are S3
+  put events, in the order they were queued and without duplicates.
+  S3 events delivered to the worker directly are accepted as well.
+  """
+  keys = []
+  for record in event.get("Records", []):
+    if "body" in record:
+      # S3 sends a test message without records when the
+      # notification is created
+      s3_records = json.loads(record["body"]).get("Records", [])
+    else:
+      s3_records = [record]
+
+    for s3_record in s3_records:
+      key = urllib.parse.unquote_plus(s3_record['s3']['object']['key'], encoding='utf-8')
+      if key not in keys:
+        keys.append(key)
+
+  return keys
+
+
+class LocalQueue:
+  """
+  In-process stand-in for the SQS queue and its Lambda trigger
+  """
+
+  def __init__(self, batch_size=10, window=20.0):
+    if batch_size <= 0 or window < 0:
+      raise Exception("queue batch size must be positive and the window not negative")
+    self.batch_size = batch_size
+    self.window = window
+    self.messages = queue.Queue()
+
+  def send(self, body):
+    """
+    Queues a message; body is a str, or a dict sent as JSON
+    """
+    if not isinstance(body, str):
+      body = json.dumps(body)
+    self.messages.put(body)
+
+  def receive(self):
+    """
+    Waits up to the window for a first message, then collects more
+    until the batch is full or the window from the first one has
+    passed. Returns the batch as an SQS event, or None if no message
+    arrived.
+    """
+    try:
+      bodies = [self.messages.get(timeout=self.window)]
+    except queue.Empty:
+      return None
+
+    deadline = time.monotonic() + self.window
+    while len(bodies) < self.batch_size:
+      remaining = deadline - time.monotonic()
+      try:
+        bodies.append(self.messages.get(timeout=max(remaining, 0)) if remaining > 0
+                      else self.messages.get_nowait())
+      except queue.Empty:
+        break
+
+    return {"Records": [{"messageId": str(uuid.uuid4()),
+                         "eventSource": "aws:sqs",
+                         "body": body} for body in bodies]}
+
+  def drain(self, handler):
+    """
+    Invokes handler(event, None) with batches until the queue is
+    empty, returning the responses
+    """
+    responses = []
+    while not self.messages.empty():
+      event = self.receive()
+      if event is None:
+        break
+      responses.append(handler(event, None))
+    return responses
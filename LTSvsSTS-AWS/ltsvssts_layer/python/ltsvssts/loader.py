@@ -0,0 +1,112 @@
+#
+# loader.py
+#
+# Loads sample CSVs reading only the columns a job needs, with a
+# compact dtype per column instead of pandas' float64/int64
+# inference, and reports the bytes saved per sample.
+#
+# Marker intensities and distance metrics are stored as float32;
+# the analysis backends (analysis.py) threshold them. Compressed
+# samples (compression.py) are parsed from a decompressing stream.
+#
+
+import pathlib
+import numpy as np
+import pandas as pd
+from io import BytesIO
+
+from ltsvssts import compression
+from ltsvssts import download
+
+INTENSITY_DTYPE = np.float32
+DISTANCE_DTYPE = np.float32
+DISTANCE_SUFFIX = " Distance"
+MARKER_SUFFIX = "_R"
+
+
+###################################################################
+#
+# job_columns:
+#
+# Returns the columns a job reads: every thresholded marker plus
+# any extra columns (phenotype markers, distance metrics, ...),
+# in first-seen order and without duplicates.
+#
+def job_columns(thresholddict=None, extra=None):
+  columns = []
+  seen = set()
+
+  for thresholds in (thresholddict or {}).values():
+    for col in thresholds:
+      if col not in seen:
+        seen.add(col)
+        columns.append(col)
+
+  for col in (extra or []):
+    if col not in seen:
+      seen.add(col)
+      columns.append(col)
+
+  return columns
+
+def sample_name(file_key):
+  """
+  Returns the sample's name, its key without the folder and the
+  .csv, .csv.gz or .csv.zst suffix
+  """
+  name = pathlib.PurePosixPath(file_key).name
+  for suffix in sorted(compression.SAMPLE_SUFFIXES, key=len, reverse=True):
+    if name.endswith(suffix):
+      return name[:-len(suffix)]
+  return pathlib.PurePosixPath(name).stem
+
+def dtype_map(columns):
+  return {col: (DISTANCE_DTYPE if col.endswith(DISTANCE_SUFFIX) else INTENSITY_DTYPE)
+          for col in columns}
+
+def _open(source):
+  # raw bytes from S3 are parsed without decoding to str first;
+  # BytesIO shares bytes, but would copy a downloaded buffer
+  if isinstance(source, bytes):
+    return BytesIO(source)
+  if isinstance(source, (bytearray, memoryview)):
+    return download.BufferReader(source)
+  if isinstance(source, compression.CompressedSample):
+    return source.open()
+  return source
+
+def sample_columns(source):
+  """
+  Returns the column names of a sample by parsing only its header
+  """
+  return list(pd.read_csv(_open(source), nrows=0).columns)
+
+
+###################################################################
+#
+# load_sample:
+#
+# Parses a sample (raw CSV bytes, a downloaded buffer, a
+# CompressedSample or a file path) keeping only the given columns
+# with the compact dtype map.
+# Prints the bytes held compared to a full float64 parse of every
+# column.
+#
+def load_sample(source, columns, name=""):
+  header = sample_columns(source)
+
+  missing = [col for col in columns if col not in header]
+  if len(missing) > 0:
+    raise Exception("sample '" + str(name) + "' is missing columns: " + ", ".join(missing))
+
+  df = pd.read_csv(_open(source), usecols=columns, dtype=dtype_map(columns), engine='c')
+
+  # keep the job's column order rather than the file's
+  df = df[columns]
+
+  full_bytes = len(df.index) * len(header) * 8
+  loaded_bytes = int(df.memory_usage(index=False).sum())
+  print(f"loaded {name}: {len(df.index)} cells, {len(columns)}/{len(header)} columns, "
+        f"{loaded_bytes} bytes, saved {full_bytes - loaded_bytes} bytes")
+
+  return df
@@ -0,0 +1,276 @@
+#
+# memprofile.py
+#
+# Opt-in memory profiling of a compute job, turned on by
+#
+#   "PROFILE_MEMORY": true
+#
+# in the template or memory = true in the [profile] section of the
+# config file. While on, tracemalloc traces Python and numpy
+# allocations and a background thread samples the process RSS, and
+# the peak of both is recorded for every timing stage (see
+# timing.py) and every sample. Each stage logs a JSON line such as
+#
+#   {"type": "memory", "job": "...", "stage": "csv_parse", "sample": "NU01929", "traced_mb": 812.4, "rss_mb": 1390.2}
+#
+# so when a sample runs the function out of memory the last line
+# names the stage and sample. report() fits each sample's peak
+# against its cell count and recommends the smallest Lambda memory
+# setting that fits the largest sample of the job and of each
+# cohort; the handlers store it as LTSvsSTS-Result/<job>-memory.json.
+#
+# Only stages run on the main thread are profiled, and worker
+# processes are not included in the RSS.
+#
+
+import json
+import math
+import os
+import resource
+import threading
+import tracemalloc
+import numpy as np
+
+from ltsvssts import loader
+from ltsvssts import timing
+
+MB = 1024 * 1024
+
+# Lambda memory settings, in MB
+LAMBDA_MIN_MB = 128
+LAMBDA_MAX_MB = 10240
+
+# recommendations are rounded up to a multiple of this, in MB
+ROUND_MB = 64
+
+_profile = None
+
+
+def rss_bytes():
+  """
+  Returns the resident set size of this process
+  """
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError):
+    # peak rather than current RSS, in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _RssSampler(threading.Thread):
+  """
+  Samples the RSS every interval seconds, keeping the peak since the
+  last take_peak()
+  """
+
+  def __init__(self, interval):
+    super().__init__(daemon=True)
+    self.interval = interval
+    self.peak = rss_bytes()
+    self.stopped = threading.Event()
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      rss = rss_bytes()
+      if rss > self.peak:
+        self.peak = rss
+
+  def take_peak(self):
+    """
+    Returns the peak since the last call and restarts from the
+    current RSS
+    """
+    current = rss_bytes()
+    peak = max(self.peak, current)
+    self.peak = current
+    return peak
+
+
+class _Frame:
+
+  def __init__(self, name, sample, traced, rss):
+    self.name = name
+    self.sample = sample
+    self.traced = traced
+    self.rss = rss
+
+
+class _Profile:
+
+  def __init__(self, job, interval, margin):
+    self.job = job
+    self.margin = margin
+    self.main = threading.main_thread()
+    self.stack = []
+    self.stages = {}
+    self.samples = {}
+
+    tracemalloc.start()
+    self.sampler = _RssSampler(interval)
+    self.sampler.start()
+    self.base_rss = rss_bytes()
+    self.peak_traced = 0
+    self.peak_rss = self.base_rss
+
+  def _take_peaks(self):
+    """
+    Peaks since the previous call, credited to every open stage
+    """
+    _, traced = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    rss = self.sampler.take_peak()
+
+    for frame in self.stack:
+      frame.traced = max(frame.traced, traced)
+      frame.rss = max(frame.rss, rss)
+    self.peak_traced = max(self.peak_traced, traced)
+    self.peak_rss = max(self.peak_rss, rss)
+
+  def enter(self, name, sample):
+    if threading.current_thread() is not self.main:
+      return
+    self._take_peaks()
+    traced, _ = tracemalloc.get_traced_memory()
+    self.stack.append(_Frame(name, sample, traced, rss_bytes()))
+
+  def exit(self, name, sample):
+    if threading.current_thread() is not self.main or len(self.stack) == 0:
+      return
+    self._take_peaks()
+    frame = self.stack.pop()
+
+    totals = self.stages.setdefault(frame.name, {"traced": 0, "rss": 0})
+    totals["traced"] = max(totals["traced"], frame.traced)
+    totals["rss"] = max(totals["rss"], frame.rss)
+    if frame.sample is not None:
+      totals = self.samples.setdefault(frame.sample, {"traced": 0, "rss": 0})
+      totals["traced"] = max(totals["traced"], frame.traced)
+      totals["rss"] = max(totals["rss"], frame.rss)
+
+    print(json.dumps({"type": "memory", "job": self.job, "stage": frame.name, "sample": frame.sample,
+                      "traced_mb": round(frame.traced / MB, 1), "rss_mb": round(frame.rss / MB, 1)}))
+
+  def stop(self):
+    self._take_peaks()
+    self.sampler.stopped.set()
+    self.sampler.join()
+    tracemalloc.stop()
+
+
+def enabled(configur, data):
+  """
+  True if the template or the config file asks for memory profiling
+  """
+  if "PROFILE_MEMORY" in data:
+    return bool(data["PROFILE_MEMORY"])
+  return configur.getboolean('profile', 'memory', fallback=False)
+
+def start(configur, job):
+  """
+  Starts profiling a job, hooking into its timing stages
+  """
+  global _profile
+  stop()
+  interval = configur.getfloat('profile', 'interval', fallback=0.01)
+  margin = configur.getfloat('profile', 'margin', fallback=1.2)
+  _profile = _Profile(job, interval, margin)
+  timing.set_listener(_profile)
+  print("**Profiling memory: RSS sampled every", interval, "s**")
+
+def active():
+  return _profile is not None
+
+def stop():
+  """
+  Stops profiling, if on; safe to call from error handlers
+  """
+  global _profile
+  if _profile is not None:
+    timing.set_listener(None)
+    _profile.stop()
+    _profile = None
+
+def fit_memory(cells, peaks):
+  """
+  Least-squares fit of peak bytes = intercept + slope * cells,
+  returning (intercept, slope). With a single distinct cell count
+  the line goes through the origin.
+  """
+  cells = np.asarray(cells, dtype=np.float64)
+  peaks = np.asarray(peaks, dtype=np.float64)
+  if len(np.unique(cells)) < 2:
+    return 0.0, float(peaks.max() / max(cells.max(), 1))
+
+  slope, intercept = np.polyfit(cells, peaks, 1)
+  return float(max(intercept, 0.0)), float(max(slope, 0.0))
+
+def recommend_memory(peak_bytes, margin):
+  """
+  Smallest Lambda memory setting (MB) holding peak_bytes with the
+  given safety margin
+  """
+  mb = math.ceil(peak_bytes * margin / MB / ROUND_MB) * ROUND_MB
+  return int(min(max(mb, LAMBDA_MIN_MB), LAMBDA_MAX_MB))
+
+
+###################################################################
+#
+# report:
+#
+# Stops profiling and returns the job's memory report. samples are
+# the registry samples (registry.ready_samples), which give the cell
+# count of every profiled sample and of each cohort's largest one.
+# The RSS of a sample is predicted as the RSS before the job plus
+# the fitted traced peak, as RSS does not shrink once memory is
+# freed and would credit small samples with the peak of large ones.
+#
+def report(samples):
+  profile = _profile
+  if profile is None:
+    return {}
+  stop()
+
+  cells = {loader.sample_name(sample.datafilekey): sample.cells for sample in samples}
+  cohorts = {}
+  for sample in samples:
+    if sample.cohort is not None and sample.cohort != "":
+      cohorts.setdefault(sample.cohort, []).append(sample.cells)
+
+  result = {
+    "job": profile.job,
+    "base_rss_mb": round(profile.base_rss / MB, 1),
+    "peak_traced_mb": round(profile.peak_traced / MB, 1),
+    "peak_rss_mb": round(profile.peak_rss / MB, 1),
+    "margin": profile.margin,
+    "stages": {name: {"traced_mb": round(peaks["traced"] / MB, 1), "rss_mb": round(peaks["rss"] / MB, 1)}
+               for name, peaks in profile.stages.items()},
+    "samples": {sample: {"cells": cells.get(sample), "traced_mb": round(peaks["traced"] / MB, 1),
+                         "rss_mb": round(peaks["rss"] / MB, 1)}
+                for sample, peaks in profile.samples.items()}
+  }
+
+  fitted = [(cells[sample], peaks["traced"]) for sample, peaks in profile.samples.items() if sample in cells]
+  if len(fitted) == 0:
+    result["recommended_mb"] = {"job": recommend_memory(profile.peak_rss, profile.margin)}
+    return result
+
+  intercept, slope = fit_memory([c for c, _ in fitted], [p for _, p in fitted])
+  result["fit"] = {"intercept_mb": round(intercept / MB, 1),
+                   "mb_per_million_cells": round(slope * 1e6 / MB, 1)}
+
+  def predicted(num_cells):
+    return profile.base_rss + intercept + slope * num_cells
+
+  recommended = {"job": recommend_memory(max(profile.peak_rss, predicted(max(c for c, _ in fitted))),
+                                         profile.margin)}
+  for cohort, cohort_cells in sorted(cohorts.items()):
+    recommended[cohort] = recommend_memory(predicted(max(cohort_cells)), profile.margin)
+  if len(cells) > 0:
+    recommended["all"] = recommend_memory(predicted(max(cells.values())), profile.margin)
+  result["recommended_mb"] = recommended
+
+  return result
+
+def memory_key(results_key):
+  return os.path.splitext(results_key)[0] + "-memory.json"
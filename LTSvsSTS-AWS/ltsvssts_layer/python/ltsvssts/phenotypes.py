@@ -0,0 +1,220 @@
+#
+# phenotypes.py
+#
+# Compiles phenotype definitions into a DAG of boolean operations
+# over thresholded marker columns, so subexpressions shared between
+# phenotypes are evaluated once per sample.
+#
+# A phenotype is either a list of marker columns (all must be
+# positive, e.g. ["CD4_R", "Ki67_R"]) or an expression string:
+#
+#   CD4+ & !FOXP3+
+#   CD68+ & (CD163+ | CD206+)
+#   GFAP- cCasp3+          (juxtaposition means &)
+#
+# where MARKER+ is the column MARKER_R being positive and MARKER- is
+# the same as !MARKER+.
+#
+
+import re
+import numpy as np
+
+_TOKEN = re.compile(r"\s*(?:([A-Za-z0-9]+)([+-])|([&|!()]))")
+
+
+class PhenotypeProgram:
+  """
+  Compiled phenotypes: nodes[i] is ('col', name), ('not', a),
+  ('and', a, b) or ('or', a, b) where a and b are indices of earlier
+  nodes, so evaluating nodes in order respects every dependency.
+  outputs maps each phenotype name to its node index.
+  """
+
+  def __init__(self, nodes, outputs):
+    self.nodes = nodes
+    self.outputs = outputs
+
+  def columns(self):
+    return [node[1] for node in self.nodes if node[0] == 'col']
+
+
+###################################################################
+#
+# parse_phenotype:
+#
+# Parses one phenotype definition into a nested tuple tree of
+# ('col', name), ('not', x), ('and', [x, ...]) and ('or', [x, ...]).
+#
+def parse_phenotype(definition):
+  if isinstance(definition, list):
+    if len(definition) == 0:
+      raise Exception("phenotype has an empty marker list")
+    return ('and', [('col', col) for col in definition])
+
+  if not isinstance(definition, str):
+    raise Exception("phenotype must be a list of markers or an expression string")
+
+  tokens = []
+  pos = 0
+  text = definition.rstrip()
+  while pos < len(text):
+    match = _TOKEN.match(text, pos)
+    if match is None:
+      raise Exception("invalid phenotype expression '" + definition + "' at: " + text[pos:])
+    if match.group(1):
+      tokens.append(('marker', match.group(1), match.group(2)))
+    else:
+      tokens.append(('op', match.group(3)))
+    pos = match.end()
+
+  tree, pos = _parse_or(tokens, 0, definition)
+  if pos != len(tokens):
+    raise Exception("unexpected tokens at end of phenotype expression '" + definition + "'")
+  return tree
+
+def _parse_or(tokens, pos, definition):
+  terms = []
+  term, pos = _parse_and(tokens, pos, definition)
+  terms.append(term)
+  while pos < len(tokens) and tokens[pos] == ('op', '|'):
+    term, pos = _parse_and(tokens, pos + 1, definition)
+    terms.append(term)
+  return (terms[0] if len(terms) == 1 else ('or', terms)), pos
+
+def _parse_and(tokens, pos, definition):
+  terms = []
+  term, pos = _parse_unary(tokens, pos, definition)
+  terms.append(term)
+  while pos < len(tokens):
+    if tokens[pos] == ('op', '&'):
+      pos += 1
+    elif tokens[pos][0] != 'marker' and tokens[pos] not in [('op', '!'), ('op', '(')]:
+      break
+    term, pos = _parse_unary(tokens, pos, definition)
+    terms.append(term)
+  return (terms[0] if len(terms) == 1 else ('and', terms)), pos
+
+def _parse_unary(tokens, pos, definition):
+  if pos >= len(tokens):
+    raise Exception("phenotype expression '" + definition + "' ends unexpectedly")
+
+  token = tokens[pos]
+  if token == ('op', '!'):
+    term, pos = _parse_unary(tokens, pos + 1, definition)
+    return ('not', term), pos
+  if token == ('op', '('):
+    term, pos = _parse_or(tokens, pos + 1, definition)
+    if pos >= len(tokens) or tokens[pos] != ('op', ')'):
+      raise Exception("missing ')' in phenotype expression '" + definition + "'")
+    return term, pos + 1
+  if token[0] == 'marker':
+    col = ('col', token[1] + "_R")
+    return (col if token[2] == '+' else ('not', col)), pos + 1
+
+  raise Exception("unexpected '" + token[1] + "' in phenotype expression '" + definition + "'")
+
+
+###################################################################
+#
+# compile_phenotypes:
+#
+# Compiles every phenotype into one shared PhenotypeProgram. AND/OR
+# operands are flattened, de-duplicated and chained so the operands
+# used by the most phenotypes are combined first, which lets e.g.
+# CD68+CD163+ and CD68+CD163+CD206+ share the CD68 & CD163 node.
+#
+def compile_phenotypes(phenotypedict):
+  trees = {}
+  for phenotype, definition in phenotypedict.items():
+    try:
+      trees[phenotype] = _normalize(parse_phenotype(definition))
+    except Exception as err:
+      raise Exception("phenotype '" + phenotype + "': " + str(err))
+
+  usage = {}
+  for tree in trees.values():
+    _count_operands(tree, usage)
+
+  nodes = []
+  index = {}
+  outputs = {}
+  for phenotype, tree in trees.items():
+    outputs[phenotype] = _emit(tree, nodes, index, usage)
+
+  return PhenotypeProgram(nodes, outputs)
+
+def _normalize(tree):
+  kind = tree[0]
+  if kind == 'col':
+    return tree
+  if kind == 'not':
+    inner = _normalize(tree[1])
+    if inner[0] == 'not':
+      return inner[1]
+    return ('not', inner)
+
+  operands = set()
+  for child in tree[1]:
+    child = _normalize(child)
+    if child[0] == kind:
+      operands.update(child[1])
+    else:
+      operands.add(child)
+  if len(operands) == 1:
+    return operands.pop()
+  return (kind, frozenset(operands))
+
+def _count_operands(tree, usage):
+  if tree[0] == 'not':
+    _count_operands(tree[1], usage)
+  elif tree[0] in ['and', 'or']:
+    for child in tree[1]:
+      usage[child] = usage.get(child, 0) + 1
+      _count_operands(child, usage)
+
+def _add_node(node, nodes, index):
+  if node not in index:
+    index[node] = len(nodes)
+    nodes.append(node)
+  return index[node]
+
+def _emit(tree, nodes, index, usage):
+  kind = tree[0]
+  if kind == 'col':
+    return _add_node(tree, nodes, index)
+  if kind == 'not':
+    return _add_node(('not', _emit(tree[1], nodes, index, usage)), nodes, index)
+
+  operands = sorted(tree[1], key=lambda child: (-usage.get(child, 0), repr(child)))
+  current = _emit(operands[0], nodes, index, usage)
+  for child in operands[1:]:
+    right = _emit(child, nodes, index, usage)
+    current = _add_node((kind, current, right), nodes, index)
+  return current
+
+
+###################################################################
+#
+# evaluate_phenotypes:
+#
+# Evaluates a compiled program against one sample, given a function
+# returning the boolean (or 0/1) array of a thresholded column.
+# Returns a dict of phenotype -> boolean mask. The operations default
+# to numpy's logical ones; the analysis backends pass their own to
+# evaluate over Series, bitmasks or expressions instead.
+#
+def evaluate_phenotypes(program, get_column, negate=np.logical_not, both=np.logical_and,
+                        either=np.logical_or):
+  values = []
+  for node in program.nodes:
+    kind = node[0]
+    if kind == 'col':
+      values.append(get_column(node[1]))
+    elif kind == 'not':
+      values.append(negate(values[node[1]]))
+    elif kind == 'and':
+      values.append(both(values[node[1]], values[node[2]]))
+    else:
+      values.append(either(values[node[1]], values[node[2]]))
+
+  return {phenotype: values[i] for phenotype, i in program.outputs.items()}
@@ -0,0 +1,75 @@
+#
+# prefetch.py
+#
+# Double-buffered sample loading. A producer thread loads the next
+# samples of a job (download, parse, cache write) while the handler
+# computes on the current one, so the network is busy while numpy
+# is, and a job takes about max(load, compute) per sample instead of
+# their sum. At most `depth` samples are loaded ahead of the one
+# being computed, which bounds the extra memory to depth samples.
+#
+# The depth is `prefetch` in the [download] section (default 1; 0
+# loads each sample only when it is needed). Prefetching is off while
+# memory profiling, so each sample's peak is measured on its own.
+#
+# The DB connection stays on the handler's thread: the producer only
+# loads.
+#
+
+import queue
+import threading
+
+from ltsvssts import memprofile
+
+
+def get_depth(configur):
+  """
+  Returns the number of samples to load ahead
+  """
+  if memprofile.active():
+    return 0
+  return max(configur.getint('download', 'prefetch', fallback=1), 0)
+
+def prefetched(load, items, depth):
+  """
+  Yields (item, load(item)) for every item in order, with up to
+  depth items loaded ahead on a producer thread. An exception raised
+  by load is raised here, at its item.
+  """
+  items = list(items)
+  if depth <= 0 or len(items) <= 1:
+    for item in items:
+      yield item, load(item)
+    return
+
+  loaded = queue.Queue()
+  # one slot for the item being computed, depth for those ahead
+  slots = threading.Semaphore(depth + 1)
+  stop = threading.Event()
+
+  def produce():
+    for item in items:
+      slots.acquire()
+      if stop.is_set():
+        return
+      try:
+        loaded.put((item, load(item), None))
+      except Exception as err:
+        loaded.put((item, None, err))
+        return
+
+  producer = threading.Thread(target=produce, name="prefetch", daemon=True)
+  producer.start()
+  try:
+    for _ in items:
+      item, value, err = loaded.get()
+      if err is not None:
+        raise err
+      yield item, value
+      # the caller is done with this item
+      del value
+      slots.release()
+  finally:
+    # unblocks a producer waiting for a slot if the caller stopped early
+    stop.set()
+    slots.release()
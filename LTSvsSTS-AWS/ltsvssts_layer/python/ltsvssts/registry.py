@@ -0,0 +1,70 @@
+#
+# registry.py
+#
+# Reads the sample registry (the samples table filled in by
+# ltsvssts_ingest) to decide which sample files a job processes,
+# which cohort each belongs to, and how many there are in total.
+#
+
+from ltsvssts import datatier
+
+# the cohorts the compute functions compare
+COHORTS = ("LTS", "STS")
+
+
+class Sample:
+
+  def __init__(self, row):
+    self.datafilekey = row[0]
+    self.cohort = row[1]
+    self.cells = row[2]
+
+
+def ready_samples(dbConn):
+  """
+  Returns every sample that was ingested successfully, ordered by
+  datafilekey
+  """
+  sql = "SELECT datafilekey, cohort, cells FROM samples WHERE status = 'ready' ORDER BY datafilekey;"
+  rows = datatier.retrieve_all_rows(dbConn, sql)
+  return [Sample(row) for row in rows]
+
+def job_files(dbConn, requested=None):
+  """
+  Returns the sample files a job processes: the requested ones (in
+  the order given), or every ready sample if requested is None.
+  Raises if a requested sample is not a ready sample.
+  """
+  samples = ready_samples(dbConn)
+  if requested is None:
+    return [sample.datafilekey for sample in samples]
+
+  ready = set(sample.datafilekey for sample in samples)
+  missing = [file_key for file_key in requested if file_key not in ready]
+  if len(missing) > 0:
+    raise Exception("samples not ingested or invalid: " + ", ".join(missing))
+
+  return list(requested)
+
+def cohort_files(dbConn, requested=None):
+  """
+  Returns a dict of cohort -> sample files for every ready sample
+  in an LTS or STS cohort, restricted to the requested files if
+  given. Raises if a requested sample is in neither cohort, rather
+  than leaving it out of the comparison.
+  """
+  cohorts = {}
+  unassigned = []
+  for sample in ready_samples(dbConn):
+    if requested is not None and sample.datafilekey not in requested:
+      continue
+    if sample.cohort not in COHORTS:
+      unassigned.append(sample.datafilekey)
+      continue
+    cohorts.setdefault(sample.cohort, []).append(sample.datafilekey)
+
+  if requested is not None and len(unassigned) > 0:
+    raise Exception("samples not in the LTS or STS cohort: " + ", ".join(unassigned)
+                    + " (check the cohort column of the samples table)")
+
+  return cohorts
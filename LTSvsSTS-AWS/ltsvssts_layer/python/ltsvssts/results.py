@@ -0,0 +1,151 @@
+#
+# results.py
+#
+# Result encodings of the (rows x samples) matrices of compute ids 1
+# to 3. A job's template picks one with "RESULT_FORMAT":
+#
+#   json   df.to_json(orient='index'), the default
+#   npz    compressed numpy .npz with the row and column labels and
+#          the values as int32 counts or float32 proportions, about
+#          5x smaller than JSON and parsed without text conversion
+#
+# The client asks for npz when it can read it; the download function
+# converts an npz result back to JSON for clients that did not ask.
+#
+# While a job is processing, PartialResults keeps the columns of the
+# samples completed so far in LTSvsSTS-Result/<template>-partial.json,
+# rewritten as each sample completes and deleted once the results
+# are stored, so the client can show the matrix as it fills in.
+#
+# The per-sample co-occurrence (Gram) matrices of compute id 4 are
+# cached in LTSvsSTS-Gram/, keyed by the sample's ETag, markers and
+# thresholds, by compute id 4 and the shared-scan batch worker alike.
+#
+
+import hashlib
+import io
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from ltsvssts import loader
+
+FORMATS = ("json", "npz")
+DEFAULT_FORMAT = "json"
+
+
+def result_format(data):
+  """
+  Returns the result encoding a job's template asked for
+  """
+  name = str(data.get("RESULT_FORMAT", DEFAULT_FORMAT)).lower()
+  if name not in FORMATS:
+    raise Exception("unknown RESULT_FORMAT '" + name + "', expected one of: " + ", ".join(FORMATS))
+  return name
+
+def results_key(bucketkey, name):
+  """
+  S3 key of a job's results, named after its template
+  """
+  stem = os.path.splitext(os.path.basename(bucketkey))[0]
+  return "LTSvsSTS-Result/" + stem + "." + name
+
+def partial_key(bucketkey):
+  """
+  S3 key of a job's partial results while it is processing
+  """
+  stem = os.path.splitext(os.path.basename(bucketkey))[0]
+  return "LTSvsSTS-Result/" + stem + "-partial.json"
+
+def _compact(values):
+  if np.issubdtype(values.dtype, np.integer):
+    info = np.iinfo(np.int32)
+    if values.size == 0 or (values.min() >= info.min and values.max() <= info.max):
+      return values.astype(np.int32)
+    return values
+  return values.astype(np.float32)
+
+def encode_matrix(df, name):
+  """
+  Returns the bytes of a result matrix in the given encoding
+  """
+  if name == "json":
+    return df.to_json(orient='index').encode('utf-8')
+
+  buffer = io.BytesIO()
+  np.savez_compressed(buffer,
+                      rows=np.array([str(row) for row in df.index]),
+                      columns=np.array([str(col) for col in df.columns]),
+                      values=_compact(df.to_numpy()))
+  return buffer.getvalue()
+
+def decode_matrix(body):
+  """
+  Returns the DataFrame of an npz result
+  """
+  with np.load(io.BytesIO(body), allow_pickle=False) as npz:
+    return pd.DataFrame(npz['values'], index=list(npz['rows']), columns=list(npz['columns']))
+
+
+class PartialResults:
+  """
+  The columns of a job's matrix completed so far, published to S3
+  each time a sample is added
+  """
+
+  def __init__(self, s3_client, bucket, bucketkey, row_names, total):
+    self.s3_client = s3_client
+    self.bucket = bucket
+    self.key = partial_key(bucketkey)
+    self.row_names = [str(row) for row in row_names]
+    self.total = total
+    self.completed = []
+    self.columns = {}
+
+  def add(self, sample, values):
+    """
+    Records a completed sample's column and publishes the partial
+    matrix, in the order the samples completed
+    """
+    self.completed.append(sample)
+    self.columns[sample] = np.asarray(values).tolist()
+    body = {
+      "completed": self.completed,
+      "total": self.total,
+      "results": {row: {sample: self.columns[sample][i] for sample in self.completed}
+                  for i, row in enumerate(self.row_names)}
+    }
+    self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=json.dumps(body))
+
+
+####
+#
+# per-sample co-occurrence (Gram) matrices
+#
+
+def gram_key(file_key, etag, markers, thresholds):
+  """
+  S3 key of a sample's co-occurrence (Gram) matrix, which depends
+  on the sample's contents and the markers and thresholds used
+  """
+  spec = json.dumps([etag.strip('"'), markers, [thresholds[marker] for marker in markers]])
+  digest = hashlib.sha1(spec.encode('utf-8')).hexdigest()[:16]
+  return "LTSvsSTS-Gram/" + loader.sample_name(file_key) + "-" + digest + ".npz"
+
+def load_gram(s3_client, bucket, key):
+  """
+  Returns the cached (gram, cells) of a sample, or None
+  """
+  try:
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+  except s3_client.exceptions.NoSuchKey:
+    return None
+  with np.load(io.BytesIO(body)) as npz:
+    print("Loaded co-occurrence matrix:", key)
+    return npz['gram'], int(npz['cells'])
+
+def store_gram(s3_client, bucket, key, gram, cells, markers):
+  buffer = io.BytesIO()
+  np.savez(buffer, gram=gram, cells=np.array(cells), markers=np.array(markers))
+  s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
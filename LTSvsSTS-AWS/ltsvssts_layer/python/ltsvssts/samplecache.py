@@ -0,0 +1,233 @@
+#
+# samplecache.py
+#
+# Local disk cache of decoded samples in /tmp, kept across warm
+# invocations of a compute lambda. Each sample is a directory keyed
+# by its S3 key and ETag holding one memory-mappable .npy file per
+# column, so a repeat job reads the arrays back instead of
+# downloading and parsing the CSV. On a miss the columnar .npz
+# written at ingest is used when it matches the CSV's ETag, otherwise
+# the columns a job needs are parsed from the CSV and added to the
+# entry. Both are fetched with concurrent ranged GETs (download.py);
+# a compressed CSV (compression.py) is parsed while it decompresses.
+#
+# The cache is bounded in bytes (a fraction of the function's
+# ephemeral storage) and evicts least recently used samples.
+# Every file is written to a temporary name and renamed into place,
+# so a timed-out invocation never leaves a partial entry behind.
+#
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+
+from ltsvssts import compression
+from ltsvssts import download
+from ltsvssts import loader
+from ltsvssts import timing
+
+
+class SampleCache:
+
+  def __init__(self, directory, max_bytes, downloader=None):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.downloader = downloader or download.RangedDownloader()
+    self.hits = 0
+    self.misses = 0
+    os.makedirs(self.directory, exist_ok=True)
+
+  def _entry(self, file_key, etag):
+    digest = hashlib.sha1(file_key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(self.directory, digest + "-" + etag.strip('"'))
+
+  def _column_file(self, entry, columns, col):
+    return os.path.join(entry, columns[col])
+
+  def _read_index(self, entry):
+    try:
+      with open(os.path.join(entry, "columns.json"), "r") as f:
+        return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+      return {}
+
+  def _write_atomic(self, path, write):
+    tmp = path + "." + uuid.uuid4().hex + ".tmp"
+    try:
+      write(tmp)
+      os.replace(tmp, path)
+    finally:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+  def evict(self, incoming_bytes=0, keep=None):
+    """
+    Removes least recently used entries until incoming_bytes more
+    would fit; the entry being filled (keep) is never evicted
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      if not os.path.isdir(path):
+        continue
+      size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+      entries.append((os.path.getmtime(path), path, size))
+      total += size
+
+    for mtime, path, size in sorted(entries):
+      if total + incoming_bytes <= self.max_bytes:
+        break
+      if path == keep:
+        continue
+      print("sample cache: evicting", path, size, "bytes")
+      shutil.rmtree(path, ignore_errors=True)
+      total -= size
+
+    return total + incoming_bytes <= self.max_bytes
+
+  def load(self, s3_client, bucket, file_key, columns):
+    """
+    Returns the sample's columns as a DataFrame, from the cache when
+    every column is present for the object's current ETag, otherwise
+    by downloading and parsing the missing columns
+    """
+    sample = loader.sample_name(file_key)
+    with timing.stage("s3_head", sample):
+      head = s3_client.head_object(Bucket=bucket, Key=file_key)
+    etag = head['ETag']
+    entry = self._entry(file_key, etag)
+    index = self._read_index(entry)
+
+    missing = [col for col in columns if col not in index]
+    if len(missing) == 0:
+      self.hits += 1
+      print("sample cache: hit", file_key)
+      # touch the entry so it becomes most recently used
+      os.utime(entry, None)
+      with timing.stage("cache_read", sample):
+        arrays = {col: np.load(self._column_file(entry, index, col), mmap_mode='r') for col in columns}
+        return pd.DataFrame(arrays)
+
+    self.misses += 1
+    print("sample cache: miss", file_key, "-", len(missing), "columns not cached")
+
+    with timing.stage("columnar_load", sample):
+      df = load_columnar(s3_client, bucket, file_key, etag, missing, self.downloader)
+    if df is not None:
+      # the npz has every column, the cached ones are kept as they are
+      df = df[missing]
+    else:
+      with timing.stage("s3_get", sample):
+        body = self.downloader.fetch(s3_client, bucket, file_key, head['ContentLength'], etag)
+      with timing.stage("csv_parse", sample):
+        source = compression.sample_source(body, file_key, head.get('ContentEncoding'))
+        df = loader.load_sample(source, missing, file_key)
+        del source
+      del body
+
+    with timing.stage("cache_write", sample):
+      self._store(entry, index, df)
+
+    if len(missing) == len(columns):
+      return df[columns]
+
+    arrays = {col: np.load(self._column_file(entry, index, col), mmap_mode='r')
+              for col in columns if col not in missing}
+    for col in missing:
+      arrays[col] = df[col].to_numpy()
+    return pd.DataFrame(arrays)[columns]
+
+  def _store(self, entry, index, df):
+    incoming = int(df.memory_usage(index=False).sum())
+    os.makedirs(entry, exist_ok=True)
+    if not self.evict(incoming, keep=entry):
+      print("sample cache: not enough space to cache", entry)
+      return
+
+    # named after the column, so a column added to an entry never
+    # overwrites another one's file
+    for col in df.columns:
+      name = _column_name(col)
+      self._write_atomic(os.path.join(entry, name), _save_array(df[col].to_numpy()))
+      index[col] = name
+
+    self._write_atomic(os.path.join(entry, "columns.json"), _save_json(index))
+    os.utime(entry, None)
+
+  def reset_stats(self):
+    self.hits = 0
+    self.misses = 0
+
+  def report(self):
+    total = self.hits + self.misses
+    rate = (100.0 * self.hits / total) if total > 0 else 0.0
+    return f"sample cache: {self.hits} hits, {self.misses} misses, hit rate {rate:.1f}%"
+
+
+def load_columnar(s3_client, bucket, file_key, etag, columns, downloader):
+  """
+  Returns every column of the sample's columnar derivative, or None
+  if it does not exist, is stale, or lacks one of the columns
+  """
+  key = "LTSvsSTS-Columnar/" + loader.sample_name(file_key) + ".npz"
+  try:
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+  except s3_client.exceptions.ClientError as err:
+    if err.response.get('Error', {}).get('Code') in ("404", "NoSuchKey"):
+      return None
+    raise
+
+  body = downloader.fetch(s3_client, bucket, key, head['ContentLength'], head['ETag'])
+  with np.load(download.BufferReader(body)) as npz:
+    if str(npz['__etag__']) != etag.strip('"'):
+      print("sample cache:", key, "is stale, parsing", file_key)
+      return None
+    names = [name for name in npz.files if name != '__etag__']
+    if any(col not in names for col in columns):
+      return None
+    print("sample cache: loaded", file_key, "from", key)
+    return pd.DataFrame({name: npz[name] for name in names})
+
+def _column_name(col):
+  return hashlib.sha1(col.encode('utf-8')).hexdigest()[:16] + ".npy"
+
+def _save_array(values):
+  def write(path):
+    with open(path, "wb") as f:
+      np.save(f, values)
+  return write
+
+def _save_json(index):
+  def write(path):
+    with open(path, "w") as f:
+      json.dump(index, f)
+  return write
+
+
+###################################################################
+#
+# get_cache:
+#
+# Returns the cache shared by every invocation of this container,
+# sized as a fraction of the /tmp ephemeral storage and downloading
+# with the [download] settings. The hit/miss counters restart for
+# each job.
+#
+_cache = None
+
+def get_cache(configur):
+  global _cache
+  if _cache is None:
+    directory = configur.get('cache', 'directory', fallback='/tmp/ltsvssts-cache')
+    fraction = configur.getfloat('cache', 'fraction', fallback=0.75)
+    os.makedirs(directory, exist_ok=True)
+    max_bytes = int(shutil.disk_usage(directory).total * fraction)
+    print("sample cache:", directory, max_bytes, "bytes")
+    _cache = SampleCache(directory, max_bytes, download.get_downloader(configur))
+  _cache.reset_stats()
+  return _cache
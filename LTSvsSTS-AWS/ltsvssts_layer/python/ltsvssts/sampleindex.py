@@ -0,0 +1,277 @@
+#
+# sampleindex.py
+#
+# Index of the header of every ingested sample: its columns and cell
+# count, with its status and ETag, taken from the manifests
+# ltsvssts_ingest writes (LTSvsSTS-Manifest/<sample>.json). The
+# index is stored as one object, LTSvsSTS-Index/samples.json, and
+# kept in memory across warm invocations. The samples table says
+# which entries are current: a sample's manifest is read again only
+# when its ETag or status there changed, so once the index is built
+# checking a template costs one query and no S3 reads.
+#
+# check_template validates a template's THRESHOLDS, PHENOTYPES and
+# SWEEP against the index, and the cohorts of the samples from the
+# samples table, so ltsvssts_upload rejects a job that would fail in
+# compute (a misspelled marker, a sample that is not ingested or has
+# no cohort) before creating it.
+#
+
+import difflib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from ltsvssts import datatier
+from ltsvssts import loader
+from ltsvssts import phenotypes
+from ltsvssts import registry
+
+INDEX_KEY = "LTSvsSTS-Index/samples.json"
+
+# compute ids whose handlers read PHENOTYPES, and those of them that
+# evaluate the phenotypes on the samples
+PHENOTYPE_IDS = (1, 2, 3, 4, 6, 7)
+EVALUATED_PHENOTYPE_IDS = (1, 2, 6, 7)
+
+# compute ids comparing the LTS and STS cohorts, and the sweep
+COHORT_IDS = (4, 6, 7)
+SWEEP_ID = 5
+
+_index = None
+
+
+def manifest_key(file_key):
+  return "LTSvsSTS-Manifest/" + loader.sample_name(file_key) + ".json"
+
+def _entry(manifest):
+  return {
+    "etag": manifest["etag"],
+    "status": manifest["status"],
+    "errors": manifest.get("errors", []),
+    "cells": manifest.get("cells", 0),
+    "columns": manifest.get("columns", [])
+  }
+
+def _read_json(s3_client, bucket, key):
+  try:
+    return json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+  except s3_client.exceptions.NoSuchKey:
+    return None
+
+
+###################################################################
+#
+# get_index:
+#
+# Returns the index, a dict of datafilekey -> {"etag", "status",
+# "errors", "cells", "columns", "cohort"} for every sample in the
+# samples table that has a manifest, rebuilding the entries that are
+# stale and storing the index again if any were. The cohort is taken
+# from the same query every time, since setting it does not change
+# the sample's ETag.
+#
+def get_index(s3_client, bucket, dbConn, max_workers=16):
+  global _index
+
+  sql = "SELECT datafilekey, etag, status, cohort FROM samples;"
+  rows = datatier.retrieve_all_rows(dbConn, sql)
+  samples = {row[0]: (row[1], row[2]) for row in rows}
+  cohorts = {row[0]: row[3] for row in rows}
+
+  index = _index
+  if index is None:
+    index = _read_json(s3_client, bucket, INDEX_KEY) or {}
+
+  def current(file_key):
+    etag, status = samples[file_key]
+    entry = index.get(file_key)
+    return entry is not None and entry["etag"] == etag and (entry["status"] == "ready") == (status == "ready")
+
+  stale = [file_key for file_key in samples if not current(file_key)]
+  removed = [file_key for file_key in index if file_key not in samples]
+
+  if len(stale) > 0 or len(removed) > 0:
+    print("sample index:", len(stale), "stale,", len(removed), "removed of", len(samples), "samples")
+    index = {file_key: entry for file_key, entry in index.items() if file_key in samples}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      manifests = executor.map(lambda file_key: _read_json(s3_client, bucket, manifest_key(file_key)), stale)
+      for file_key, manifest in zip(stale, manifests):
+        if manifest is None:
+          index.pop(file_key, None)
+        else:
+          index[file_key] = _entry(manifest)
+    s3_client.put_object(Bucket=bucket, Key=INDEX_KEY, Body=json.dumps(index))
+
+  for file_key, entry in index.items():
+    entry["cohort"] = cohorts[file_key]
+
+  _index = index
+  return index
+
+
+def _suggest(name, names):
+  """
+  Returns " (did you mean X?)" for the closest of names, or ""
+  """
+  by_case = {other.lower(): other for other in names}
+  if name.lower() in by_case:
+    return " (did you mean " + by_case[name.lower()] + "?)"
+  close = difflib.get_close_matches(name, names, n=1, cutoff=0.75)
+  return " (did you mean " + close[0] + "?)" if len(close) > 0 else ""
+
+def _samples(file_keys):
+  return ", ".join(loader.sample_name(file_key) for file_key in file_keys)
+
+def _number(value):
+  try:
+    float(value)
+    return not isinstance(value, bool)
+  except (TypeError, ValueError):
+    return False
+
+def _check_sweep(sweep, markers):
+  """
+  Returns the errors of a SWEEP entry for the swept markers, in the
+  three forms ltsvssts_compute5 accepts
+  """
+  if isinstance(sweep, dict) and "STEP" in sweep:
+    if not all(_number(sweep.get(name)) for name in ["START", "STOP", "STEP"]):
+      return ["SWEEP: START, STOP and STEP must be numbers"]
+    if float(sweep["STEP"]) <= 0:
+      return ["SWEEP: STEP must be positive"]
+    return []
+
+  if isinstance(sweep, list):
+    sweep = {marker: sweep for marker in markers}
+  elif not isinstance(sweep, dict):
+    return ["SWEEP must be a list of thresholds, a dict of marker -> thresholds, or START/STOP/STEP"]
+
+  errors = []
+  missing = [marker for marker in markers if marker not in sweep]
+  if len(missing) > 0:
+    errors.append("SWEEP: no thresholds for markers: " + ", ".join(missing))
+  for marker in markers:
+    thresholds = sweep.get(marker, [])
+    if not isinstance(thresholds, list) or not all(_number(thr) for thr in thresholds):
+      errors.append("SWEEP: thresholds of " + marker + " must be a list of numbers")
+  return errors
+
+
+###################################################################
+#
+# check_template:
+#
+# Returns the errors that would fail a job of the given compute id
+# with this template, an empty list if there are none. Each column
+# a template names must be a column of every sample it is used for;
+# a misspelled name is reported once with the samples it is missing
+# from and the closest column.
+#
+def check_template(index, computeid, data):
+  if not isinstance(data, dict):
+    return ["template is not a JSON object"]
+
+  thresholddict = data.get('THRESHOLDS')
+  if not isinstance(thresholddict, dict) or len(thresholddict) == 0:
+    return ["THRESHOLDS must map each sample to its marker thresholds"]
+
+  errors = []
+  samples = {}
+  for file_key, thresholds in thresholddict.items():
+    entry = index.get(file_key)
+    if entry is None:
+      errors.append("THRESHOLDS: no ingested sample " + file_key + _suggest(file_key, list(index.keys())))
+    elif entry["status"] != "ready":
+      errors.append("THRESHOLDS: sample " + file_key + " is invalid: " + "; ".join(entry["errors"]))
+    elif entry["cells"] == 0:
+      errors.append("THRESHOLDS: sample " + file_key + " has no cells")
+    elif not isinstance(thresholds, dict):
+      errors.append("THRESHOLDS: " + file_key + " must map markers to thresholds")
+    else:
+      samples[file_key] = entry
+
+  # markers missing from samples, in first-seen order
+  missing = {}
+  for file_key, entry in samples.items():
+    columns = set(entry["columns"])
+    for marker, threshold in thresholddict[file_key].items():
+      if marker not in columns:
+        missing.setdefault(marker, []).append(file_key)
+        continue
+      try:
+        float(threshold)
+      except (TypeError, ValueError):
+        errors.append("THRESHOLDS: " + file_key + ": threshold of " + marker + " is not a number")
+
+  for marker, file_keys in missing.items():
+    columns = samples[file_keys[0]]["columns"]
+    errors.append("THRESHOLDS: no column " + marker + " in " + str(len(file_keys)) + " sample(s): "
+                  + _samples(file_keys) + _suggest(marker, columns))
+
+  # compute ids 4, 6 and 7 split the samples by cohort
+  if computeid in COHORT_IDS and len(samples) > 0:
+    file_keys = [file_key for file_key, entry in samples.items() if entry.get("cohort") not in registry.COHORTS]
+    if len(file_keys) > 0:
+      errors.append("THRESHOLDS: no LTS or STS cohort for " + str(len(file_keys)) + " sample(s): "
+                    + _samples(file_keys) + " (check the cohort column of the samples table)")
+    else:
+      for cohort in registry.COHORTS:
+        if not any(entry["cohort"] == cohort for entry in samples.values()):
+          errors.append("THRESHOLDS: no " + cohort + " samples in the job")
+
+  # compute id 5 sweeps the markers of the first sample in every sample
+  if computeid == SWEEP_ID and len(samples) == len(thresholddict):
+    markers = list(thresholddict[next(iter(thresholddict))].keys())
+    for marker in markers:
+      file_keys = [file_key for file_key, entry in samples.items() if marker not in entry["columns"]]
+      if len(file_keys) > 0 and marker not in missing:
+        errors.append("SWEEP: no column " + marker + " in " + str(len(file_keys)) + " sample(s): "
+                      + _samples(file_keys) + _suggest(marker, samples[file_keys[0]]["columns"]))
+    if 'SWEEP' in data:
+      errors += _check_sweep(data['SWEEP'], markers)
+
+  if computeid not in PHENOTYPE_IDS:
+    return errors
+
+  phenotypedict = data.get('PHENOTYPES')
+  if not isinstance(phenotypedict, dict):
+    errors.append("PHENOTYPES must map each phenotype to its definition")
+    return errors
+  if computeid not in EVALUATED_PHENOTYPE_IDS:
+    return errors
+
+  # a phenotype column without a threshold is read from the sample
+  # as is (analysis.py), positive where it is non-zero. That suits a
+  # 0/1 column, but any raw intensity is non-zero, so a marker
+  # (*_R) must have a threshold in every sample
+  for name, definition in phenotypedict.items():
+    try:
+      columns = phenotypes.compile_phenotypes({name: definition}).columns()
+    except Exception as err:
+      errors.append("PHENOTYPES: " + str(err))
+      continue
+
+    for col in columns:
+      file_keys = [file_key for file_key, entry in samples.items() if col not in entry["columns"]]
+      if len(file_keys) > 0:
+        errors.append("PHENOTYPES: " + name + ": no column " + col + " in " + str(len(file_keys)) + " sample(s): "
+                      + _samples(file_keys) + _suggest(col, samples[file_keys[0]]["columns"]))
+        continue
+      if col.endswith(loader.MARKER_SUFFIX):
+        file_keys = [file_key for file_key in samples if col not in thresholddict[file_key]]
+        if len(file_keys) > 0:
+          errors.append("PHENOTYPES: " + name + ": marker " + col + " has no threshold in " + str(len(file_keys))
+                        + " sample(s): " + _samples(file_keys))
+
+  # compute id 6 reads DISTANCES metrics that NEAREST does not compute
+  if computeid == 6:
+    nearestdict = data.get('NEAREST', {})
+    for metric in data.get('DISTANCES', {}):
+      if metric in nearestdict:
+        continue
+      file_keys = [file_key for file_key, entry in samples.items() if metric not in entry["columns"]]
+      if len(file_keys) > 0:
+        errors.append("DISTANCES: no column " + metric + " in " + str(len(file_keys)) + " sample(s): "
+                      + _samples(file_keys) + _suggest(metric, samples[file_keys[0]]["columns"]))
+
+  return errors
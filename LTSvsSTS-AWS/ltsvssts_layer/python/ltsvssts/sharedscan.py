@@ -0,0 +1,195 @@
+#
+# sharedscan.py
+#
+# Runs a batch of queued compute id 1, 2 and 4 jobs (jobqueue.py)
+# with one scan of their samples. Every sample any job needs is
+# loaded once, with the union of the columns the jobs read, and each
+# job that includes the sample evaluates its own thresholds and
+# phenotypes (or co-occurrence) on that same DataFrame, so the S3
+# reads of a batch grow with its samples, not with jobs x samples.
+#
+# Compute id 1 and 2 jobs end with their result matrix. Compute id 4
+# jobs end with every sample's Gram matrix in the S3 cache
+# (results.gram_key), where compute id 4 then finds them without
+# reading a CSV. A job that fails is dropped from the rest of the
+# scan and the others carry on. The next samples are loaded while the
+# current one is evaluated (prefetch.py).
+#
+
+import numpy as np
+import pandas as pd
+
+from ltsvssts import jobqueue
+from ltsvssts import loader
+from ltsvssts import phenotypes
+from ltsvssts import prefetch
+from ltsvssts import registry
+from ltsvssts import results
+from ltsvssts import timing
+
+
+class ScanJob:
+  """
+  A queued job: its template, the samples it reads (in template
+  order) and the columns it reads from them
+  """
+
+  def __init__(self, computeid, bucketkey, data, filelist, columns, backend):
+    self.computeid = computeid
+    self.bucketkey = bucketkey
+    self.data = data
+    self.filelist = filelist
+    self.columns = columns
+    self.backend = backend
+    self.pending = set(filelist)
+    self.done = 0
+    self.error = None
+
+  def needs(self, file_key):
+    return self.error is None and file_key in self.pending
+
+  def evaluate(self, file_key, df):
+    raise NotImplementedError
+
+
+class PhenotypeJob(ScanJob):
+  """
+  Compute id 1 (phenotype counts) or 2 (phenotypes as a percentage
+  of the sample's cells)
+  """
+
+  def __init__(self, computeid, bucketkey, data, filelist, backend):
+    self.program = phenotypes.compile_phenotypes(data['PHENOTYPES'])
+    columns = loader.job_columns(data['THRESHOLDS'], self.program.columns())
+    super().__init__(computeid, bucketkey, data, filelist, columns, backend)
+    self.row_names = list(data['PHENOTYPES'].keys())
+    dtype = np.int64 if computeid == 1 else np.float64
+    self.matrix = np.zeros((len(self.row_names), len(filelist)), dtype=dtype)
+
+  def evaluate(self, file_key, df):
+    j = self.filelist.index(file_key)
+    positive = self.backend.threshold(df, self.data['THRESHOLDS'][file_key])
+    file_counts = self.backend.count_phenotypes(positive, self.program)
+    if self.computeid == 1:
+      self.matrix[:, j] = file_counts
+    else:
+      self.matrix[:, j] = np.array(file_counts) / len(df.index) * 100
+    return self.matrix[:, j]
+
+  def dataframe(self):
+    column_names = [loader.sample_name(file_key) for file_key in self.filelist]
+    return pd.DataFrame(self.matrix, index=self.row_names, columns=column_names)
+
+
+class GramJob(ScanJob):
+  """
+  Compute id 4: stores each sample's Gram matrix for the job's
+  markers and thresholds, skipping samples already in the cache
+  """
+
+  def __init__(self, bucketkey, data, filelist, backend):
+    any_file = list(data['THRESHOLDS'].keys())[0]
+    self.markers = list(data['THRESHOLDS'][any_file].keys())
+    super().__init__(4, bucketkey, data, filelist, self.markers, backend)
+    self.keys = {}
+
+  def plan(self, s3_client, bucket):
+    """
+    Drops the samples whose Gram matrix is already cached
+    """
+    self.s3_client = s3_client
+    self.bucket = bucket
+    for file_key in self.filelist:
+      etag = s3_client.head_object(Bucket=bucket, Key=file_key)['ETag']
+      key = results.gram_key(file_key, etag, self.markers, self.data['THRESHOLDS'][file_key])
+      try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+        self.pending.discard(file_key)
+      except s3_client.exceptions.ClientError as err:
+        if err.response.get('Error', {}).get('Code') not in ("404", "NoSuchKey"):
+          raise
+      self.keys[file_key] = key
+
+  def evaluate(self, file_key, df):
+    thresholds = self.data['THRESHOLDS'][file_key]
+    gram = self.backend.co_occurrence(self.backend.threshold(df, thresholds), self.markers)
+    cells = len(df.index)
+    results.store_gram(self.s3_client, self.bucket, self.keys[file_key], gram, cells, self.markers)
+    return gram, cells
+
+
+def make_job(s3_client, bucket, dbConn, bucketkey, data, backend):
+  """
+  Returns the ScanJob of a template, checking its samples against
+  the registry as the compute functions do
+  """
+  computeid = jobqueue.compute_id(bucketkey)
+  if computeid not in jobqueue.SHARED_COMPUTE_IDS:
+    raise Exception("compute id " + str(computeid) + " is not run by the shared-scan worker")
+
+  thresholddict = data['THRESHOLDS']
+  if computeid in (1, 2):
+    filelist = registry.job_files(dbConn, list(thresholddict.keys()))
+    return PhenotypeJob(computeid, bucketkey, data, filelist, backend)
+
+  registry.job_files(dbConn, list(thresholddict.keys()))
+  cohorts = registry.cohort_files(dbConn, thresholddict)
+  for cohort in ["LTS", "STS"]:
+    if cohort not in cohorts:
+      raise Exception("no " + cohort + " samples in the job (check the cohort column of the samples table)")
+
+  job = GramJob(bucketkey, data, cohorts["LTS"] + cohorts["STS"], backend)
+  job.plan(s3_client, bucket)
+  return job
+
+
+###################################################################
+#
+# scan:
+#
+# Loads every sample a job still needs once, in the order the
+# samples first appear in the jobs, and evaluates every such job on
+# it, with up to prefetch_depth samples loaded ahead (prefetch.py).
+# on_sample(job, file_key, value) is called after each evaluation,
+# with the job's result for the sample. A sample that fails to load
+# fails the jobs that need it. Returns the number of samples loaded.
+#
+def scan(s3_client, bucket, jobs, cache, on_sample=None, prefetch_depth=0):
+  # planned up front, the producer thread does not look at the jobs
+  plan = {}
+  for job in jobs:
+    for file_key in job.filelist:
+      if job.needs(file_key):
+        plan.setdefault(file_key, []).append(job)
+
+  def load(file_key):
+    columns = loader.job_columns(None, [col for job in plan[file_key] for col in job.columns])
+    try:
+      return cache.load(s3_client, bucket, file_key, columns), None
+    except Exception as err:
+      return None, err
+
+  loaded = 0
+  for file_key, (df, load_error) in prefetch.prefetched(load, list(plan.keys()), prefetch_depth):
+    waiting = [job for job in plan[file_key] if job.needs(file_key)]
+    print(f"Processing file: {file_key} for {len(waiting)} job(s)")
+    if load_error is not None:
+      for job in waiting:
+        job.error = "loading " + file_key + " failed: " + str(load_error)
+      continue
+    loaded += 1
+
+    sample = loader.sample_name(file_key)
+    for job in waiting:
+      try:
+        with timing.stage("evaluate", sample):
+          value = job.evaluate(file_key, df)
+        job.pending.discard(file_key)
+        job.done += 1
+        if on_sample is not None:
+          on_sample(job, file_key, value)
+      except Exception as err:
+        job.error = str(err)
+    del df
+
+  return loaded
@@ -0,0 +1,168 @@
+#
+# stats.py
+#
+# Two-group tests run on every row of a (features x samples) matrix
+# at once: a Wilcoxon rank-sum test from ranks computed for all rows
+# in one sort, and a permutation test on the difference of group
+# means (or another statistic of the group sums) where each batch of
+# label permutations is one matrix product. Permutation batches are
+# spread over worker processes.
+# P-values are corrected for multiple testing with Benjamini-Hochberg.
+#
+
+import math
+import numpy as np
+
+from ltsvssts import workers
+
+# permutations evaluated per matrix product, bounds the (rows x
+# batch) array of permuted statistics
+PERMUTATION_BATCH = 1000
+
+# permuted statistics this close to the observed one count as equal,
+# so rounding in the matrix product cannot hide ties
+TOLERANCE = 1e-12
+
+
+###################################################################
+#
+# average_ranks:
+#
+# Ranks the values of each row (1 = smallest), ties getting the
+# average of their ranks. Also returns the tie correction term
+# sum(t^3 - t) over the tie groups of each row.
+#
+def average_ranks(values):
+  rows, n = values.shape
+  order = np.argsort(values, axis=1, kind='stable')
+  ordered = np.take_along_axis(values, order, axis=1)
+
+  # number the tie groups of every row so they are distinct overall
+  starts = np.ones((rows, n), dtype=bool)
+  starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+  groups = (np.cumsum(starts, axis=1) - 1 + (np.arange(rows) * n)[:, None]).ravel()
+
+  positions = np.tile(np.arange(1, n + 1, dtype=float), rows)
+  sizes = np.bincount(groups, minlength=rows * n)
+  totals = np.bincount(groups, weights=positions, minlength=rows * n)
+
+  ranks = np.empty((rows, n))
+  np.put_along_axis(ranks, order, (totals[groups] / sizes[groups]).reshape(rows, n), axis=1)
+
+  sizes = sizes.reshape(rows, n).astype(float)
+  ties = (sizes ** 3 - sizes).sum(axis=1)
+
+  return ranks, ties
+
+def rank_sum_test(values, in_group):
+  """
+  Two-sided Wilcoxon rank-sum (Mann-Whitney U) test of every row,
+  group 1 being the columns where in_group is True. Uses the normal
+  approximation with tie and continuity correction; returns U of
+  group 1 and the p-values.
+  """
+  n1 = int(np.count_nonzero(in_group))
+  n2 = len(in_group) - n1
+  n = n1 + n2
+
+  ranks, ties = average_ranks(values)
+  u = ranks[:, in_group].sum(axis=1) - n1 * (n1 + 1) / 2.0
+
+  mean = n1 * n2 / 2.0
+  sd = np.sqrt(n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1))))
+
+  delta = np.abs(u - mean) - 0.5
+  with np.errstate(divide='ignore', invalid='ignore'):
+    z = np.where(sd > 0, np.maximum(delta, 0) / sd, 0.0)
+
+  pvalues = np.array([math.erfc(v / math.sqrt(2.0)) for v in z])
+  return u, pvalues
+
+def mean_difference(values, in_group):
+  return values[:, in_group].mean(axis=1) - values[:, ~in_group].mean(axis=1)
+
+def sum_mean_difference(sums, other_sums, n1, n2):
+  """
+  Difference of group means from the (rows x labelings) sums of
+  each group
+  """
+  return sums / n1 - other_sums / n2
+
+def _permutation_exceedances(values, in_group, permutations, seed, observed, statistic):
+  """
+  Counts, per row, the random label permutations whose absolute
+  statistic is at least the observed one
+  """
+  rng = np.random.default_rng(seed)
+  n1 = int(np.count_nonzero(in_group))
+  n2 = len(in_group) - n1
+  totals = values.sum(axis=1)[:, None]
+  threshold = np.abs(observed)[:, None] - TOLERANCE
+
+  exceed = np.zeros(values.shape[0], dtype=np.int64)
+  done = 0
+  while done < permutations:
+    batch = min(PERMUTATION_BATCH, permutations - done)
+    labels = rng.permuted(np.tile(in_group, (batch, 1)), axis=1).astype(values.dtype)
+    sums = values @ labels.T
+    differences = statistic(sums, totals - sums, n1, n2)
+    exceed += np.count_nonzero(np.abs(differences) >= threshold, axis=1)
+    done += batch
+
+  return exceed
+
+
+###################################################################
+#
+# permutation_test:
+#
+# Two-sided permutation test of the difference of group means for
+# every row, sharing the same label permutations across rows. The
+# permutations are split over num_workers processes, each with its
+# own independent random stream. Returns the observed differences
+# and p-values (1 + exceedances) / (1 + permutations).
+#
+# statistic(sums, other_sums, n1, n2) replaces the mean difference:
+# it maps the (rows x labelings) sums of the two groups to one
+# statistic per row and labeling, and must be a module-level
+# function so the worker processes can run it.
+#
+def permutation_test(values, in_group, permutations, num_workers, seed=None, statistic=None):
+  values = np.asarray(values, dtype=np.float64)
+  in_group = np.asarray(in_group, dtype=bool)
+  if statistic is None:
+    statistic = sum_mean_difference
+    observed = mean_difference(values, in_group)
+  else:
+    sums = values[:, in_group].sum(axis=1)[:, None]
+    n1 = int(np.count_nonzero(in_group))
+    observed = statistic(sums, values.sum(axis=1)[:, None] - sums, n1, len(in_group) - n1)[:, 0]
+
+  num_workers = max(1, min(num_workers, permutations // PERMUTATION_BATCH))
+  shares = [permutations // num_workers + (1 if i < permutations % num_workers else 0)
+            for i in range(num_workers)]
+  seeds = np.random.SeedSequence(seed).spawn(num_workers)
+
+  tasks = [(values, in_group, share, child, observed, statistic) for share, child in zip(shares, seeds)]
+  exceed = sum(workers.run_parallel(_permutation_exceedances, tasks))
+
+  return observed, (1.0 + exceed) / (1.0 + permutations)
+
+def fdr_bh(pvalues):
+  """
+  Benjamini-Hochberg adjusted p-values (q-values); NaN p-values are
+  left out of the correction and stay NaN
+  """
+  pvalues = np.asarray(pvalues, dtype=float)
+  qvalues = np.full(pvalues.shape, np.nan)
+
+  valid = np.flatnonzero(~np.isnan(pvalues))
+  m = len(valid)
+  if m == 0:
+    return qvalues
+
+  order = valid[np.argsort(pvalues[valid], kind='stable')]
+  scaled = pvalues[order] * m / np.arange(1, m + 1)
+  qvalues[order] = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1.0)
+
+  return qvalues
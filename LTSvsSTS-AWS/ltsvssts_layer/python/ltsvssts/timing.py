@@ -0,0 +1,120 @@
+#
+# timing.py
+#
+# Per-stage timing of a compute job. Each stage is wrapped in
+#
+#   with timing.stage("threshold", sample):
+#       ...
+#
+# which logs one JSON line per execution, e.g.
+#
+#   {"type": "timing", "job": "...", "stage": "threshold", "sample": "NU00295", "seconds": 0.0123}
+#
+# and adds the time to the job's totals. summary() returns the
+# totals per stage and per sample; the handlers store it next to the
+# results as LTSvsSTS-Result/<job>-timing.json. Stages may run on
+# several threads, in which case their times overlap.
+#
+# A listener (see set_listener) is told when each stage starts and
+# ends; memprofile.py uses this to track memory per stage.
+#
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+_lock = threading.Lock()
+_job = None
+_listener = None
+
+
+class _Job:
+
+  def __init__(self, name):
+    self.name = name
+    self.start = time.perf_counter()
+    self.stages = {}
+    self.samples = {}
+
+
+def start_job(name):
+  """
+  Starts timing a new job, discarding the totals of the previous one
+  """
+  global _job
+  _job = _Job(name)
+  print(json.dumps({"type": "timing", "job": name, "event": "start"}))
+
+def set_listener(listener):
+  """
+  Sets the object whose enter(name, sample) and exit(name, sample)
+  are called around every stage, or None
+  """
+  global _listener
+  _listener = listener
+
+def record(name, sample, seconds):
+  job = _job
+  if job is None:
+    return
+
+  with _lock:
+    totals = job.stages.setdefault(name, {"seconds": 0.0, "count": 0})
+    totals["seconds"] += seconds
+    totals["count"] += 1
+    if sample is not None:
+      per_sample = job.samples.setdefault(sample, {})
+      per_sample[name] = per_sample.get(name, 0.0) + seconds
+
+  print(json.dumps({"type": "timing", "job": job.name, "stage": name,
+                    "sample": sample, "seconds": round(seconds, 6)}))
+
+@contextlib.contextmanager
+def stage(name, sample=None):
+  listener = _listener
+  if listener is not None:
+    listener.enter(name, sample)
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    record(name, sample, time.perf_counter() - start)
+    if listener is not None:
+      listener.exit(name, sample)
+
+def timed(name):
+  """
+  Decorator timing every call of a function as the given stage
+  """
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with stage(name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def summary():
+  """
+  Returns the job's total time and its time per stage and per sample
+  """
+  job = _job
+  if job is None:
+    return {}
+
+  with _lock:
+    stages = {name: {"seconds": round(totals["seconds"], 6), "count": totals["count"]}
+              for name, totals in job.stages.items()}
+    samples = {sample: {name: round(seconds, 6) for name, seconds in per_sample.items()}
+               for sample, per_sample in job.samples.items()}
+
+  total = time.perf_counter() - job.start
+  print(json.dumps({"type": "timing", "job": job.name, "event": "end", "seconds": round(total, 6)}))
+
+  return {"job": job.name, "total_seconds": round(total, 6), "stages": stages, "samples": samples}
+
+def timing_key(results_key):
+  return os.path.splitext(results_key)[0] + "-timing.json"
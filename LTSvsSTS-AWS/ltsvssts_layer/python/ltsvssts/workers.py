@@ -0,0 +1,72 @@
+#
+# workers.py
+#
+# Runs independent tasks in separate processes so CPU-bound numpy
+# work can use every core of the function. Lambda provides no
+# /dev/shm, which multiprocessing.Pool and ProcessPoolExecutor need
+# for their queues, so each task gets its own Process and sends its
+# result back through a Pipe.
+#
+
+import multiprocessing
+import os
+
+
+def worker_count(configur):
+  """
+  Returns the number of worker processes from the [compute] section;
+  0 or missing means one per CPU
+  """
+  workers = configur.getint('compute', 'workers', fallback=0)
+  if workers <= 0:
+    workers = os.cpu_count() or 1
+  return workers
+
+def _run(conn, func, args):
+  try:
+    conn.send((True, func(*args)))
+  except Exception as err:
+    conn.send((False, str(err)))
+  finally:
+    conn.close()
+
+
+###################################################################
+#
+# run_parallel:
+#
+# Returns [func(*args) for args in tasks], running each task in its
+# own process. A single task runs in the calling process. Raises if
+# any task raised.
+#
+def run_parallel(func, tasks):
+  if len(tasks) <= 1:
+    return [func(*args) for args in tasks]
+
+  running = []
+  for args in tasks:
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_run, args=(sender, func, args))
+    process.start()
+    sender.close()
+    running.append((process, receiver))
+
+  results = []
+  errors = []
+  for process, receiver in running:
+    # receive before join, a large result would otherwise block the
+    # child on a full pipe
+    try:
+      ok, value = receiver.recv()
+    except EOFError:
+      ok, value = False, "worker process exited without a result"
+    process.join()
+    if ok:
+      results.append(value)
+    else:
+      errors.append(value)
+
+  if len(errors) > 0:
+    raise Exception("worker failed: " + "; ".join(errors))
+
+  return results
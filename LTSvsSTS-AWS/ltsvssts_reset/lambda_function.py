@@ -6,7 +6,7 @@
 import json
 import boto3
 import os
-import datatier
+from ltsvssts import datatier
 
 from configparser import ConfigParser
 
@@ -63,6 +63,9 @@ def lambda_handler(event, context):
       'LTSvsSTS2-Template/',
       'LTSvsSTS3-Template/',
       'LTSvsSTS4-Template/',
+      'LTSvsSTS5-Template/',
+      'LTSvsSTS6-Template/',
+      'LTSvsSTS7-Template/',
       'LTSvsSTS-Result/'
     ]
 
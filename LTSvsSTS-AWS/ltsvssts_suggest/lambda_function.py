@@ -0,0 +1,188 @@
+#
+# Suggests per-sample marker thresholds from the stored intensity
+# histograms in LTSvsSTS-Histogram/. All marker/sample pairs are
+# stacked into one array, each row with the bins of its own
+# intensity range, and fitted in a single vectorized pass,
+# either with Otsu's method or a two-component Gaussian mixture.
+# Returns a THRESHOLDS dictionary in the same shape as the template.
+#
+
+import json
+import boto3
+import os
+import numpy as np
+from io import BytesIO
+
+from configparser import ConfigParser
+
+EM_ITERATIONS = 100
+
+def load_histograms(s3_client, bucket):
+    """
+    Downloads every stored histogram and stacks them into one
+    (pairs x bins) array of counts and a (pairs x bins + 1) array of
+    their bin edges, with a (datafilekey, marker) label per row
+    """
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix="LTSvsSTS-Histogram/"):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith(".npz"):
+                keys.append(obj['Key'])
+
+    if len(keys) == 0:
+        raise Exception("no histograms found in 'LTSvsSTS-Histogram/'")
+
+    labels = []
+    counts = []
+    edges = []
+    for key in sorted(keys):
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        with np.load(BytesIO(body)) as npz:
+            # histograms from before per-marker ranges share one row of edges
+            rows = np.broadcast_to(npz['edges'], (len(npz['markers']), npz['counts'].shape[1] + 1))
+            if len(edges) > 0 and rows.shape[1] != edges[0].shape[1]:
+                raise Exception("histogram '" + key + "' uses a different number of bins, rebuild histograms")
+
+            datafilekey = str(npz['datafilekey'])
+            for marker in npz['markers']:
+                labels.append((datafilekey, str(marker)))
+            counts.append(npz['counts'])
+            edges.append(rows)
+
+    return labels, np.vstack(counts).astype(float), np.vstack(edges).astype(float)
+
+def otsu_thresholds(hist, edges):
+    """
+    Otsu's method for every row of hist at once: picks the bin edge
+    of the row maximizing the between-class variance of the two
+    classes
+    """
+    centers = (edges[:, :-1] + edges[:, 1:]) / 2
+
+    w0 = np.cumsum(hist, axis=1)
+    m0 = np.cumsum(hist * centers, axis=1)
+    w1 = w0[:, -1:] - w0
+    m1 = m0[:, -1:] - m0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = w0 * w1 * (m0 / w0 - m1 / w1) ** 2
+    between[~np.isfinite(between)] = 0
+
+    # class 0 holds bins [0, idx], so positives start at the next edge
+    idx = np.argmax(between, axis=1)
+    return edges[np.arange(len(hist)), idx + 1]
+
+def mixture_thresholds(hist, edges):
+    """
+    Fits a two-component Gaussian mixture to every row of hist with
+    EM on the binned counts, and returns the first bin edge above
+    the low component's mean where the high component is more likely
+    """
+    centers = (edges[:, :-1] + edges[:, 1:]) / 2
+    floor = ((centers[:, 1] - centers[:, 0]) ** 2)[:, None]
+
+    total = hist.sum(axis=1, keepdims=True)
+    total[total == 0] = 1
+    cdf = np.cumsum(hist, axis=1) / total
+
+    # start the components at the 25th and 90th percentiles
+    mu = np.take_along_axis(centers, np.stack([np.argmax(cdf >= 0.25, axis=1),
+                                               np.argmax(cdf >= 0.90, axis=1)], axis=1), axis=1)
+    mean = (hist * centers).sum(axis=1) / total[:, 0]
+    var = (hist * (centers - mean[:, None]) ** 2).sum(axis=1) / total[:, 0] + floor[:, 0]
+    var = np.stack([var, var], axis=1)
+    pi = np.full_like(mu, 0.5)
+
+    for _ in range(EM_ITERATIONS):
+        # E-step: (pairs x components x bins) likelihoods
+        dens = pi[:, :, None] / np.sqrt(2 * np.pi * var[:, :, None]) * \
+               np.exp(-(centers[:, None, :] - mu[:, :, None]) ** 2 / (2 * var[:, :, None]))
+        resp = dens / (dens.sum(axis=1, keepdims=True) + 1e-300)
+
+        # M-step on the bin counts
+        weights = resp * hist[:, None, :]
+        n = weights.sum(axis=2) + 1e-12
+        mu = (weights * centers[:, None, :]).sum(axis=2) / n
+        var = (weights * (centers[:, None, :] - mu[:, :, None]) ** 2).sum(axis=2) / n + floor
+        pi = n / n.sum(axis=1, keepdims=True)
+
+    order = np.argsort(mu, axis=1)
+    high = order[:, 1]
+    low_mu = np.take_along_axis(mu, order[:, :1], axis=1)
+
+    resp_high = resp[np.arange(len(hist)), high, :]
+    positive = (resp_high >= 0.5) & (centers > low_mu)
+
+    idx = np.argmax(positive, axis=1)
+    thresholds = edges[np.arange(len(hist)), idx]
+
+    # no crossover found: fall back to the high component's mean
+    none = ~positive.any(axis=1)
+    thresholds[none] = np.take_along_axis(mu, high[:, None], axis=1)[none, 0]
+
+    return thresholds
+
+METHODS = {"otsu": otsu_thresholds, "mixture": mixture_thresholds}
+
+
+def lambda_handler(event, context):
+  try:
+    print("**STARTING**")
+    print("**lambda: ltsvssts_suggest**")
+
+    # setup AWS based on config file:
+    config_file = 'ltsvsstsapp-config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+
+    configur = ConfigParser()
+    configur.read(config_file)
+
+    # configure for S3 access:
+    s3_profile = 's3readwrite'
+    boto3.setup_default_session(profile_name=s3_profile)
+
+    s3_client = boto3.client('s3')
+    bucketname = configur.get('s3', 'bucket_name')
+
+    # method from event: could be a parameter or
+    # part of the query string, default is otsu:
+    method = "otsu"
+    if "method" in event:
+      method = event["method"]
+    elif event.get("queryStringParameters") and "method" in event["queryStringParameters"]:
+      method = event["queryStringParameters"]["method"]
+
+    if method not in METHODS:
+      raise Exception("invalid method '" + method + "', expecting one of: " + ", ".join(METHODS))
+
+    print("method:", method)
+
+    print("**Loading histograms**")
+    labels, hist, edges = load_histograms(s3_client, bucketname)
+
+    print("**Fitting", len(labels), "marker/sample pairs**")
+    thresholds = METHODS[method](hist, edges)
+
+    thresholddict = {}
+    for (datafilekey, marker), threshold in zip(labels, thresholds):
+      thresholddict.setdefault(datafilekey, {})[marker] = round(float(threshold), 2)
+
+    print("**DONE, returning thresholds**")
+
+    return {
+      'statusCode': 200,
+      'headers': {
+          'Content-Type': 'application/json',
+      },
+      'body': json.dumps({"METHOD": method, "THRESHOLDS": thresholddict})
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
@@ -8,7 +8,7 @@ import json
 import boto3
 import os
 import base64
-import datatier
+from ltsvssts import datatier
 
 from configparser import ConfigParser
 
@@ -1,7 +1,15 @@
 #
 # Uploads a json file to S3 and then inserts a new job record
 # in the LTSvsSTS database with a status of 'uploaded'.
-# Sends the job id back to the client.
+# Sends the job id back to the client. A template naming samples
+# or columns the ingested samples do not have is rejected with
+# status 400 and its errors, before any job is created.
+#
+# A request may carry an idempotency key, generated by the client
+# once per submission, which also names the job's template. A
+# request repeating a key that already has a job returns that job's
+# id, and puts the template only if the first post never did, so a
+# retried post never starts a second compute.
 #
 
 import json
@@ -10,10 +18,30 @@ import os
 import uuid
 import base64
 import pathlib
-import datatier
+import re
+import time
+from ltsvssts import datatier
+from ltsvssts import sampleindex
 
 from configparser import ConfigParser
 
+IDEMPOTENCY_KEY = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def put_template(s3_client, bucketname, bucketkey, template_json):
+    """
+    Puts the template unless its key already has an object, returning
+    whether it did. The put is conditional, so two posts of the same
+    submission never both trigger the compute function
+    """
+    try:
+        s3_client.put_object(Bucket=bucketname, Key=bucketkey, Body=json.dumps(template_json),
+                             ACL='public-read', ContentType='application/json', IfNoneMatch='*')
+        return True
+    except s3_client.exceptions.ClientError as err:
+        if err.response['Error']['Code'] != 'PreconditionFailed':
+            raise
+        return False
+
 def lambda_handler(event, context):
   try:
     print("**STARTING**")
@@ -33,6 +61,7 @@ def lambda_handler(event, context):
     bucketname = configur.get('s3', 'bucket_name')
     
     s3 = boto3.resource('s3')
+    s3_client = boto3.client('s3')
     bucket = s3.Bucket(bucketname)
     
     # configure for RDS access
@@ -81,39 +110,63 @@ def lambda_handler(event, context):
 
     filename = body["filename"]
     template_json = body["data"]
+
+    idempotencykey = body.get("idempotencykey")
+    if idempotencykey is not None and (not isinstance(idempotencykey, str) or
+                                       IDEMPOTENCY_KEY.match(idempotencykey) is None):
+      raise Exception("idempotencykey must be 1-64 letters, digits, '-' or '_'")
     
     print("filename:", filename)
-    print(template_json['THRESHOLDS'])
+    print("idempotency key:", idempotencykey)
+    print(template_json.get('THRESHOLDS'))
 
     # open connection to the database:
     print("**Opening connection**")
     dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    # check the template against the samples' columns and cell
+    # counts, so a job that would fail in compute is never created:
+    if configur.getboolean('upload', 'validate_templates', fallback=True):
+      print("**Checking template**")
+      start = time.perf_counter()
+      index = sampleindex.get_index(s3_client, bucketname, dbConn)
+      errors = sampleindex.check_template(index, int(computeid), template_json)
+      print(f"template checked against {len(index)} samples in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+      if len(errors) > 0:
+        print("**INVALID TEMPLATE**")
+        for error in errors:
+          print(error)
+        return {
+          'statusCode': 400,
+          'body': json.dumps({"message": "invalid template", "errors": errors})
+        }
     
-    # Prepare to store as JSON file locally:
-    print("**Writing local JSON data file**")
     basename = pathlib.Path(filename).stem
     extension = pathlib.Path(filename).suffix
 
     if extension != ".json": 
       raise Exception("expecting filename to have .json extension")
 
-    local_filename = "/tmp/data.json"
-
-    with open(local_filename, "w") as outfile:
-      json.dump(template_json, outfile)
-
-    # generate unique filename in preparation for the S3 upload:
-    print("**Uploading local file to S3**")
+    # generate unique filename in preparation for the S3 upload; a
+    # submission with a key gets the same one on every post:
+    suffix = idempotencykey if idempotencykey is not None else str(uuid.uuid4())
 
-    bucketkey = "LTSvsSTS-Template/" + basename + "-" + str(uuid.uuid4()) + ".json"
+    bucketkey = "LTSvsSTS-Template/" + basename + "-" + suffix + ".json"
     if int(computeid)==1:
-      bucketkey = "LTSvsSTS1-Template/" + basename + "-" + str(uuid.uuid4()) + ".json"
+      bucketkey = "LTSvsSTS1-Template/" + basename + "-" + suffix + ".json"
     elif int(computeid)==2:
-      bucketkey = "LTSvsSTS2-Template/" + basename + "-" + str(uuid.uuid4()) + ".json"
+      bucketkey = "LTSvsSTS2-Template/" + basename + "-" + suffix + ".json"
     elif int(computeid)==3:
-      bucketkey = "LTSvsSTS3-Template/" + basename + "-" + str(uuid.uuid4()) + ".json"
+      bucketkey = "LTSvsSTS3-Template/" + basename + "-" + suffix + ".json"
     elif int(computeid)==4:
-      bucketkey = "LTSvsSTS4-Template/" + basename + "-" + str(uuid.uuid4()) + ".json"
+      bucketkey = "LTSvsSTS4-Template/" + basename + "-" + suffix + ".json"
+    elif int(computeid)==5:
+      bucketkey = "LTSvsSTS5-Template/" + basename + "-" + suffix + ".json"
+    elif int(computeid)==6:
+      bucketkey = "LTSvsSTS6-Template/" + basename + "-" + suffix + ".json"
+    elif int(computeid)==7:
+      bucketkey = "LTSvsSTS7-Template/" + basename + "-" + suffix + ".json"
     else:
       raise Exception("invalid computeid")
 
@@ -123,38 +176,51 @@ def lambda_handler(event, context):
     # and that lambda function is going to update the database as
     # is processes. Insert job record then upload JSON file.
     print("**Adding jobs row to database**")
-    
+
+    # one round trip: the jobid is the new row's, or with a repeated
+    # idempotency key the existing row's (no key is NULL, which
+    # never repeats)
     sql = """
-      INSERT INTO jobs(computeid, status, originaldatafile, datafilekey, resultsfilekey)
-                  VALUES(%s, %s, %s, %s, '');
+      INSERT INTO jobs(computeid, status, originaldatafile, datafilekey, resultsfilekey, idempotencykey)
+                  VALUES(%s, %s, %s, %s, '', %s)
+      ON DUPLICATE KEY UPDATE jobid = LAST_INSERT_ID(jobid);
     """
     
     status = 'uploaded'
-    datatier.perform_action(dbConn, sql, [computeid, status, filename, bucketkey])
-
-    # Grab the jobid that was auto-generated by mysql:
-    sql = "SELECT LAST_INSERT_ID();"
-    
-    row = datatier.retrieve_one_row(dbConn, sql)
-    
-    jobid = row[0]
+    jobid, inserted = datatier.insert_row(dbConn, sql, [computeid, status, filename, bucketkey, idempotencykey])
     
     print("jobid:", jobid)
 
+    if inserted == 0:
+      sql = "SELECT computeid, status, datafilekey FROM jobs WHERE jobid = %s;"
+      row = datatier.retrieve_one_row(dbConn, sql, [jobid])
+      if int(row[0]) != int(computeid):
+        raise Exception("idempotency key was already used for job " + str(jobid) + " of compute id " + str(row[0]))
+
+      # the first post may have stopped between its insert and its
+      # template upload (a timeout, a failed put), so a job that is
+      # still 'uploaded' gets its template now
+      if row[1] == 'uploaded' and put_template(s3_client, bucketname, row[2], template_json):
+        print("**Template of the first submission was missing, uploaded it**")
+
+      print("**DUPLICATE, returning jobid of the first submission**")
+      return {
+        'statusCode': 200,
+        'body': json.dumps(str(jobid))
+      }
+
     print("**Uploading data file to S3**")
-    #bucket.upload_file(???, 
-    #                   bucketkey, 
-    #                   ExtraArgs={
-    #                     'ACL': 'public-read',
-    #                     'ContentType': 'application/pdf'
-    #                   })
-
-    bucket.upload_file(local_filename, 
-                       bucketkey, 
-                       ExtraArgs={
-                         'ACL': 'public-read',
-                         'ContentType': 'application/json'
-                       })
+
+    # with a key the row is kept, since a concurrent post of the
+    # same submission may already have returned its jobid, and a
+    # retry puts the template; without one no retry can find the
+    # job, so its row is removed
+    try:
+      put_template(s3_client, bucketname, bucketkey, template_json)
+    except Exception:
+      if idempotencykey is None:
+        datatier.perform_action(dbConn, "DELETE FROM jobs WHERE jobid = %s;", [jobid])
+      raise
 
     
     #
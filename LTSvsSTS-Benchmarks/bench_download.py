@@ -0,0 +1,169 @@
+#
+# bench_download.py
+#
+# Measures the download throughput of the compute functions' ranged
+# GET downloader (ltsvssts/download.py) against a single GET per
+# object, for a grid of part sizes and concurrency levels, with the
+# sample stored plain and compressed (--compression). Every download
+# is checked byte for byte and parsed with the loader, so this also
+# tests the downloader and the decompressing parser against moto.
+#
+# By default S3 is emulated in memory with moto, where a GET has no
+# network latency and no per-connection bandwidth limit. To see how
+# the part size and concurrency trade off against a real S3 link,
+# --latency-ms delays the first byte of every GET and --stream-mbps
+# caps each GET's throughput. --bucket runs against a real bucket
+# with the default AWS credentials instead.
+#
+# Usage: python bench_download.py [--cells 400000] [--part-size-mb 4 8 16]
+#          [--concurrency 1 4 8 16] [--latency-ms 0] [--stream-mbps 0]
+#          [--compression none gzip zstd] [--repeat 3] [--bucket name]
+#          [--output results.csv]
+#
+
+import argparse
+import io
+import os
+import sys
+import time
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "LTSvsSTS-AWS", "ltsvssts_layer", "python"))
+
+from ltsvssts import compression
+from ltsvssts import download
+from ltsvssts import loader
+import synthetic
+
+KEY = "LTSvsSTS-Data/NU99999.csv"
+
+
+def throttle(s3_client, latency, stream_mbps):
+  """
+  Makes every GetObject wait latency seconds plus its size at
+  stream_mbps MB/s, like one connection to S3
+  """
+  def after_call(parsed, **kwargs):
+    seconds = latency
+    if stream_mbps > 0:
+      seconds += parsed.get('ContentLength', 0) / download.MB / stream_mbps
+    time.sleep(seconds)
+
+  s3_client.meta.events.register('after-call.s3.GetObject', after_call)
+
+def single_get(s3_client, bucket, key):
+  return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+def measure(fetch, expected, repeat):
+  best = float("inf")
+  for _ in range(repeat):
+    start = time.perf_counter()
+    body = fetch()
+    best = min(best, time.perf_counter() - start)
+    if bytes(body) != expected:
+      raise Exception("downloaded bytes differ from the object")
+  return best, body
+
+def run(s3_client, bucket, body, encoding, part_sizes, concurrencies, repeat):
+  """
+  Stores the sample with the encoding and times every download
+  setting, then parsing the download
+  """
+  columns = synthetic.MARKERS[:8]
+  reference = loader.load_sample(body, columns, KEY)
+  plain_size = len(body)
+
+  if encoding is None:
+    s3_client.put_object(Bucket=bucket, Key=KEY, Body=body)
+  else:
+    body = compression.compress(body, encoding)
+    s3_client.put_object(Bucket=bucket, Key=KEY, Body=body, ContentEncoding=encoding)
+  size = len(body)
+  head = s3_client.head_object(Bucket=bucket, Key=KEY)
+  name = encoding or "none"
+
+  cases = [("single GET", 0, 1, lambda: single_get(s3_client, bucket, KEY))]
+  for part_size in part_sizes:
+    for concurrency in concurrencies:
+      downloader = download.RangedDownloader(int(part_size * download.MB), concurrency)
+      cases.append(("ranged", part_size, concurrency,
+                    lambda d=downloader: d.fetch(s3_client, bucket, KEY, head['ContentLength'], head['ETag'])))
+
+  rows = []
+  for method, part_size, concurrency, fetch in cases:
+    seconds, downloaded = measure(fetch, body, repeat)
+    start = time.perf_counter()
+    parsed = loader.load_sample(compression.sample_source(downloaded, KEY, head.get('ContentEncoding')),
+                                columns, KEY)
+    parse_seconds = time.perf_counter() - start
+    if not parsed.equals(reference):
+      raise Exception("parsing the " + method + " download gave a different sample")
+    row = {
+      "compression": name,
+      "method": method,
+      "part_size_mb": part_size,
+      "concurrency": concurrency,
+      "mb": size / download.MB,
+      "ratio": plain_size / size,
+      "seconds": seconds,
+      "mb_per_sec": size / download.MB / seconds if seconds > 0 else float("inf"),
+      "parse_seconds": parse_seconds
+    }
+    rows.append(row)
+    print(f"{name:5s} {method:10s} {part_size:>6g} MB parts {concurrency:>3d} concurrent "
+          f"{seconds:8.3f} s {row['mb_per_sec']:9.1f} MB/s, parse {parse_seconds:6.3f} s")
+
+  return pd.DataFrame(rows)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="benchmark ranged GET downloads")
+  parser.add_argument("--cells", type=int, default=400000)
+  parser.add_argument("--part-size-mb", type=float, nargs="+", default=[4, 8, 16])
+  parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16])
+  parser.add_argument("--latency-ms", type=float, default=0)
+  parser.add_argument("--stream-mbps", type=float, default=0)
+  parser.add_argument("--compression", nargs="+", choices=["none", "gzip", "zstd"], default=["none"])
+  parser.add_argument("--repeat", type=int, default=3)
+  parser.add_argument("--bucket", default=None)
+  parser.add_argument("--output", default=None)
+  args = parser.parse_args()
+
+  import boto3
+
+  buffer = io.BytesIO()
+  synthetic.write_sample(buffer, args.cells)
+  body = buffer.getvalue()
+  print("sample:", args.cells, "cells,", round(len(body) / download.MB, 1), "MB")
+
+  def bench(bucket):
+    s3_client = boto3.client("s3")
+    throttle(s3_client, args.latency_ms / 1000, args.stream_mbps)
+    try:
+      return pd.concat([run(s3_client, bucket, body, None if name == "none" else name,
+                            args.part_size_mb, args.concurrency, args.repeat)
+                        for name in args.compression], ignore_index=True)
+    finally:
+      s3_client.delete_object(Bucket=bucket, Key=KEY)
+
+  if args.bucket is not None:
+    results = bench(args.bucket)
+  else:
+    from moto import mock_aws
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+      boto3.client("s3").create_bucket(Bucket="ltsvssts-bench")
+      results = bench("ltsvssts-bench")
+
+  print()
+  print(results.pivot_table(index=["compression", "part_size_mb"], columns="concurrency",
+                            values="seconds").round(3))
+
+  if args.output is not None:
+    results.to_csv(args.output, index=False)
+    print("wrote", args.output)
+
+
+if __name__ == "__main__":
+  main()
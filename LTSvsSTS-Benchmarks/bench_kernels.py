@@ -0,0 +1,156 @@
+#
+# bench_kernels.py
+#
+# Micro-benchmarks of the per-sample analysis kernels on synthetic
+# samples: thresholding, phenotype counting, co-occurrence and the
+# notebook's phenotype-by-distance counting. Each kernel is timed for
+# every analysis backend (ltsvssts/analysis.py) across cell and
+# marker counts, reporting the best of several runs as cells/sec and
+# the peak memory traced while it ran.
+#
+# Backends:
+#   pandas    the reference implementation
+#   numpy     bitmasks and popcounts (the default of the handlers)
+#   polars    polars expressions, if polars is installed
+#
+# Usage: python bench_kernels.py [--cells 10000 100000 ...]
+#          [--markers 8 26] [--phenotypes 20] [--repeat 3]
+#          [--output results.csv]
+#
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "LTSvsSTS-AWS", "ltsvssts_layer", "python"))
+
+from ltsvssts import analysis
+from ltsvssts import phenotypes
+import synthetic
+
+
+def distance_counts(positive, values, distances):
+  """
+  Positive cells of every phenotype in every distance bin, from the
+  (phenotypes x cells) masks of a backend
+  """
+  bins = np.stack([(values >= bounds[0]) & (values < bounds[1])
+                   for bounds in distances.values()]).astype(np.float32)
+  return (positive.astype(np.float32) @ bins.T).ravel()
+
+
+###################################################################
+#
+# measure:
+#
+# Runs setup() then func(state) repeat times and returns the best
+# wall time, and the peak traced memory of one more run.
+#
+def measure(setup, func, repeat):
+  best = float("inf")
+  for _ in range(repeat):
+    state = setup()
+    gc.collect()
+    start = time.perf_counter()
+    func(state)
+    best = min(best, time.perf_counter() - start)
+    del state
+
+  state = setup()
+  gc.collect()
+  tracemalloc.start()
+  func(state)
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del state
+
+  return best, peak
+
+def kernels(df, markers, thresholds, phenotypedict, distancedict, metric):
+  """
+  Returns (kernel, backend, setup, func) for every benchmark case;
+  setup returns the kernel's input
+  """
+  program = phenotypes.compile_phenotypes(phenotypedict)
+  raw = df[markers + [metric]]
+  values = raw[metric].to_numpy()
+  distances = distancedict[metric]
+
+  cases = []
+  for name in analysis.available_backends():
+    backend = analysis.get_backend(name)
+    positive = backend.threshold(raw, thresholds)
+    cases += [
+      ("threshold", name, lambda: raw, lambda d, b=backend: b.threshold(d, thresholds)),
+      ("count_phenotypes", name, lambda p=positive: p, lambda p, b=backend: b.count_phenotypes(p, program)),
+      ("co_occurrence", name, lambda p=positive: p, lambda p, b=backend: b.co_occurrence(p, markers)),
+      ("phenotype_distance", name, lambda p=positive: p,
+       lambda p, b=backend: distance_counts(b.phenotype_masks(p, program), values, distances)),
+    ]
+
+  return cases
+
+def run(cell_counts, marker_counts, num_phenotypes, repeat):
+  rows = []
+  metric = synthetic.DISTANCES[2]
+  distancedict = synthetic.make_distance_bins()
+
+  for cells in cell_counts:
+    df = synthetic.make_sample(cells)
+    for num_markers in marker_counts:
+      markers = synthetic.MARKERS[:num_markers]
+      thresholds = synthetic.make_thresholds(markers)
+      phenotypedict = synthetic.make_phenotypes(markers, num_phenotypes)
+
+      for kernel, backend, setup, func in kernels(df, markers, thresholds, phenotypedict, distancedict, metric):
+        seconds, peak = measure(setup, func, repeat)
+        row = {
+          "kernel": kernel,
+          "backend": backend,
+          "cells": cells,
+          "markers": num_markers,
+          "seconds": seconds,
+          "cells_per_sec": cells / seconds if seconds > 0 else float("inf"),
+          "peak_mb": peak / 1e6
+        }
+        rows.append(row)
+        print(f"{kernel:20s} {backend:7s} {cells:>9d} cells {num_markers:>3d} markers "
+              f"{seconds * 1000:10.2f} ms {row['cells_per_sec']:14.0f} cells/s {row['peak_mb']:9.1f} MB")
+    del df
+
+  return pd.DataFrame(rows)
+
+def speedups(results):
+  """
+  Adds each backend's speedup over the pandas backend for the same case
+  """
+  key = ["kernel", "cells", "markers"]
+  base = results[results["backend"] == "pandas"].set_index(key)["seconds"]
+  results = results.join(base.rename("pandas_seconds"), on=key)
+  results["speedup"] = results["pandas_seconds"] / results["seconds"]
+  return results.drop(columns=["pandas_seconds"])
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="benchmark the per-sample analysis kernels")
+  parser.add_argument("--cells", type=int, nargs="+", default=[10000, 100000, 1000000])
+  parser.add_argument("--markers", type=int, nargs="+", default=[8, 26])
+  parser.add_argument("--phenotypes", type=int, default=20)
+  parser.add_argument("--repeat", type=int, default=3)
+  parser.add_argument("--output", default=None)
+  args = parser.parse_args()
+
+  results = speedups(run(args.cells, args.markers, args.phenotypes, args.repeat))
+
+  print()
+  print(results.pivot_table(index=["kernel", "cells", "markers"], columns="backend", values="speedup").round(2))
+
+  if args.output is not None:
+    results.to_csv(args.output, index=False)
+    print("wrote", args.output)
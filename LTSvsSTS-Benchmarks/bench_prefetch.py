@@ -0,0 +1,153 @@
+#
+# bench_prefetch.py
+#
+# Measures the per-job wall time of the compute functions' sample
+# loop with the samples loaded one at a time (prefetch depth 0) and
+# loaded ahead on a producer thread (ltsvssts/prefetch.py), for a
+# set of depths. Each sample is loaded through the sample cache's
+# download and parse path from moto, with every GET throttled like
+# bench_download.py's, and then thresholded and counted with the
+# analysis backend as in compute id 1. The counts must equal those
+# of depth 0, and the most samples held at once must not exceed
+# depth + 1, the one being counted plus those loaded ahead.
+#
+# With a pipeline the time per sample approaches max(load, compute)
+# instead of their sum.
+#
+# Usage: python bench_prefetch.py [--samples 8] [--cells 200000]
+#          [--phenotypes 200] [--depth 0 1 2] [--latency-ms 50] [--stream-mbps 50]
+#          [--backend numpy] [--output results.csv]
+#
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "LTSvsSTS-AWS", "ltsvssts_layer", "python"))
+
+from ltsvssts import analysis
+from ltsvssts import download
+from ltsvssts import loader
+from ltsvssts import phenotypes
+from ltsvssts import prefetch
+from ltsvssts import samplecache
+import bench_download
+import synthetic
+
+
+class Holding:
+  """
+  Counts the samples loaded and not yet counted, and the time spent
+  loading and counting
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.current = 0
+    self.peak = 0
+    self.load_seconds = 0.0
+    self.compute_seconds = 0.0
+
+  def add(self, n):
+    with self.lock:
+      self.current += n
+      self.peak = max(self.peak, self.current)
+
+
+def run(s3_client, bucket, keys, thresholds, program, columns, backend, depth, cache_dir):
+  """
+  Counts the phenotypes of every sample with the given prefetch
+  depth from an empty cache, returning the counts, the wall time and
+  the Holding
+  """
+  cache = samplecache.SampleCache(os.path.join(cache_dir, str(depth)), 1 << 40,
+                                  download.RangedDownloader(8 * download.MB, 8))
+  holding = Holding()
+
+  def load(file_key):
+    start = time.perf_counter()
+    df = cache.load(s3_client, bucket, file_key, columns)
+    holding.load_seconds += time.perf_counter() - start
+    holding.add(1)
+    return df
+
+  counts = {}
+  start = time.perf_counter()
+  for file_key, df in prefetch.prefetched(load, keys, depth):
+    compute_start = time.perf_counter()
+    counts[loader.sample_name(file_key)] = backend.count_phenotypes(backend.threshold(df, thresholds[file_key]),
+                                                                   program)
+    holding.compute_seconds += time.perf_counter() - compute_start
+    holding.add(-1)
+  seconds = time.perf_counter() - start
+  return pd.DataFrame(counts), seconds, holding
+
+
+def main():
+  parser = argparse.ArgumentParser(description="benchmark prefetching samples during a job")
+  parser.add_argument("--samples", type=int, default=8)
+  parser.add_argument("--cells", type=int, default=200000)
+  parser.add_argument("--phenotypes", type=int, default=200)
+  parser.add_argument("--depth", type=int, nargs="+", default=[0, 1, 2])
+  parser.add_argument("--latency-ms", type=float, default=50)
+  parser.add_argument("--stream-mbps", type=float, default=50)
+  parser.add_argument("--backend", default="numpy")
+  parser.add_argument("--output", default=None)
+  args = parser.parse_args()
+
+  import boto3
+  from moto import mock_aws
+
+  markers = synthetic.MARKERS
+  program = phenotypes.compile_phenotypes(synthetic.make_phenotypes(markers, args.phenotypes))
+  backend = analysis.get_backend(args.backend)
+  keys = ["LTSvsSTS-Data/SYN%03d.csv" % (i + 1) for i in range(args.samples)]
+  thresholds = {key: synthetic.make_thresholds(markers, seed=i) for i, key in enumerate(keys)}
+  columns = loader.job_columns(thresholds, program.columns())
+
+  os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+  rows = []
+  with mock_aws(), tempfile.TemporaryDirectory() as cache_dir:
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(Bucket="ltsvssts-bench")
+    for i, key in enumerate(keys):
+      buffer = io.StringIO()
+      synthetic.write_sample(buffer, args.cells, seed=i)
+      s3_client.put_object(Bucket="ltsvssts-bench", Key=key, Body=buffer.getvalue().encode("utf-8"))
+    bench_download.throttle(s3_client, args.latency_ms / 1000, args.stream_mbps)
+
+    reference = None
+    for depth in args.depth:
+      counts, seconds, holding = run(s3_client, "ltsvssts-bench", keys, thresholds, program, columns, backend,
+                                  depth, cache_dir)
+      if reference is None:
+        reference = counts
+      elif not counts.equals(reference):
+        raise Exception("counts with prefetch depth " + str(depth) + " differ")
+      if holding.peak > max(depth, 0) + 1:
+        raise Exception("prefetch depth " + str(depth) + " held " + str(holding.peak) + " samples at once")
+
+      rows.append({"depth": depth, "samples": args.samples, "seconds": seconds,
+                   "per_sample_s": seconds / args.samples, "load_s": holding.load_seconds,
+                   "compute_s": holding.compute_seconds, "peak_samples": holding.peak})
+      print(f"depth {depth}: {seconds:7.2f} s (load {holding.load_seconds:.2f} s, "
+            f"compute {holding.compute_seconds:.2f} s), {seconds / args.samples:6.3f} s per sample, "
+            f"at most {holding.peak} sample(s) held")
+
+  results = pd.DataFrame(rows)
+  print()
+  print(results.to_string(index=False))
+
+  if args.output is not None:
+    results.to_csv(args.output, index=False)
+    print("wrote", args.output)
+
+
+if __name__ == "__main__":
+  main()
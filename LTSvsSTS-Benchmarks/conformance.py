@@ -0,0 +1,141 @@
+#
+# conformance.py
+#
+# Checks that every installed analysis backend (ltsvssts/analysis.py)
+# returns exactly the results of the pandas reference backend:
+# phenotype counts, phenotype masks and co-occurrence matrices. The
+# synthetic samples are built to hit the edge cases: cell counts
+# that are not a multiple of 64 (and empty samples), NaN intensities,
+# intensities exactly at the float32 threshold, list and expression
+# phenotypes, and phenotype columns without a threshold.
+#
+# Usage: python conformance.py [--cells 0 1 63 64 65 1000 100003]
+#          [--seeds 3] [--phenotypes 30]
+#
+# Exits with status 1 if any backend differs from the reference.
+#
+
+import argparse
+import os
+import sys
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "LTSvsSTS-AWS", "ltsvssts_layer", "python"))
+
+from ltsvssts import analysis
+from ltsvssts import phenotypes
+import synthetic
+
+REFERENCE = "pandas"
+
+# markers left out of THRESHOLDS, used as raw columns by phenotypes
+UNTHRESHOLDED = 2
+
+
+def make_expression(rng, markers):
+  """
+  Returns a random phenotype expression over the markers, with
+  negation, juxtaposition, | and parentheses
+  """
+  def term():
+    marker = markers[rng.integers(len(markers))][:-len("_R")]
+    text = marker + ("+" if rng.random() < 0.7 else "-")
+    return ("!" + text) if rng.random() < 0.15 else text
+
+  def conjunction():
+    return (" & " if rng.random() < 0.5 else " ").join(term() for _ in range(rng.integers(1, 4)))
+
+  parts = [conjunction() for _ in range(rng.integers(1, 3))]
+  expression = " | ".join("(" + part + ")" for part in parts) if len(parts) > 1 else parts[0]
+  if rng.random() < 0.2:
+    expression = "!(" + expression + ")"
+  return expression
+
+def make_case(cells, seed, num_phenotypes):
+  """
+  Returns a sample, its thresholds and phenotypes, with NaNs and
+  values on the thresholds mixed in
+  """
+  rng = np.random.default_rng(seed)
+  df = synthetic.make_sample(cells, seed=seed)
+  markers = synthetic.MARKERS
+  thresholds = synthetic.make_thresholds(markers[:-UNTHRESHOLDED], seed=seed)
+
+  for col, thr in thresholds.items():
+    values = df[col].to_numpy().copy()
+    values[rng.random(cells) < 0.05] = values.dtype.type(thr)
+    values[rng.random(cells) < 0.01] = np.nan
+    df[col] = values
+  for col in markers[-UNTHRESHOLDED:]:
+    values = df[col].to_numpy().copy()
+    values[rng.random(cells) < 0.3] = 0
+    values[rng.random(cells) < 0.01] = np.nan
+    df[col] = values
+
+  phenotypedict = synthetic.make_phenotypes(markers, num_phenotypes // 2, seed=seed)
+  for i in range(num_phenotypes - len(phenotypedict)):
+    phenotypedict["expr" + str(i)] = make_expression(rng, markers)
+
+  return df, thresholds, phenotypedict, markers
+
+def compare(name, expected, actual):
+  if expected.shape != actual.shape:
+    return name + ": shape " + str(actual.shape) + " != " + str(expected.shape)
+  if not np.array_equal(expected, actual):
+    return name + ": " + str(int(np.count_nonzero(expected != actual))) + " values differ"
+  return None
+
+def check(backend, reference, df, thresholds, program, markers):
+  """
+  Returns the list of differences between a backend and the
+  reference on one sample
+  """
+  expected = reference.threshold(df, thresholds)
+  actual = backend.threshold(df, thresholds)
+
+  results = [
+    compare("count_phenotypes", reference.count_phenotypes(expected, program),
+            np.asarray(backend.count_phenotypes(actual, program))),
+    compare("phenotype_masks", reference.phenotype_masks(expected, program),
+            np.asarray(backend.phenotype_masks(actual, program))),
+    compare("co_occurrence", reference.co_occurrence(expected, markers),
+            np.asarray(backend.co_occurrence(actual, markers)))
+  ]
+  return [result for result in results if result is not None]
+
+
+def main():
+  parser = argparse.ArgumentParser(description="check the analysis backends against the reference")
+  parser.add_argument("--cells", type=int, nargs="+", default=[0, 1, 63, 64, 65, 1000, 100003])
+  parser.add_argument("--seeds", type=int, default=3)
+  parser.add_argument("--phenotypes", type=int, default=30)
+  args = parser.parse_args()
+
+  reference = analysis.get_backend(REFERENCE)
+  backends = [name for name in analysis.available_backends() if name != REFERENCE]
+  missing = [name for name in analysis.BACKENDS if name not in analysis.available_backends()]
+  print("backends:", ", ".join(backends), "against", REFERENCE)
+  if len(missing) > 0:
+    print("not installed, skipped:", ", ".join(missing))
+
+  failures = 0
+  for cells in args.cells:
+    for seed in range(args.seeds):
+      df, thresholds, phenotypedict, markers = make_case(cells, seed, args.phenotypes)
+      program = phenotypes.compile_phenotypes(phenotypedict)
+      for name in backends:
+        differences = check(analysis.get_backend(name), reference, df, thresholds, program, markers)
+        status = "ok" if len(differences) == 0 else "FAILED " + "; ".join(differences)
+        print(f"{name:7s} {cells:>8d} cells seed {seed}: {status}")
+        failures += len(differences) > 0
+
+  print()
+  if failures > 0:
+    print(failures, "case(s) differ from the reference")
+    sys.exit(1)
+  print("all backends match the reference")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,14 @@
+#
+# conftest.py
+#
+# pytest setup for the checks in this folder (python -m pytest in
+# LTSvsSTS-Benchmarks): the shared ltsvssts package is imported from
+# the layer, as the lambda functions see it.
+#
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "LTSvsSTS-AWS", "ltsvssts_layer", "python"))
+sys.path.insert(0, HERE)
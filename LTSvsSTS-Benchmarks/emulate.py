@@ -0,0 +1,548 @@
+#
+# emulate.py
+#
+# Runs the real lambda handlers end to end without AWS: S3 is
+# emulated with moto, the database with sqlite_datatier.py, and the
+# S3 put events that trigger ingestion and the compute functions
+# are built here. Synthetic samples are uploaded and ingested, then
+# for every compute id a job goes through upload -> compute ->
+# download, and the latency of each step is reported, with the
+# compute step split into S3 calls, database queries and the rest,
+# along with the slowest stage of the job's timing summary.
+#
+# With --shared-scan K, K jobs of each of compute ids 1, 2 and 4
+# (with different thresholds) are uploaded together instead, their
+# template events queued in jobqueue.LocalQueue and run by the
+# shared-scan worker (ltsvssts_batch), and the number of sample
+# objects read is compared with one function per job. Lambda
+# invocations of compute id 4 by the worker run once it returns.
+#
+# Before the jobs, a template with a misspelled marker and a sample
+# that was never ingested is uploaded, and must be rejected without
+# creating a job. A submission is then posted twice with the same
+# idempotency key, and must create one job and one template.
+#
+# Usage: python emulate.py [--samples 6] [--cells 20000]
+#          [--computeids 1 2 3 4 5 6 7] [--output latency.csv]
+#          [--backend numpy] [--part-size-mb 1] [--concurrency 8] [--prefetch 1]
+#          [--compression none|gzip|zstd] [--result-format json|npz]
+#          [--shared-scan K] [--profile-memory] [--verbose]
+#
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import pandas as pd
+
+import synthetic
+import sqlite_datatier
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AWS_DIR = os.path.join(HERE, "..", "LTSvsSTS-AWS")
+LAYER_DIR = os.path.join(AWS_DIR, "ltsvssts_layer", "python")
+
+BUCKET = "ltsvssts-emulator"
+
+COMPUTE_FUNCTIONS = {computeid: "ltsvssts_compute" + str(computeid) for computeid in range(1, 8)}
+
+CONFIG = """[s3]
+bucket_name = {bucket}
+
+[rds]
+endpoint = localhost
+port_number = 3306
+region_name = us-east-1
+user_name = emulator
+user_pwd = emulator
+db_name = ltsvsstsapp
+
+[s3readonly]
+region_name = us-east-1
+aws_access_key_id = testing
+aws_secret_access_key = testing
+
+[s3readwrite]
+region_name = us-east-1
+aws_access_key_id = testing
+aws_secret_access_key = testing
+
+[cache]
+directory = {cache}
+fraction = 0.5
+
+[compute]
+workers = 0
+max_workers = 8
+
+[download]
+part_size_mb = {part_size_mb}
+concurrency = {concurrency}
+prefetch = {prefetch}
+
+[spatial]
+centroid_columns = X, Y
+radius = 20
+
+[ingest]
+required_markers = {markers}
+"""
+
+
+###################################################################
+#
+# S3 call timing: every botocore API call made by a handler is
+# timed, whatever client or transfer thread makes it
+#
+class S3Timer:
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    self.calls = 0
+    self.seconds = 0.0
+    self.sample_reads = 0
+
+  def install(self):
+    import botocore.client
+    original = botocore.client.BaseClient._make_api_call
+    timer = self
+
+    def _make_api_call(client, operation_name, api_params):
+      start = time.perf_counter()
+      try:
+        return original(client, operation_name, api_params)
+      finally:
+        with timer.lock:
+          timer.calls += 1
+          timer.seconds += time.perf_counter() - start
+          # a sample (or its columnar copy) downloaded, counted once
+          # however many ranged GETs fetch it
+          if (operation_name == "GetObject" and
+              api_params.get("Key", "").startswith(("LTSvsSTS-Data/", "LTSvsSTS-Columnar/")) and
+              api_params.get("Range", "bytes=0-").startswith("bytes=0-")):
+            timer.sample_reads += 1
+
+    botocore.client.BaseClient._make_api_call = _make_api_call
+
+
+def load_handler(function):
+  """
+  Imports a lambda function folder's lambda_handler with its own
+  sibling modules and a fresh copy of the shared ltsvssts package,
+  as in a new container, with the SQLite datatier in place of
+  pymysql
+  """
+  folder = os.path.join(AWS_DIR, function)
+  siblings = [name[:-3] for name in os.listdir(folder) if name.endswith(".py")]
+  for name in siblings:
+    sys.modules.pop(name, None)
+  for name in list(sys.modules):
+    if name == "ltsvssts" or name.startswith("ltsvssts."):
+      del sys.modules[name]
+
+  if LAYER_DIR not in sys.path:
+    sys.path.insert(0, LAYER_DIR)
+  import ltsvssts
+  ltsvssts.datatier = sqlite_datatier
+  sys.modules["ltsvssts.datatier"] = sqlite_datatier
+
+  sys.path.insert(0, folder)
+  try:
+    spec = importlib.util.spec_from_file_location(function + "_lambda_function",
+                                                  os.path.join(folder, "lambda_function.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+  finally:
+    sys.path.remove(folder)
+
+  return module.lambda_handler
+
+###################################################################
+#
+# Lambda invocations: an asynchronous Invoke of another function by
+# a handler is recorded and run after the handler returns
+#
+class LambdaInvoker:
+
+  def __init__(self):
+    self.pending = []
+
+  def install(self):
+    import botocore.client
+    original = botocore.client.BaseClient._make_api_call
+    invoker = self
+
+    def _make_api_call(client, operation_name, api_params):
+      if operation_name != "Invoke":
+        return original(client, operation_name, api_params)
+      invoker.pending.append((api_params["FunctionName"], json.loads(api_params["Payload"])))
+      return {"StatusCode": 202}
+
+    botocore.client.BaseClient._make_api_call = _make_api_call
+
+  def run_pending(self, verbose):
+    while len(self.pending) > 0:
+      function, event = self.pending.pop(0)
+      response, _ = invoke(load_handler(function), event, verbose)
+      if response["statusCode"] != 200:
+        print(function, "failed:", response["body"])
+
+
+def s3_event(key):
+  return {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}]}
+
+def invoke(handler, event, verbose):
+  """
+  Calls a handler, returning its response and the wall time
+  """
+  output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+  start = time.perf_counter()
+  with output:
+    response = handler(event, None)
+  return response, time.perf_counter() - start
+
+def make_template(computeid, samples, profile_memory=False, backend=None, result_format=None, seed=0):
+  markers = synthetic.MARKERS
+  template = {
+    "THRESHOLDS": {key: synthetic.make_thresholds(markers, seed=seed + i) for i, key in enumerate(samples)},
+    "PHENOTYPES": synthetic.make_phenotypes(markers, 10)
+  }
+  if computeid == 4:
+    template["PERMUTATIONS"] = 1000
+  elif computeid == 5:
+    template["SWEEP"] = {"START": 1.0, "STOP": 3.0, "STEP": 0.1}
+  elif computeid == 6:
+    template["DISTANCES"] = {synthetic.DISTANCES[2]: synthetic.make_distance_bins()[synthetic.DISTANCES[2]]}
+    template["PERMUTATIONS"] = 1000
+  elif computeid == 7:
+    template["PERMUTATIONS"] = 50
+    template["RADIUS"] = 20
+  template["SEED"] = 1
+  if profile_memory:
+    template["PROFILE_MEMORY"] = True
+  if backend is not None:
+    template["BACKEND"] = backend
+  if result_format is not None:
+    template["RESULT_FORMAT"] = result_format
+  return template
+
+
+###################################################################
+#
+# ingest_samples:
+#
+# Uploads synthetic samples and delivers their put events to the
+# ingest function, then assigns alternating LTS/STS cohorts. With an
+# encoding the samples are uploaded compressed, as .csv.gz or
+# .csv.zst.
+#
+def ingest_samples(s3_client, num_samples, cells, verbose, encoding=None):
+  handler = load_handler("ltsvssts_ingest")
+  from ltsvssts import compression
+
+  samples = []
+  for i in range(num_samples):
+    key = "LTSvsSTS-Data/SYN%03d.csv" % (i + 1)
+    buffer = io.StringIO()
+    synthetic.write_sample(buffer, cells, seed=i)
+    body = buffer.getvalue().encode("utf-8")
+    if encoding is not None:
+      key += compression.ENCODINGS[encoding]
+      body = compression.compress(body, encoding)
+    s3_client.put_object(Bucket=BUCKET, Key=key, Body=body)
+
+    response, seconds = invoke(handler, s3_event(key), verbose)
+    if response["statusCode"] != 200:
+      raise Exception("ingest of " + key + " failed: " + response["body"])
+    print(f"ingested {key}: {cells} cells in {seconds:.2f} s")
+    samples.append(key)
+
+  dbConn = sqlite_datatier.get_dbConn()
+  for i, key in enumerate(samples):
+    sqlite_datatier.perform_action(dbConn, "UPDATE samples SET cohort = %s WHERE datafilekey = %s",
+                                   ["LTS" if i % 2 == 0 else "STS", key])
+  return samples
+
+def upload_job(template, computeid, verbose):
+  """
+  Submits a template through the upload function, returning the
+  job's id, template key and the upload time
+  """
+  upload = load_handler("ltsvssts_upload")
+  event = {"computeid": computeid,
+           "body": json.dumps({"filename": "emulated.json", "data": template})}
+  response, seconds = invoke(upload, event, verbose)
+  if response["statusCode"] != 200:
+    raise Exception("upload failed: " + response["body"])
+  jobid = json.loads(response["body"])
+
+  dbConn = sqlite_datatier.get_dbConn()
+  bucketkey = sqlite_datatier.retrieve_one_row(dbConn, "SELECT datafilekey FROM jobs WHERE jobid = %s", [jobid])[0]
+  return jobid, bucketkey, seconds
+
+def reject_invalid_template(samples, verbose):
+  """
+  Uploads a template with a misspelled marker and a sample that was
+  not ingested, which the upload function must reject without
+  creating a job; returns the errors and the upload time
+  """
+  template = make_template(1, samples)
+  thresholds = template["THRESHOLDS"][samples[0]]
+  marker = synthetic.MARKERS[0]
+  thresholds[marker.upper()] = thresholds.pop(marker)
+  template["THRESHOLDS"]["LTSvsSTS-Data/NOSUCHSAMPLE.csv"] = dict(thresholds)
+
+  dbConn = sqlite_datatier.get_dbConn()
+  jobs_sql = "SELECT COUNT(*) FROM jobs"
+  before = sqlite_datatier.retrieve_one_row(dbConn, jobs_sql)[0]
+
+  upload = load_handler("ltsvssts_upload")
+  event = {"computeid": 1,
+           "body": json.dumps({"filename": "invalid.json", "data": template})}
+  response, seconds = invoke(upload, event, verbose)
+  if response["statusCode"] != 400:
+    raise Exception("upload did not reject an invalid template: " + response["body"])
+  if sqlite_datatier.retrieve_one_row(dbConn, jobs_sql)[0] != before:
+    raise Exception("upload created a job for an invalid template")
+  return json.loads(response["body"])["errors"], seconds
+
+def repeat_submission(s3_client, samples, verbose):
+  """
+  Posts the same submission twice, as a client retrying a post whose
+  response was lost would; both must return the same job, with one
+  jobs row and one template. Then posts it a third time with the
+  template removed, as after a first post that stopped before its
+  upload, which must put the template again. Returns the job id and
+  the time of the repeated post
+  """
+  template = make_template(3, samples)
+  event = {"computeid": 3,
+           "body": json.dumps({"filename": "repeated.json", "data": template,
+                               "idempotencykey": str(uuid.uuid4())})}
+
+  upload = load_handler("ltsvssts_upload")
+  response, _ = invoke(upload, event, verbose)
+  if response["statusCode"] != 200:
+    raise Exception("upload failed: " + response["body"])
+  jobid = json.loads(response["body"])
+
+  response, seconds = invoke(upload, event, verbose)
+  if response["statusCode"] != 200 or json.loads(response["body"]) != jobid:
+    raise Exception("repeated upload did not return job " + str(jobid) + ": " + response["body"])
+
+  dbConn = sqlite_datatier.get_dbConn()
+  rows = sqlite_datatier.retrieve_one_row(dbConn, "SELECT COUNT(*) FROM jobs WHERE originaldatafile = %s",
+                                          ["repeated.json"])[0]
+  templates = s3_client.list_objects_v2(Bucket=BUCKET, Prefix="LTSvsSTS3-Template/repeated-").get("KeyCount", 0)
+  if rows != 1 or templates != 1:
+    raise Exception(f"repeated upload created {rows} jobs and {templates} templates")
+
+  bucketkey = sqlite_datatier.retrieve_one_row(dbConn, "SELECT datafilekey FROM jobs WHERE jobid = %s", [jobid])[0]
+  s3_client.delete_object(Bucket=BUCKET, Key=bucketkey)
+  response, _ = invoke(upload, event, verbose)
+  if response["statusCode"] != 200 or json.loads(response["body"]) != jobid:
+    raise Exception("repeated upload did not return job " + str(jobid) + ": " + response["body"])
+  if s3_client.list_objects_v2(Bucket=BUCKET, Prefix=bucketkey).get("KeyCount", 0) != 1:
+    raise Exception("repeated upload did not put the missing template of job " + str(jobid))
+  return jobid, seconds
+
+def run_job(computeid, samples, s3_timer, verbose, profile_memory=False, backend=None, result_format=None):
+  """
+  Runs one job through upload, compute and download, returning its
+  latency breakdown
+  """
+  row = {"computeid": computeid}
+  template = make_template(computeid, samples, profile_memory, backend, result_format)
+  jobid, bucketkey, row["upload_s"] = upload_job(template, computeid, verbose)
+
+  # the put of the template is what triggers the compute function
+  compute = load_handler(COMPUTE_FUNCTIONS[computeid])
+  s3_timer.reset()
+  sqlite_datatier.reset_stats()
+  response, row["compute_s"] = invoke(compute, s3_event(bucketkey), verbose)
+  row["compute_s3_s"] = s3_timer.seconds
+  row["compute_s3_calls"] = s3_timer.calls
+  row["compute_db_s"] = sqlite_datatier.stats["seconds"]
+  row["compute_db_queries"] = sqlite_datatier.stats["queries"]
+  row["compute_other_s"] = row["compute_s"] - row["compute_s3_s"] - row["compute_db_s"]
+  if response["statusCode"] != 200:
+    row["error"] = response["body"]
+
+  download = load_handler("ltsvssts_download")
+  event = {"jobid": jobid}
+  if result_format is not None:
+    event["queryStringParameters"] = {"format": result_format}
+  response, row["download_s"] = invoke(download, event, verbose)
+  row["status"] = response["statusCode"]
+  row["result_bytes"] = len(response["body"])
+  row["total_s"] = row["upload_s"] + row["compute_s"] + row["download_s"]
+
+  # the compute function's own breakdown, from its timing summary
+  response, _ = invoke(download, {"jobid": jobid, "queryStringParameters": {"timing": "true"}}, verbose)
+  if response["statusCode"] == 200:
+    stages = json.loads(response["body"])["stages"]
+    row["slowest_stage"] = max(stages, key=lambda name: stages[name]["seconds"])
+
+  if profile_memory:
+    response, _ = invoke(download, {"jobid": jobid, "queryStringParameters": {"memory": "true"}}, verbose)
+    if response["statusCode"] == 200:
+      report = json.loads(response["body"])
+      row["peak_rss_mb"] = report["peak_rss_mb"]
+      row["recommended_mb"] = report["recommended_mb"]["job"]
+
+
+  return row
+
+
+###################################################################
+#
+# run_shared_scan:
+#
+# Uploads copies jobs of each compute id (1, 2 or 4), each with its
+# own thresholds, queues their template events and runs them with
+# the shared-scan worker, starting from an empty sample cache as a
+# new worker would. Returns one row per job.
+#
+def run_shared_scan(computeids, copies, samples, s3_timer, invoker, cache_dir, verbose, backend=None,
+                    result_format=None):
+  worker = load_handler("ltsvssts_batch")
+  from ltsvssts import jobqueue
+
+  jobs = []
+  queue = jobqueue.LocalQueue(batch_size=len(computeids) * copies, window=0.1)
+  for copy in range(copies):
+    for computeid in computeids:
+      template = make_template(computeid, samples, backend=backend, result_format=result_format,
+                               seed=1000 * (copy + 1))
+      jobid, bucketkey, _ = upload_job(template, computeid, verbose)
+      queue.send(s3_event(bucketkey))
+      jobs.append((computeid, copy, jobid))
+
+  shutil.rmtree(cache_dir, ignore_errors=True)
+  s3_timer.reset()
+  start = time.perf_counter()
+  responses = queue.drain(lambda event, context: invoke(worker, event, verbose)[0])
+  worker_s = time.perf_counter() - start
+  for response in responses:
+    print("shared-scan worker:", response["statusCode"], response["body"])
+
+  start = time.perf_counter()
+  invoker.run_pending(verbose)
+  handoff_s = time.perf_counter() - start
+
+  print(f"shared scan: {len(jobs)} jobs over {len(samples)} samples read {s3_timer.sample_reads} sample objects "
+        f"(one function per job would read {len(jobs) * len(samples)}), worker {worker_s:.2f} s, "
+        f"compute 4 after the scan {handoff_s:.2f} s")
+
+  download = load_handler("ltsvssts_download")
+  rows = []
+  for computeid, copy, jobid in jobs:
+    event = {"jobid": jobid}
+    if result_format is not None:
+      event["queryStringParameters"] = {"format": result_format}
+    response, _ = invoke(download, event, verbose)
+    rows.append({"computeid": computeid, "copy": copy, "jobid": jobid, "status": response["statusCode"],
+                 "result_bytes": len(response["body"])})
+    print(f"compute {computeid} copy {copy}: status {response['statusCode']}")
+  return rows
+
+
+def main():
+  parser = argparse.ArgumentParser(description="run the lambda handlers end to end offline")
+  parser.add_argument("--samples", type=int, default=6)
+  parser.add_argument("--cells", type=int, default=20000)
+  parser.add_argument("--computeids", type=int, nargs="+", default=list(COMPUTE_FUNCTIONS.keys()))
+  parser.add_argument("--output", default=None)
+  parser.add_argument("--backend", default=None)
+  parser.add_argument("--part-size-mb", type=float, default=1)
+  parser.add_argument("--concurrency", type=int, default=8)
+  parser.add_argument("--prefetch", type=int, default=1)
+  parser.add_argument("--compression", choices=["none", "gzip", "zstd"], default="none")
+  parser.add_argument("--result-format", choices=["json", "npz"], default=None)
+  parser.add_argument("--shared-scan", type=int, default=0)
+  parser.add_argument("--profile-memory", action="store_true")
+  parser.add_argument("--verbose", action="store_true")
+  args = parser.parse_args()
+
+  try:
+    from moto import mock_aws
+    import boto3
+  except ImportError:
+    print("emulate.py needs boto3 and moto (pip install boto3 moto)")
+    sys.exit(1)
+
+  workdir = tempfile.mkdtemp(prefix="ltsvssts-emulator-")
+  with open(os.path.join(workdir, "ltsvsstsapp-config.ini"), "w") as f:
+    f.write(CONFIG.format(bucket=BUCKET, cache=os.path.join(workdir, "cache"),
+                          part_size_mb=args.part_size_mb, concurrency=args.concurrency, prefetch=args.prefetch,
+                          markers=", ".join(synthetic.MARKERS)))
+
+  # the handlers read ltsvsstsapp-config.ini from the working directory
+  cwd = os.getcwd()
+  os.chdir(workdir)
+  os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+  sqlite_datatier.DATABASE = os.path.join(workdir, "ltsvsstsapp.db")
+
+  s3_timer = S3Timer()
+  s3_timer.install()
+  invoker = LambdaInvoker()
+  invoker.install()
+
+  rows = []
+  try:
+    with mock_aws():
+      s3_client = boto3.client("s3", region_name="us-east-1")
+      s3_client.create_bucket(Bucket=BUCKET)
+
+      samples = ingest_samples(s3_client, args.samples, args.cells, args.verbose,
+                               None if args.compression == "none" else args.compression)
+
+      errors, seconds = reject_invalid_template(samples, args.verbose)
+      print(f"invalid template rejected in {seconds * 1000:.0f} ms:")
+      for error in errors:
+        print("  " + error)
+
+      jobid, seconds = repeat_submission(s3_client, samples, args.verbose)
+      print(f"repeated submission returned job {jobid} in {seconds * 1000:.0f} ms, without a second job")
+
+      if args.shared_scan > 0:
+        computeids = [computeid for computeid in args.computeids if computeid in [1, 2, 4]]
+        rows = run_shared_scan(computeids, args.shared_scan, samples, s3_timer, invoker,
+                               os.path.join(workdir, "cache"), args.verbose, args.backend, args.result_format)
+
+      for computeid in ([] if args.shared_scan > 0 else args.computeids):
+        row = run_job(computeid, samples, s3_timer, args.verbose, args.profile_memory, args.backend,
+                      args.result_format)
+        rows.append(row)
+        print(f"compute {computeid}: status {row['status']}, total {row['total_s']:.2f} s "
+              f"(upload {row['upload_s']:.2f}, compute {row['compute_s']:.2f} "
+              f"[s3 {row['compute_s3_s']:.2f} in {row['compute_s3_calls']} calls, "
+              f"db {row['compute_db_s']:.3f} in {row['compute_db_queries']} queries, "
+              f"other {row['compute_other_s']:.2f}], download {row['download_s']:.2f})"
+              + (" error: " + row["error"] if "error" in row else ""))
+  finally:
+    sqlite_datatier.close()
+    os.chdir(cwd)
+
+  results = pd.DataFrame(rows)
+  print()
+  print(results.to_string(index=False))
+
+  if args.output is not None:
+    results.to_csv(args.output, index=False)
+    print("wrote", args.output)
+
+
+if __name__ == "__main__":
+  main()
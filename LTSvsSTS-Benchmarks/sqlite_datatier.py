@@ -0,0 +1,184 @@
+#
+# sqlite_datatier.py
+#
+# Stand-in for datatier.py backed by SQLite, so the lambda handlers
+# can run offline. Offers the same functions and translates the
+# MySQL statements the handlers use (%s parameters, LAST_INSERT_ID,
+# ON DUPLICATE KEY UPDATE, TRUNCATE, AUTO_INCREMENT) to SQLite.
+# insert_row's ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id) is
+# run as an insert that ignores conflicts and, on a conflict, a
+# no-op update returning the existing row's id.
+# Every handler shares one connection to DATABASE, and the time
+# spent in queries is accumulated in stats.
+#
+
+import re
+import sqlite3
+import threading
+import time
+
+DATABASE = ":memory:"
+
+stats = {"queries": 0, "seconds": 0.0}
+
+_conn = None
+_lock = threading.Lock()
+
+SCHEMA = [
+  """
+  CREATE TABLE IF NOT EXISTS jobs (
+    jobid INTEGER PRIMARY KEY AUTOINCREMENT,
+    computeid INT NOT NULL,
+    status VARCHAR(256) NOT NULL,
+    originaldatafile VARCHAR(256) NOT NULL,
+    datafilekey VARCHAR(256) NOT NULL UNIQUE,
+    resultsfilekey VARCHAR(256) NOT NULL,
+    idempotencykey VARCHAR(64) UNIQUE
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS samples (
+    sampleid INTEGER PRIMARY KEY AUTOINCREMENT,
+    datafilekey VARCHAR(256) NOT NULL UNIQUE,
+    etag VARCHAR(64) NOT NULL,
+    status VARCHAR(256) NOT NULL,
+    cells INT NOT NULL,
+    numcolumns INT NOT NULL,
+    manifestkey VARCHAR(256) NOT NULL,
+    cohort VARCHAR(16) NOT NULL DEFAULT ''
+  );
+  """
+]
+
+_AUTO_INCREMENT = re.compile(r"^\s*ALTER\s+TABLE\s+(\w+)\s+AUTO_INCREMENT\s*=\s*(\d+)\s*;?\s*$", re.I)
+_FOREIGN_KEYS = re.compile(r"^\s*SET\s+FOREIGN_KEY_CHECKS", re.I)
+_TRUNCATE = re.compile(r"TRUNCATE\s+TABLE", re.I)
+_DUPLICATE = re.compile(r"ON\s+DUPLICATE\s+KEY\s+UPDATE", re.I)
+_VALUES = re.compile(r"VALUES\((\w+)\)", re.I)
+_LAST_INSERT_ID = re.compile(r"\w+\s*=\s*LAST_INSERT_ID\(\s*(\w+)\s*\)", re.I)
+
+
+def reset_stats():
+  stats["queries"] = 0
+  stats["seconds"] = 0.0
+
+def translate(sql):
+  """
+  Returns the SQLite form of a MySQL statement, or None for
+  statements with no SQLite equivalent
+  """
+  if _FOREIGN_KEYS.match(sql):
+    return None
+
+  sql = _TRUNCATE.sub("DELETE FROM", sql)
+  sql = sql.replace("LAST_INSERT_ID()", "last_insert_rowid()")
+
+  match = _DUPLICATE.search(sql)
+  if match is not None:
+    update = _VALUES.sub(r"excluded.\1", sql[match.end():])
+    sql = sql[:match.start()].rstrip().rstrip(";") + " ON CONFLICT DO UPDATE SET" + update
+
+  return sql.replace("%s", "?")
+
+def _execute(dbConn, sql, parameters):
+  match = _AUTO_INCREMENT.match(sql)
+  if match is not None:
+    table, start = match.group(1), int(match.group(2))
+    dbConn.execute("DELETE FROM sqlite_sequence WHERE name = ?", [table])
+    dbConn.execute("INSERT INTO sqlite_sequence(name, seq) VALUES(?, ?)", [table, start - 1])
+    return None
+
+  sql = translate(sql)
+  if sql is None:
+    return None
+
+  return dbConn.execute(sql, list(parameters))
+
+def _timed(func):
+  def timed(dbConn, sql, parameters=[]):
+    start = time.perf_counter()
+    try:
+      with _lock:
+        return func(dbConn, sql, parameters)
+    finally:
+      stats["queries"] += 1
+      stats["seconds"] += time.perf_counter() - start
+  return timed
+
+
+###################################################################
+#
+# get_dbConn:
+#
+# Returns the shared connection (the arguments of the MySQL version
+# are ignored), creating the schema on first use with job ids
+# starting at 1001 as on RDS.
+#
+def get_dbConn(endpoint=None, portnum=None, username=None, pwd=None, dbname=None):
+  global _conn
+  if _conn is None:
+    _conn = sqlite3.connect(DATABASE, check_same_thread=False)
+    for statement in SCHEMA:
+      _conn.execute(statement)
+    _execute(_conn, "ALTER TABLE jobs AUTO_INCREMENT = 1001;", [])
+    _conn.commit()
+  return _conn
+
+def close():
+  global _conn
+  if _conn is not None:
+    _conn.close()
+    _conn = None
+
+@_timed
+def retrieve_one_row(dbConn, sql, parameters=[]):
+  cursor = _execute(dbConn, sql, parameters)
+  row = cursor.fetchone() if cursor is not None else None
+  return () if row is None else row
+
+@_timed
+def retrieve_all_rows(dbConn, sql, parameters=[]):
+  cursor = _execute(dbConn, sql, parameters)
+  rows = cursor.fetchall() if cursor is not None else None
+  return [] if rows is None else rows
+
+@_timed
+def perform_action(dbConn, sql, parameters=[]):
+  try:
+    cursor = _execute(dbConn, sql, parameters)
+    dbConn.commit()
+    return cursor.rowcount if cursor is not None else 0
+  except Exception as err:
+    dbConn.rollback()
+    print("datatier.perform_action() failed:")
+    print(str(err))
+    raise
+
+@_timed
+def insert_row(dbConn, sql, parameters=[]):
+  try:
+    match = _DUPLICATE.search(sql)
+    same_id = _LAST_INSERT_ID.search(sql[match.end():]) if match is not None else None
+    if same_id is None:
+      cursor = _execute(dbConn, sql, parameters)
+      dbConn.commit()
+      return cursor.lastrowid, cursor.rowcount
+
+    insert = sql[:match.start()].rstrip().rstrip(";")
+    cursor = _execute(dbConn, insert + " ON CONFLICT DO NOTHING", parameters)
+    if cursor.rowcount == 1:
+      dbConn.commit()
+      return cursor.lastrowid, 1
+
+    column = same_id.group(1)
+    cursor = _execute(dbConn, insert + f" ON CONFLICT DO UPDATE SET {column} = {column} RETURNING {column}",
+                      parameters)
+    rowid = cursor.fetchone()[0]
+    cursor.close()
+    dbConn.commit()
+    return rowid, 0
+  except Exception as err:
+    dbConn.rollback()
+    print("datatier.insert_row() failed:")
+    print(str(err))
+    raise
@@ -0,0 +1,99 @@
+#
+# synthetic.py
+#
+# Generates synthetic samples with the schema of the real sample CSVs
+# (26 *_R marker intensities, the Visiopharm distance metrics and
+# cell centroids) so the analysis code can be measured and exercised
+# without the LFS data. Intensities are a mixture of a negative and a
+# positive population per marker, distances are exponential and
+# centroids uniform over a square sized for a realistic density.
+#
+# Usage: python synthetic.py <cells> <output.csv> [seed]
+#
+
+import sys
+import numpy as np
+import pandas as pd
+
+MARKERS = [
+  "CD11c_R", "CD163_R", "CD205_R", "CD206_R", "CD8_R", "CD4_R", "CD103_R", "FOXP3_R",
+  "GFAP_R", "GRZMB_R", "HLADR_R", "INFgamma_R", "Ki67_R", "NFAT1_R", "NFAT2_R",
+  "P2RY12_R", "PD1_R", "PDL1_R", "Perforin_R", "SOX2_R", "TIM3_R", "TNFa_R",
+  "cCasp3_R", "pLCK_R", "pSTAT3_R", "CD68_R"]
+
+DISTANCES = ["cCasp3+GFAP+ Distance", "cCasp3+GFAP- Distance", "cCasp3+P2RY12+ Distance"]
+
+CENTROIDS = ["X", "Y"]
+
+# cells per square micron, sets the side of the simulated tissue
+DENSITY = 1.0 / 400.0
+
+
+def make_sample(cells, markers=MARKERS, seed=0):
+  """
+  Returns a DataFrame of cells x (markers, distances, centroids)
+  """
+  rng = np.random.default_rng(seed)
+  columns = {}
+
+  for marker in markers:
+    positive_fraction = rng.uniform(0.02, 0.4)
+    positive = rng.random(cells) < positive_fraction
+    negative_level = rng.lognormal(0.0, 0.25, cells)
+    positive_level = rng.lognormal(1.1, 0.3, cells)
+    columns[marker] = np.where(positive, positive_level, negative_level).astype(np.float32)
+
+  for distance in DISTANCES:
+    columns[distance] = rng.exponential(200.0, cells).astype(np.float32)
+
+  side = np.sqrt(cells / DENSITY)
+  for centroid in CENTROIDS:
+    columns[centroid] = (rng.random(cells) * side).astype(np.float32)
+
+  return pd.DataFrame(columns)
+
+def make_thresholds(markers=MARKERS, seed=0):
+  """
+  Returns a threshold per marker in the range of the real ones
+  """
+  rng = np.random.default_rng(seed)
+  return {marker: round(float(rng.uniform(1.3, 2.5)), 2) for marker in markers}
+
+def make_phenotypes(markers=MARKERS, count=20, seed=0):
+  """
+  Returns count phenotypes of one to three markers each, in the list
+  format of the PHENOTYPES template entry
+  """
+  rng = np.random.default_rng(seed)
+  phenotypedict = {}
+  for i in range(count):
+    size = int(rng.integers(1, min(3, len(markers)) + 1))
+    cols = [str(col) for col in rng.choice(markers, size=size, replace=False)]
+    phenotypedict["P" + str(i) + " " + " ".join(col[:-2] for col in cols)] = cols
+  return phenotypedict
+
+def make_distance_bins(edges=(0, 50, 100, 200, 500, 1000)):
+  """
+  Returns distance bins in the notebook's distancedict format for
+  every distance metric
+  """
+  bins = {}
+  for lower, upper in zip(edges[:-1], edges[1:]):
+    bins[str(lower) + "-" + str(upper)] = [lower, upper]
+  return {distance: dict(bins) for distance in DISTANCES}
+
+def write_sample(path_or_buffer, cells, seed=0, compression=None):
+  df = make_sample(cells, seed=seed)
+  df.to_csv(path_or_buffer, index=False, float_format="%.4f", compression=compression)
+  return df
+
+
+if __name__ == "__main__":
+  if len(sys.argv) < 3:
+    print("usage: python synthetic.py <cells> <output.csv> [seed]")
+    sys.exit(1)
+
+  cells = int(sys.argv[1])
+  seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+  write_sample(sys.argv[2], cells, seed)
+  print("wrote", cells, "cells to", sys.argv[2])
@@ -0,0 +1,35 @@
+#
+# test_conformance.py
+#
+# Runs the conformance check (conformance.py) under pytest: every
+# installed analysis backend must return exactly the results of the
+# pandas reference on the edge-case samples, including cell counts
+# around a 64-bit word, empty samples, NaNs and intensities on the
+# thresholds.
+#
+
+import numpy as np
+import pytest
+
+import conformance
+from ltsvssts import analysis
+from ltsvssts import phenotypes
+
+BACKENDS = [name for name in analysis.available_backends() if name != conformance.REFERENCE]
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+@pytest.mark.parametrize("cells", [0, 1, 63, 64, 65, 1000])
+@pytest.mark.parametrize("seed", [0, 1])
+def test_backend_matches_reference(name, cells, seed):
+  df, thresholds, phenotypedict, markers = conformance.make_case(cells, seed, 30)
+  program = phenotypes.compile_phenotypes(phenotypedict)
+  reference = analysis.get_backend(conformance.REFERENCE)
+
+  assert conformance.check(analysis.get_backend(name), reference, df, thresholds, program, markers) == []
+
+def test_compare_reports_differences():
+  expected = np.array([[1, 2], [3, 4]])
+  assert conformance.compare("counts", expected, expected.copy()) is None
+  assert conformance.compare("counts", expected, np.array([[1, 2], [3, 5]])) == "counts: 1 values differ"
+  assert conformance.compare("counts", expected, expected[0]).startswith("counts: shape")
@@ -0,0 +1,71 @@
+#
+# test_samplecache.py
+#
+# Checks that the sample cache returns each column's own values when
+# a job mixes cached columns with columns loaded on a miss, from the
+# CSV or from the columnar .npz.
+#
+
+import io
+import numpy as np
+import pytest
+
+import synthetic
+
+moto = pytest.importorskip("moto")
+boto3 = pytest.importorskip("boto3")
+
+from ltsvssts import samplecache
+
+BUCKET = "ltsvssts-test"
+FILE_KEY = "LTSvsSTS-Data/SYN001.csv"
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+  monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+  monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+  monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+  with moto.mock_aws():
+    client = boto3.client("s3", region_name="us-east-1")
+    client.create_bucket(Bucket=BUCKET)
+    yield client
+
+def put_sample(s3_client, df):
+  body = io.StringIO()
+  df.to_csv(body, index=False)
+  s3_client.put_object(Bucket=BUCKET, Key=FILE_KEY, Body=body.getvalue().encode("utf-8"))
+  return s3_client.head_object(Bucket=BUCKET, Key=FILE_KEY)["ETag"]
+
+def put_columnar(s3_client, df, etag):
+  body = io.BytesIO()
+  np.savez(body, __etag__=np.array(etag.strip('"')), **{col: df[col].to_numpy() for col in df.columns})
+  s3_client.put_object(Bucket=BUCKET, Key="LTSvsSTS-Columnar/SYN001.npz", Body=body.getvalue())
+
+def check_columns(result, df, columns):
+  assert list(result.columns) == columns
+  for col in columns:
+    np.testing.assert_array_equal(result[col].to_numpy(), df[col].to_numpy(), err_msg=col)
+
+
+def test_mixed_hit_and_npz_miss(s3_client, tmp_path):
+  df = synthetic.make_sample(200, seed=1)
+  etag = put_sample(s3_client, df)
+  cache = samplecache.SampleCache(str(tmp_path), 1 << 30)
+  a, b, c = synthetic.MARKERS[:3]
+
+  # warm the cache with one column parsed from the CSV
+  check_columns(cache.load(s3_client, BUCKET, FILE_KEY, [a]), df, [a])
+
+  # the columnar copy appears, then a job needs a cached and a new column
+  put_columnar(s3_client, df, etag)
+  check_columns(cache.load(s3_client, BUCKET, FILE_KEY, [a, b]), df, [a, b])
+
+  # everything now comes from the cache, with each column's own file
+  check_columns(cache.load(s3_client, BUCKET, FILE_KEY, [b, a]), df, [b, a])
+  assert cache.hits == 1 and cache.misses == 2
+
+  # and a third column parsed from the CSV still lands in its own file
+  s3_client.delete_object(Bucket=BUCKET, Key="LTSvsSTS-Columnar/SYN001.npz")
+  check_columns(cache.load(s3_client, BUCKET, FILE_KEY, [c, a, b]), df, [c, a, b])
+  check_columns(cache.load(s3_client, BUCKET, FILE_KEY, [a, b, c]), df, [a, b, c])
@@ -0,0 +1,79 @@
+#
+# test_sampleindex.py
+#
+# Checks that the template checks of ltsvssts_upload
+# (ltsvssts/sampleindex.py) accept a valid template and reject the
+# ones that would fail or count every cell in compute: an unknown
+# marker, a marker without a threshold, a sample without a cohort, a
+# bad SWEEP.
+#
+
+import pytest
+
+pytest.importorskip("pymysql")
+
+from ltsvssts import sampleindex
+
+A = "LTSvsSTS-Data/A.csv"
+B = "LTSvsSTS-Data/B.csv"
+COLUMNS = ["CD8_R", "GFAP_R", "Ki67_R", "Class", "X", "Y"]
+
+
+def make_index(cohort_b="STS", columns_b=COLUMNS):
+  entry = {"etag": "e", "status": "ready", "errors": [], "cells": 10}
+  return {A: dict(entry, columns=COLUMNS, cohort="LTS"),
+          B: dict(entry, columns=columns_b, cohort=cohort_b)}
+
+def make_template(**entries):
+  thresholds = {"CD8_R": 1.5, "GFAP_R": 2.0}
+  template = {"THRESHOLDS": {A: dict(thresholds), B: dict(thresholds)},
+              "PHENOTYPES": {"CD8": ["CD8_R"], "CD8 GFAP": ["CD8_R", "GFAP_R"]}}
+  template.update(entries)
+  return template
+
+
+@pytest.mark.parametrize("computeid", [1, 2, 3, 4, 5, 6, 7])
+def test_valid_template(computeid):
+  assert sampleindex.check_template(make_index(), computeid, make_template()) == []
+
+def test_marker_without_threshold():
+  template = make_template(PHENOTYPES={"Ki67": ["Ki67_R"]})
+  errors = sampleindex.check_template(make_index(), 1, template)
+  assert errors == ["PHENOTYPES: Ki67: marker Ki67_R has no threshold in 2 sample(s): A, B"]
+
+def test_column_without_threshold():
+  template = make_template(PHENOTYPES={"Tumor": ["Class", "CD8_R"]})
+  assert sampleindex.check_template(make_index(), 2, template) == []
+
+@pytest.mark.parametrize("computeid", [4, 6, 7])
+def test_sample_without_cohort(computeid):
+  errors = sampleindex.check_template(make_index(cohort_b=None), computeid, make_template())
+  assert len(errors) == 1 and errors[0].startswith("THRESHOLDS: no LTS or STS cohort for 1 sample(s): B")
+
+  errors = sampleindex.check_template(make_index(cohort_b="LTS"), computeid, make_template())
+  assert errors == ["THRESHOLDS: no STS samples in the job"]
+
+def test_cohort_not_needed():
+  assert sampleindex.check_template(make_index(cohort_b=None), 1, make_template()) == []
+
+def test_sweep_marker_missing():
+  template = make_template()
+  template["THRESHOLDS"][A]["Ki67_R"] = 1.0
+  errors = sampleindex.check_template(make_index(columns_b=["CD8_R", "GFAP_R"]), 5, template)
+  assert len(errors) == 1 and errors[0].startswith("SWEEP: no column Ki67_R in 1 sample(s): B")
+
+@pytest.mark.parametrize("sweep, error", [
+  ({"START": 1.0, "STOP": 5.0, "STEP": 0}, "SWEEP: STEP must be positive"),
+  ({"START": "a", "STOP": 5.0, "STEP": 0.1}, "SWEEP: START, STOP and STEP must be numbers"),
+  ({"CD8_R": [1.0, 2.0]}, "SWEEP: no thresholds for markers: GFAP_R"),
+  ([1.0, "x"], "SWEEP: thresholds of CD8_R must be a list of numbers"),
+  ("1.0", "SWEEP must be a list of thresholds, a dict of marker -> thresholds, or START/STOP/STEP")
+])
+def test_invalid_sweep(sweep, error):
+  errors = sampleindex.check_template(make_index(), 5, make_template(SWEEP=sweep))
+  assert errors[0] == error
+
+@pytest.mark.parametrize("sweep", [[1.0, 2.5], {"CD8_R": [1.0], "GFAP_R": [2]},
+                                   {"START": 1, "STOP": 2, "STEP": 0.5}])
+def test_valid_sweep(sweep):
+  assert sampleindex.check_template(make_index(), 5, make_template(SWEEP=sweep)) == []
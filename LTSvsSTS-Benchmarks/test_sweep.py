@@ -0,0 +1,58 @@
+#
+# test_sweep.py
+#
+# Checks that the threshold sweep of compute5 counts the same
+# positive cells as compute1/2 (ltsvssts/analysis.py), including
+# intensities that equal a threshold only at float32 precision.
+#
+
+import importlib.util
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("pymysql")
+
+from ltsvssts import analysis
+from ltsvssts import phenotypes
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COMPUTE5 = os.path.join(HERE, "..", "LTSvsSTS-AWS", "ltsvssts_compute5", "lambda_function.py")
+
+# thresholds whose float32 value is above their float64 value, so a
+# float32 intensity equal to them is only positive at float32
+BOUNDARIES = [10.41, 1.3, 2.2, 0.7]
+
+
+@pytest.fixture(scope="module")
+def compute5():
+  spec = importlib.util.spec_from_file_location("ltsvssts_compute5_lambda_function", COMPUTE5)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def make_sample(seed):
+  rng = np.random.default_rng(seed)
+  values = rng.choice(np.array(BOUNDARIES + [0.0, 5.0, 20.0]), size=500)
+  values = np.where(rng.random(500) < 0.5, values, rng.uniform(0, 20, 500))
+  values[rng.random(500) < 0.05] = np.nan
+  return pd.DataFrame({"A_R": values.astype(np.float32), "B_R": (values * 0.5).astype(np.float32)})
+
+
+@pytest.mark.parametrize("backend", analysis.available_backends())
+def test_sweep_matches_thresholding(compute5, backend):
+  assert any(np.float64(np.float32(thr)) > thr for thr in BOUNDARIES)
+
+  df = make_sample(0)
+  sweep = BOUNDARIES + [thr * 0.5 for thr in BOUNDARIES] + [0.0, 5.0, 20.0]
+  sweepdict = compute5.sweep_thresholds(sweep, ["A_R", "B_R"])
+  counts = compute5.sweep_counts(compute5.sort_markers(df, ["A_R", "B_R"]), sweepdict)
+
+  engine = analysis.get_backend(backend)
+  program = phenotypes.compile_phenotypes({"A": ["A_R"], "B": ["B_R"]})
+  for i in range(len(sweep)):
+    thresholds = {marker: sweepdict[marker][i] for marker in ["A_R", "B_R"]}
+    expected = engine.count_phenotypes(engine.threshold(df, thresholds), program)
+    assert [counts["A_R"][i], counts["B_R"][i]] == list(expected), thresholds